@@ -0,0 +1,82 @@
+# activity.py - تجميع تحديثات النشاط (last_active وعدد التفاعلات) قبل كتابتها
+#
+# كل تفاعل كان يعني اتصالاً وجملة UPDATE و commit، وهذه الكتابات الصغيرة تنافس
+# جمل الحجز على قفل الكتابة الوحيد في sqlite لحظة فتح الحجز. هنا تُسجَّل في
+# الذاكرة، وتُدمج تحديثات نفس المستخدم، وتُكتب كل FLUSH_SECONDS (وعند الإيقاف)
+# في معاملة واحدة. فقدان آخر دفعة عند انهيار البوت مقبول لهذه البيانات.
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+import adb
+import db
+
+logger = logging.getLogger(__name__)
+
+# فترة الكتابة (بالثواني)
+FLUSH_SECONDS = 30
+
+
+class ActivityBuffer:
+    """تحديثات نشاط معلقة لكل قاعدة: {المسار: {user_id: [آخر نشاط، عدد التفاعلات]}}"""
+
+    def __init__(self):
+        self._pending = {}
+        self.recorded = 0
+        self.written = 0
+
+    def touch(self, user_id):
+        """تسجيل تفاعل للمستخدم في قاعدة القسم الحالي"""
+        # نفس صيغة CURRENT_TIMESTAMP في sqlite (UTC)
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        users = self._pending.setdefault(db.get_db_name(), {})
+        entry = users.get(user_id)
+        if entry is None:
+            users[user_id] = [now, 1]
+        else:
+            entry[0] = now
+            entry[1] += 1
+        self.recorded += 1
+
+    async def flush(self, path=None):
+        """كتابة التحديثات المعلقة لقاعدة واحدة (الحالية افتراضياً) - يعيد عدد الصفوف"""
+        path = path or db.get_db_name()
+        users = self._pending.pop(path, None)
+        if not users:
+            return 0
+        rows = [(last_active, count, user_id) for user_id, (last_active, count) in users.items()]
+        try:
+            with db.use_database(path):
+                await adb.record_activity(rows)
+        except Exception:
+            # إعادتها للدفعة التالية مع دمج ما وصل أثناء المحاولة
+            pending = self._pending.setdefault(path, {})
+            for user_id, (last_active, count) in users.items():
+                entry = pending.get(user_id)
+                if entry is None:
+                    pending[user_id] = [last_active, count]
+                else:
+                    entry[1] += count
+            raise
+        self.written += len(rows)
+        return len(rows)
+
+    async def run(self, interval=FLUSH_SECONDS):
+        """كتابة دورية لقاعدة القسم الحالي"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("فشل حفظ النشاط")
+
+    def get_stats(self):
+        return {
+            'pending_users': sum(len(users) for users in self._pending.values()),
+            'recorded': self.recorded,
+            'written': self.written,
+        }
+
+
+buffer = ActivityBuffer()
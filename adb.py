@@ -0,0 +1,87 @@
+# adb.py - واجهة غير متزامنة لقاعدة البيانات (تشغيل دوال db.py خارج حلقة الأحداث)
+#
+# الاستخدام داخل المعالجات:
+#     user = await adb.get_user(user_id)
+# كل دالة في db.py متاحة هنا بنفس الاسم والمعاملات، وتُنفَّذ على خيوط عاملة
+# حتى لا تتوقف حلقة أحداث البوت أثناء الاتصال والكتابة على القرص.
+
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# الاستدعاءات الأبطأ من هذا الحد تُسجَّل كتحذير
+SLOW_CALL_MS = 200
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=db.READER_POOL_SIZE + 1,
+                    thread_name_prefix='db'
+                )
+    return _executor
+
+def _record(name, elapsed):
+    # التوزيع الكامل في metrics.DB_SECONDS، وهنا تسجيل الاستدعاءات البطيئة فقط
+    ms = elapsed * 1000
+    if ms >= SLOW_CALL_MS:
+        logger.warning("db.%s بطيء: %.1f ms", name, ms)
+    else:
+        logger.debug("db.%s: %.1f ms", name, ms)
+
+async def run(func, *args, **kwargs):
+    """تشغيل دالة متزامنة على خيط عامل مع قياس زمنها"""
+    loop = asyncio.get_running_loop()
+    # run_in_executor لا ينقل متغيرات السياق - ننقلها يدوياً حتى تعمل الدالة على قاعدة القسم الحالي
+    context = contextvars.copy_context()
+    start = time.perf_counter()
+    try:
+        async with metrics.timed(metrics.DB_SECONDS, metrics.DB_ERRORS, metrics.DB_IN_FLIGHT,
+                                 function=func.__name__):
+            return await loop.run_in_executor(
+                _get_executor(), functools.partial(context.run, func, *args, **kwargs)
+            )
+    finally:
+        _record(func.__name__, time.perf_counter() - start)
+
+async def get_user(user_id):
+    """قراءة المستخدم - من ذاكرة db مباشرة دون خيط عامل إذا وُجد فيها"""
+    user = db.peek_cached_user(user_id)
+    if user is not db.USER_NOT_CACHED:
+        return user
+    return await run(db.get_user, user_id)
+
+def shutdown():
+    """إيقاف الخيوط العاملة وإغلاق مجمع الاتصالات"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+    db.close_pool()
+
+def __getattr__(name):
+    func = getattr(db, name, None)
+    if name.startswith('_') or not callable(func):
+        raise AttributeError(f"module 'adb' has no attribute '{name}'")
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    globals()[name] = wrapper
+    return wrapper
@@ -0,0 +1,80 @@
+# allocation.py - توزيع أيام الشهر حسب رغبات الأطباء المرتبة (نمط الرغبات)
+#
+# بدلاً من سباق الضغط على أزرار الحجز عند فتحه، يرسل كل طبيب خلال نافذة
+# التسجيل قائمة أيام مرتبة حسب أفضليته، وعند غلق النافذة توزَّع الأيام دفعة
+# واحدة (db.allocate_preferences يستدعي allocate داخل معاملة كتابة واحدة).
+#
+# سياسة العدالة - جولات بالتناوب (snake draft):
+#   - في كل جولة يأخذ كل طبيب لم يبلغ حده أفضل يوم متاح من قائمته
+#   - ترتيب الجولة الأولى عشوائي ثابت للشهر (يمكن إعادة التوزيع ومراجعته)،
+#     ويُعكس في كل جولة تالية: من اختار أولاً يختار آخراً في الجولة التالية
+#   - لا يأخذ أحد يومه الثاني قبل أن يأخذ كل من له رغبة متاحة يومه الأول
+#   - الحد = max_days ناقص حجوزات الطبيب الموجودة في الشهر، والأيام المحجوزة
+#     مسبقاً أو خارج أيام الشهر تُتخطى
+#   - لا يُعطى طبيب يوماً لم يطلبه؛ ما لم يتحقق من حده يُعاد في unmet
+
+import random
+from collections import namedtuple
+
+# assignments: {user_id: [الأيام بترتيب التوزيع]}
+# unmet: {user_id: عدد الأيام الناقصة عن حده بعد نفاد رغباته المتاحة}
+# order: ترتيب الجولة الأولى (للمراجعة)
+Allocation = namedtuple('Allocation', ['assignments', 'unmet', 'order'])
+
+
+def allocate(preferences, quotas, taken=(), month_days=31, seed=None):
+    """توزيع الأيام حسب الرغبات
+
+    preferences: {user_id: [الأيام مرتبة من الأفضل]}
+    quotas: {user_id: عدد الأيام المسموح بإضافتها}
+    taken: أيام محجوزة مسبقاً
+    seed: بذرة ترتيب الجولة الأولى (نفس البذرة = نفس النتيجة)
+    """
+    taken = set(taken)
+    # قوائم نظيفة: بدون تكرار أو أيام خارج الشهر، والأطباء بلا حد يُستبعدون
+    wishes = {}
+    for user_id, days in preferences.items():
+        if quotas.get(user_id, 0) <= 0:
+            continue
+        seen = set()
+        wishes[user_id] = [
+            day for day in days
+            if 1 <= day <= month_days and not (day in seen or seen.add(day))
+        ]
+
+    order = sorted(wishes)
+    random.Random(seed).shuffle(order)
+
+    assignments = {user_id: [] for user_id in order}
+    # موضع كل طبيب في قائمته: الأيام قبله إما أُخذت له أو أخذها غيره
+    cursor = dict.fromkeys(order, 0)
+    active = list(order)
+    while active:
+        still_active = []
+        for user_id in active:
+            days = wishes[user_id]
+            position = cursor[user_id]
+            while position < len(days) and days[position] in taken:
+                position += 1
+            if position == len(days):
+                cursor[user_id] = position
+                continue
+            day = days[position]
+            taken.add(day)
+            assignments[user_id].append(day)
+            cursor[user_id] = position + 1
+            if len(assignments[user_id]) < quotas[user_id]:
+                still_active.append(user_id)
+        # الجولة التالية بالترتيب المعكوس
+        active = still_active[::-1]
+
+    unmet = {
+        user_id: quotas[user_id] - len(days)
+        for user_id, days in assignments.items()
+        if len(days) < quotas[user_id]
+    }
+    return Allocation(
+        {user_id: days for user_id, days in assignments.items() if days},
+        unmet,
+        order
+    )
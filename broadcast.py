@@ -0,0 +1,216 @@
+# broadcast.py - إرسال الإشعارات الجماعية بالتوازي مع احترام حدود تيليجرام
+#
+# تيليجرام يسمح بحوالي 30 رسالة في الثانية إجمالاً ورسالة واحدة في الثانية لكل محادثة.
+# الإرسال يتم عبر عدة عمال متزامنين يمرون بمحدد معدل مشترك، مع احترام RetryAfter
+# وإعادة المحاولة عند أخطاء الشبكة المؤقتة، ويمكن للمشرف إيقاف الإرسال في أي لحظة.
+
+import asyncio
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# الحد العام للرسائل في الثانية (أقل قليلاً من حد تيليجرام)
+GLOBAL_RATE = 25
+
+# أقل فاصل بين رسالتين لنفس المحادثة (بالثواني)
+PER_CHAT_INTERVAL = 1.0
+
+# عدد العمال المتزامنين
+MAX_CONCURRENCY = 10
+
+# عدد المحاولات عند أخطاء الشبكة المؤقتة
+MAX_RETRIES = 3
+
+# أقل فاصل بين تقارير التقدم (بالثواني)
+PROGRESS_INTERVAL = 2.0
+
+
+class RateLimiter:
+    """محدد معدل: حد عام (token bucket) وفاصل أدنى لكل محادثة"""
+
+    def __init__(self, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # وقت آخر إرسال لكل محادثة؛ الأقدم من الفاصل لا يفيد ويُحذف دورياً
+        self._last_sent = {}
+        self._pruned_at = self._updated
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """إيقاف كل الإرسال مؤقتاً (بعد RetryAfter من تيليجرام)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _chat_wait(self, chat_id, now):
+        last = self._last_sent.get(chat_id)
+        return 0.0 if last is None else last + self.per_chat_interval - now
+
+    def _prune(self, now):
+        if now - self._pruned_at < self.per_chat_interval:
+            return
+        self._pruned_at = now
+        expired = now - self.per_chat_interval
+        for chat_id in [c for c, sent in self._last_sent.items() if sent <= expired]:
+            del self._last_sent[chat_id]
+
+    async def _wait_token(self):
+        """انتظار رمز من الحد العام (تحت القفل) - يعيد الوقت الحالي دون استهلاك الرمز"""
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                return now
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def acquire(self, chat_id):
+        while True:
+            # انتظار الفاصل الخاص بالمحادثة خارج القفل حتى لا يعطل المحادثات الأخرى
+            wait = self._chat_wait(chat_id, time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            async with self._lock:
+                now = await self._wait_token()
+                # الفحص وحجز الموعد بلا await بينهما: إرسالان متزامنان لنفس المحادثة لا يمران معاً
+                if self._chat_wait(chat_id, now) > 0:
+                    continue
+                self._tokens -= 1
+                self._last_sent[chat_id] = now
+                self._prune(now)
+                return
+
+
+# محدد لكل بوت (حدود تيليجرام لكل توكن)، مشترك بين كل عمليات الإرسال في العملية
+_limiters = {}
+
+def get_limiter(bot_token=None):
+    limiter = _limiters.get(bot_token)
+    if limiter is None:
+        limiter = _limiters[bot_token] = RateLimiter()
+    return limiter
+
+
+class Broadcast:
+    """عملية إرسال جماعي واحدة وحالتها"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, chat_ids, text, parse_mode=None):
+        self.id = next(self._ids)
+        self.chat_ids = list(chat_ids)
+        self.text = text
+        self.parse_mode = parse_mode
+        self.total = len(self.chat_ids)
+        self.delivered = 0
+        self.failed = 0
+        self.cancelled = False
+        self.done = False
+
+    @property
+    def processed(self):
+        return self.delivered + self.failed
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def _retry_seconds(error):
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+async def deliver(bot, chat_id, text, parse_mode=None, is_cancelled=None, kind='message'):
+    """إرسال رسالة واحدة عبر محدد المعدل مع إعادة المحاولة - يعيد True عند النجاح
+
+    kind: نوع الرسالة في مقياس bot_deliveries_total (reminder، broadcast، ...)
+    """
+    limiter = get_limiter(bot.token)
+    attempt = 0
+    while not (is_cancelled and is_cancelled()):
+        await limiter.acquire(chat_id)
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            metrics.DELIVERIES.inc(kind=kind, result='delivered')
+            return True
+        except RetryAfter as e:
+            logger.warning("RetryAfter %.1fs أثناء الإرسال", _retry_seconds(e))
+            metrics.DELIVERIES.inc(kind=kind, result='retry_after')
+            limiter.pause(_retry_seconds(e))
+        except (BadRequest, Forbidden) as e:
+            # المستخدم حظر البوت أو المحادثة غير صالحة - لا فائدة من الإعادة
+            logger.info("تعذر الإرسال إلى %s: %s", chat_id, e)
+            metrics.DELIVERIES.inc(kind=kind, result='rejected')
+            return False
+        except NetworkError as e:
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                logger.warning("فشل الإرسال إلى %s بعد %d محاولات: %s", chat_id, attempt, e)
+                metrics.DELIVERIES.inc(kind=kind, result='failed')
+                return False
+            await asyncio.sleep(2 ** (attempt - 1))
+        except TelegramError as e:
+            # أخطاء أخرى (ChatMigrated مثلاً) تُحسب فشلاً بدل إسقاط العامل
+            logger.warning("تعذر الإرسال إلى %s: %s", chat_id, e)
+            metrics.DELIVERIES.inc(kind=kind, result='failed')
+            return False
+    metrics.DELIVERIES.inc(kind=kind, result='cancelled')
+    return False
+
+async def run_broadcast(bot, broadcast, on_progress=None):
+    """تنفيذ الإرسال الجماعي وإرجاع Broadcast بعد الانتهاء أو الإيقاف
+
+    on_progress: دالة async تُستدعى بالعملية دورياً وعند الانتهاء
+    """
+    pending = asyncio.Queue()
+    for chat_id in broadcast.chat_ids:
+        pending.put_nowait(chat_id)
+
+    last_report = time.monotonic()
+
+    async def report(force=False):
+        nonlocal last_report
+        if on_progress is None:
+            return
+        now = time.monotonic()
+        if not force and now - last_report < PROGRESS_INTERVAL:
+            return
+        last_report = now
+        try:
+            await on_progress(broadcast)
+        except Exception:
+            logger.exception("فشل تحديث تقدم الإرسال الجماعي")
+
+    async def worker():
+        while not broadcast.cancelled:
+            try:
+                chat_id = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            delivered = await deliver(
+                bot, chat_id, broadcast.text, broadcast.parse_mode,
+                is_cancelled=lambda: broadcast.cancelled, kind='broadcast'
+            )
+            if delivered:
+                broadcast.delivered += 1
+            elif not broadcast.cancelled:
+                broadcast.failed += 1
+            await report()
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(MAX_CONCURRENCY, broadcast.total))))
+    finally:
+        broadcast.done = True
+    await report(force=True)
+    return broadcast
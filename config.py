@@ -1,4 +1,45 @@
 # config.py - ملف الإعدادات (لن تحتاج لتعديله بعد الآن)
 
+import os
 
 ADMIN_ID = 592614066  # استبدل هذا بمعرف التليجرام الخاص بالمشرف
+
+# مستوى التسجيل (DEBUG يُظهر زمن كل استدعاء للقاعدة)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING")
+
+# سجل الأقسام (JSON) لخدمة عدة أقسام من عملية واحدة - انظر tenants.py
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
+
+# ==================== الحجز ====================
+
+# مدة نافذة تسجيل الرغبات في نمط الرغبات إذا فُتح الحجز دون وقت غلق (بالساعات)
+PREFERENCE_WINDOW_HOURS = float(os.getenv("PREFERENCE_WINDOW_HOURS", "24"))
+
+# ==================== طريقة استقبال التحديثات ====================
+
+# عنوان خادم Bot API بديل (خادم telegram-bot-api محلي، أو tools/fake_bot_api.py)
+# فارغ = api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+# عدد التحديثات التي تُعالج بالتوازي (تحديثات المستخدم الواحد تبقى بالترتيب)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+
+# polling (الافتراضي) أو webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# العنوان العام الذي يصل إليه تيليجرام (عبر الوكيل العكسي)، بدون المسار
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+
+# العنوان والمنفذ المحليان لخادم webhook (الوكيل العكسي يمرر إليهما)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+
+# رمز سري يرسله تيليجرام في ترويسة X-Telegram-Bot-Api-Secret-Token (إلزامي في وضع webhook)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# ==================== المقاييس ====================
+
+# منفذ GET /metrics بصيغة Prometheus (0 = معطل). محلي فقط: لا يوجد تحقق من الهوية
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
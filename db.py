@@ -1,23 +1,221 @@
 # db.py - قاعدة البيانات المتكاملة لبوت المناوبات (نسخة سريعة)
 
+import contextvars
+import os
+import queue
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-DB_NAME = 'duty_bot.db'
+import allocation
+import querytrace
 
-def get_db():
-    """إنشاء اتصال بقاعدة البيانات"""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+# يمكن تغيير مسار القاعدة عبر متغير البيئة DB_NAME (للاختبارات وقياس الأداء)
+DB_NAME = os.getenv("DB_NAME", 'duty_bot.db')
 
-def init_db():
-    """إنشاء الجداول المطلوبة"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # جدول المستخدمين (الأطباء)
-    cursor.execute('''
+# قاعدة القسم الحالي في وضع تعدد الأقسام (tenants.py)؛ بدونها تُستخدم DB_NAME.
+# متغير سياق وليس عاماً: كل مهمة asyncio ترث قاعدة القسم الذي أنشأها
+_current_db = contextvars.ContextVar('db_name', default=None)
+
+def get_db_name():
+    """مسار قاعدة البيانات في السياق الحالي"""
+    return _current_db.get() or DB_NAME
+
+def activate_database(path):
+    """تفعيل قاعدة لبقية المهمة الحالية وما تنشئه من مهام"""
+    _current_db.set(path)
+
+@contextmanager
+def use_database(path):
+    """تنفيذ كتلة على قاعدة بيانات محددة (قاعدة قسم)"""
+    token = _current_db.set(path)
+    try:
+        yield
+    finally:
+        _current_db.reset(token)
+
+# عدد اتصالات القراءة في المجمع (الكتابة عبر اتصال واحد فقط)
+READER_POOL_SIZE = 4
+
+# إعدادات الاتصال: WAL يسمح بالقراءة أثناء الكتابة، و NORMAL يكفي مع WAL
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# دوال تُستدعى على كل اتصال جديد في المجمع (للتتبع والقياس)
+CONNECTION_HOOKS = []
+
+# ==================== مجمع الاتصالات ====================
+
+class PooledConnection:
+    """اتصال مستعار من المجمع - close() يعيده إلى المجمع بدلاً من إغلاقه"""
+
+    def __init__(self, pool, conn, write):
+        self._pool = pool
+        self._conn = conn
+        self._write = write
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    # كل الجمل تمر عبر مؤشر متتبَّع (querytrace) لقياس زمنها
+    def cursor(self):
+        return querytrace.wrap(self._conn.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if conn.in_transaction:
+            conn.rollback()
+        self._pool.release(conn, self._write)
+
+
+class ConnectionPool:
+    """مجمع اتصالات طويلة العمر: كاتب واحد وعدة قرّاء"""
+
+    def __init__(self, path, readers=READER_POOL_SIZE):
+        self.path = path
+        self.max_readers = readers
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        for hook in CONNECTION_HOOKS:
+            hook(conn)
+        return conn
+
+    def acquire(self, write=False):
+        """استعارة اتصال (الكاتب حصري، والقرّاء حتى max_readers)"""
+        if write:
+            self._writer_lock.acquire()
+            try:
+                if self._writer is None:
+                    self._writer = self._connect()
+            except BaseException:
+                # القفل لا يُحرَّر إلا في close() - فشل الاتصال يجب ألا يحبس كل الكتابات
+                self._writer_lock.release()
+                raise
+            return PooledConnection(self, self._writer, True)
+        
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._reader_count < self.max_readers
+                if create:
+                    self._reader_count += 1
+            if not create:
+                conn = self._readers.get()
+            else:
+                try:
+                    conn = self._connect()
+                except BaseException:
+                    with self._lock:
+                        self._reader_count -= 1
+                    raise
+        return PooledConnection(self, conn, False)
+
+    def release(self, conn, write):
+        if write:
+            self._writer_lock.release()
+        else:
+            self._readers.put(conn)
+
+    def close(self):
+        """إغلاق جميع الاتصالات الخاملة"""
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._reader_count = 0
+
+
+# مجمع لكل قاعدة: {المسار: ConnectionPool}
+_pools = {}
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """مجمع الاتصالات الخاص بقاعدة البيانات الحالية"""
+    path = get_db_name()
+    pool = _pools.get(path)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = _pools[path] = ConnectionPool(path)
+    return pool
+
+def close_pool(path=None):
+    """إغلاق مجمع قاعدة واحدة، أو كل المجمعات (عند إيقاف البوت)"""
+    with _pool_lock:
+        paths = [path] if path is not None else list(_pools)
+        for name in paths:
+            pool = _pools.pop(name, None)
+            if pool is not None:
+                pool.close()
+
+def get_db(write=False):
+    """استعارة اتصال من المجمع (write=True لاتصال الكتابة الوحيد)"""
+    return get_pool().acquire(write)
+
+# ==================== إصدار البيانات ====================
+
+# عدّاد يزيد مع كل تغيير يؤثر على الرسائل المعروضة (الحجوزات، أيام الشهر، حدود الأطباء)
+# لكل قاعدة: {المسار: رقم}. تستخدمه ذاكرة الرسائل في main.py لمعرفة متى تنتهي صلاحيتها.
+_data_versions = {}
+_data_versions_lock = threading.Lock()
+
+def get_data_version():
+    """رقم الإصدار الحالي لبيانات الجدول"""
+    return _data_versions.get(get_db_name(), 0)
+
+def bump_data_version():
+    """تسجيل تغيير في البيانات المعروضة"""
+    path = get_db_name()
+    with _data_versions_lock:
+        _data_versions[path] = _data_versions.get(path, 0) + 1
+
+# ==================== ترحيل المخطط ====================
+
+# خطوات الترحيل مرتبة؛ رقم الخطوة = قيمة PRAGMA user_version بعد تطبيقها.
+# لا تعدّل خطوة منشورة - أضف خطوة جديدة في النهاية.
+MIGRATIONS = [
+    # 1: الجداول الأساسية
+    (
+        '''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             full_name TEXT NOT NULL,
@@ -26,10 +224,8 @@ def init_db():
             registered_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             last_active TIMESTAMP
         )
-    ''')
-    
-    # جدول الحجوزات
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS bookings (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             day INTEGER NOT NULL,
@@ -41,51 +237,253 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (user_id),
             UNIQUE(day, month)
         )
-    ''')
-    
-    # جدول إعدادات النظام
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY,
             value TEXT NOT NULL,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # جدول طلبات الانتظار
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS pending_approvals (
             user_id INTEGER PRIMARY KEY,
             full_name TEXT NOT NULL,
             request_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # إضافة الإعدادات الافتراضية
-    default_settings = [
-        ('month_days', '31'),
-        ('booking_open', '0'),
-        ('scheduled_booking_time', '')
-    ]
-    
-    for key, value in default_settings:
-        cursor.execute(
-            "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
-            (key, value)
+        ''',
+    ),
+    # 2: جدول المؤقتات (فتح/غلق الحجز المجدول...)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS timers (
+            name TEXT PRIMARY KEY,
+            action TEXT NOT NULL,
+            run_at TEXT NOT NULL,
+            payload TEXT
         )
+        ''',
+    ),
+    # 3: فهارس الاستعلامات المتكررة
+    (
+        # حجوزات المستخدم في شهر (get_user_bookings، عدّاد book_day، delete_user)
+        "CREATE INDEX IF NOT EXISTS idx_bookings_user_month ON bookings (user_id, month, day)",
+        # جدول الشهر والتذكيرات (get_all_bookings، get_due_reminders، reset_month)
+        "CREATE INDEX IF NOT EXISTS idx_bookings_month_day ON bookings (month, day, user_id)",
+        # قائمة المعتمدين مرتبة بالاسم (get_approved_users)
+        "CREATE INDEX IF NOT EXISTS idx_users_approved_name ON users (approved, full_name)",
+        # طلبات الانتظار بالترتيب (get_pending_users)
+        "CREATE INDEX IF NOT EXISTS idx_pending_request_date ON pending_approvals (request_date)",
+        "CREATE INDEX IF NOT EXISTS idx_timers_run_at ON timers (run_at)",
+    ),
+    # 4: أرشيف الحجوزات (الأشهر المغلقة والأشهر المصفّرة)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS bookings_archive (
+            id INTEGER PRIMARY KEY,
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            full_name TEXT,
+            booked_date TIMESTAMP,
+            superseded INTEGER DEFAULT 0,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # superseded = 1 لحجوزات شهر تم تصفيره (محفوظة للرجوع فقط ولا تظهر في الاستعلامات)
+        "CREATE INDEX IF NOT EXISTS idx_archive_month_day ON bookings_archive (month, day) "
+        "WHERE superseded = 0",
+        "CREATE INDEX IF NOT EXISTS idx_archive_user_month ON bookings_archive (user_id, month, day) "
+        "WHERE superseded = 0",
+    ),
+    # 5: المهام الخلفية (الإرسال الجماعي والتصدير) وحالتها
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            title TEXT NOT NULL,
+            params TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+        # المهام غير المنتهية عند البدء (mark_interrupted_jobs)
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)",
+    ),
+    # 6: حالة المحادثة لكل مستخدم (context.user_data) - انظر persistence.py
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    # 7: عدّاد التفاعلات لكل مستخدم (يُحدَّث مع last_active من activity.py)
+    (
+        "ALTER TABLE users ADD COLUMN interactions INTEGER DEFAULT 0",
+    ),
+    # 8: رغبات الأطباء المرتبة لنمط الرغبات (تُحذف بعد توزيع الشهر) - انظر allocation.py
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS booking_preferences (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            day INTEGER NOT NULL,
+            rank INTEGER NOT NULL,
+            submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, month, day)
+        )
+        ''',
+        # رغبات المستخدم بالترتيب (get_preferences) ورغبات الشهر كاملة (allocate_preferences)
+        "CREATE INDEX IF NOT EXISTS idx_preferences_month_user ON booking_preferences (month, user_id, rank)",
+    ),
+]
+
+def get_schema_version(conn):
+    """رقم إصدار المخطط الحالي"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    """تطبيق خطوات الترحيل الناقصة، كل خطوة في معاملة مستقلة"""
+    version = get_schema_version(conn)
+    for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return get_schema_version(conn)
+
+def init_db():
+    """إنشاء الجداول المطلوبة وترحيل المخطط لآخر إصدار"""
+    conn = get_db(write=True)
+    try:
+        # auto_vacuum التدريجي يسمح بإرجاع مساحة الأرشفة للنظام دون VACUUM كامل؛
+        # تغييره في قاعدة موجودة يحتاج VACUUM واحد (خارج أي معاملة)
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+
+        migrate(conn)
+        cursor = conn.cursor()
+
+        # إضافة الإعدادات الافتراضية
+        default_settings = [
+            ('month_days', '31'),
+            ('booking_open', '0'),
+            ('scheduled_booking_time', ''),
+            ('booking_mode', BOOKING_MODE_FIRST_COME)
+        ]
+
+        for key, value in default_settings:
+            cursor.execute(
+                "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+                (key, value)
+            )
+
+        conn.commit()
+    finally:
+        conn.close()
     
-    conn.commit()
-    conn.close()
+    with _settings_lock:
+        _settings_cache.pop(get_db_name(), None)
+
+# ==================== ذاكرة المستخدمين ====================
+
+# كل رسالة وزر يقرأ المستخدم للتحقق من اعتماده؛ الصفوف (وغياب غير المسجلين) تُحفظ
+# في الذاكرة لكل قاعدة مع مدة صلاحية وحد أقصى يُحذف عنده الأقدم استخداماً.
+# كل دالة تعدّل بيانات المستخدم هنا تستدعي invalidate_user.
+USER_CACHE_TTL = 300
+USER_CACHE_SIZE = 10000
+
+# {المسار: OrderedDict({user_id: (انتهاء الصلاحية، الصف أو None)})}
+_user_cache = {}
+# {المسار: رقم يزيد مع كل إلغاء} - قراءة بدأت قبل الإلغاء لا تُحفظ نتيجتها
+_user_cache_versions = {}
+_user_cache_lock = threading.Lock()
+_user_cache_stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+# قيمة peek_cached_user عندما لا يكون المستخدم في الذاكرة
+USER_NOT_CACHED = object()
+
+def peek_cached_user(user_id):
+    """المستخدم من الذاكرة فقط: الصف، أو None لغير المسجل، أو USER_NOT_CACHED"""
+    path = get_db_name()
+    with _user_cache_lock:
+        users = _user_cache.get(path)
+        entry = users.get(user_id) if users is not None else None
+        if entry is None:
+            return USER_NOT_CACHED
+        if entry[0] < time.monotonic():
+            del users[user_id]
+            return USER_NOT_CACHED
+        users.move_to_end(user_id)
+        _user_cache_stats['hits' if entry[1] is not None else 'negative_hits'] += 1
+        return entry[1]
+
+def invalidate_user(user_id=None):
+    """حذف مستخدم (أو الجميع) من ذاكرة القاعدة الحالية"""
+    path = get_db_name()
+    with _user_cache_lock:
+        _user_cache_versions[path] = _user_cache_versions.get(path, 0) + 1
+        users = _user_cache.get(path)
+        if users is None:
+            return
+        if user_id is None:
+            users.clear()
+        else:
+            users.pop(user_id, None)
+        _user_cache_stats['invalidations'] += 1
+
+def get_user_cache_stats():
+    """إحصائيات ذاكرة المستخدمين (لكل القواعد)"""
+    with _user_cache_lock:
+        stats = dict(_user_cache_stats)
+        stats['size'] = sum(len(users) for users in _user_cache.values())
+    lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+    stats['hit_rate'] = (stats['hits'] + stats['negative_hits']) / lookups if lookups else 0.0
+    return stats
 
 # ==================== دوال المستخدمين ====================
 
 def get_user(user_id):
-    """الحصول على معلومات مستخدم"""
+    """الحصول على معلومات مستخدم (من الذاكرة إن وُجد)"""
+    user = peek_cached_user(user_id)
+    if user is not USER_NOT_CACHED:
+        return user
+
+    path = get_db_name()
+    with _user_cache_lock:
+        _user_cache_stats['misses'] += 1
+        version = _user_cache_versions.get(path, 0)
     conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     user = cursor.fetchone()
     conn.close()
+
+    with _user_cache_lock:
+        if _user_cache_versions.get(path, 0) == version:
+            users = _user_cache.setdefault(path, OrderedDict())
+            users[user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+            users.move_to_end(user_id)
+            while len(users) > USER_CACHE_SIZE:
+                users.popitem(last=False)
+                _user_cache_stats['evictions'] += 1
     return user
 
 def get_approved_users():
@@ -108,102 +506,137 @@ def get_pending_users():
 
 def add_user(user_id, full_name):
     """إضافة مستخدم جديد لقائمة الانتظار"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO pending_approvals (user_id, full_name) VALUES (?, ?)",
-        (user_id, full_name)
-    )
-    conn.commit()
-    conn.close()
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO pending_approvals (user_id, full_name) VALUES (?, ?)",
+            (user_id, full_name)
+        )
+        conn.commit()
+    finally:
+        conn.close()
 
 def approve_user(user_id, max_days=2):
     """الموافقة على مستخدم"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT full_name FROM pending_approvals WHERE user_id = ?", (user_id,))
-    pending = cursor.fetchone()
-    
-    if pending:
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT full_name FROM pending_approvals WHERE user_id = ?", (user_id,))
+        pending = cursor.fetchone()
+        if not pending:
+            return False
         cursor.execute(
             "INSERT INTO users (user_id, full_name, approved, max_days) VALUES (?, ?, 1, ?)",
             (user_id, pending['full_name'], max_days)
         )
         cursor.execute("DELETE FROM pending_approvals WHERE user_id = ?", (user_id,))
         conn.commit()
+    finally:
         conn.close()
-        return True
-    
-    conn.close()
-    return False
+    invalidate_user(user_id)
+    return True
 
 def reject_user(user_id):
     """رفض مستخدم"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM pending_approvals WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM pending_approvals WHERE user_id = ?", (user_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_user(user_id)
 
 def update_user_max_days(user_id, max_days):
     """تحديث عدد الأيام المسموحة لمستخدم"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE users SET max_days = ? WHERE user_id = ?",
-        (max_days, user_id)
-    )
-    conn.commit()
-    conn.close()
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET max_days = ? WHERE user_id = ?",
+            (max_days, user_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_user(user_id)
+    bump_data_version()
 
 def delete_user(user_id):
     """حذف مستخدم نهائياً"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-    cursor.execute("DELETE FROM bookings WHERE user_id = ?", (user_id,))
-    cursor.execute("DELETE FROM pending_approvals WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM bookings WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM pending_approvals WHERE user_id = ?", (user_id,))
+        cursor.execute("DELETE FROM booking_preferences WHERE user_id = ?", (user_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    invalidate_user(user_id)
+    bump_data_version()
 
 def update_last_active(user_id):
     """تحديث آخر نشاط للمستخدم"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?",
-        (user_id,)
-    )
-    conn.commit()
-    conn.close()
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?",
+            (user_id,)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def record_activity(rows):
+    """تحديث آخر نشاط وعدد التفاعلات لعدة مستخدمين في معاملة واحدة
+
+    rows: [(last_active, عدد التفاعلات الجديدة, user_id)]
+    """
+    conn = get_db(write=True)
+    try:
+        conn.executemany(
+            "UPDATE users SET last_active = ?, interactions = COALESCE(interactions, 0) + ? "
+            "WHERE user_id = ?",
+            rows
+        )
+        conn.commit()
+    finally:
+        conn.close()
 
 # ==================== دوال الحجوزات ====================
 
+# رموز نتيجة الحجز
+BOOK_OK = 'ok'
+BOOK_TAKEN = 'taken'
+BOOK_NO_USER = 'no_user'
+BOOK_LIMIT = 'limit'
+BOOK_OUT_OF_RANGE = 'out_of_range'
+BOOK_BUSY = 'busy'
+
+# نتيجة book_day: ok (نجح/فشل)، message (نص للمستخدم)، code (أحد رموز BOOK_*)
+BookingResult = namedtuple('BookingResult', ['ok', 'message', 'code'])
+
 def get_current_month():
     """الحصول على الشهر الحالي بصيغة YYYY-MM"""
-    now = datetime.now()
-    return f"{now.year}-{now.month:02d}"
+    return month_of(datetime.now())
+
+def month_of(date):
+    """الشهر الذي يقع فيه التاريخ بصيغة YYYY-MM"""
+    return f"{date.year}-{date.month:02d}"
 
 def get_month_days():
     """الحصول على عدد أيام الشهر"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM settings WHERE key = 'month_days'")
-    result = cursor.fetchone()
-    conn.close()
-    return int(result['value']) if result else 31
+    value = get_setting('month_days')
+    return int(value) if value else 31
 
 def set_month_days(days):
     """تحديد عدد أيام الشهر"""
-    conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
-        ('month_days', str(days))
-    )
-    conn.commit()
-    conn.close()
+    set_setting('month_days', str(days))
+    bump_data_version()
 
 def get_user_bookings(user_id, month=None):
     """الحصول على حجوزات مستخدم معين"""
@@ -212,10 +645,12 @@ def get_user_bookings(user_id, month=None):
     
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute(
-        "SELECT day FROM bookings WHERE user_id = ? AND month = ? ORDER BY day",
-        (user_id, month)
-    )
+    cursor.execute("""
+        SELECT day FROM bookings WHERE user_id = ? AND month = ?
+        UNION ALL
+        SELECT day FROM bookings_archive WHERE user_id = ? AND month = ? AND superseded = 0
+        ORDER BY 1
+    """, (user_id, month, user_id, month))
     bookings = cursor.fetchall()
     conn.close()
     return bookings
@@ -232,157 +667,636 @@ def get_all_bookings(month=None):
         FROM bookings b
         JOIN users u ON b.user_id = u.user_id
         WHERE b.month = ?
-        ORDER BY b.day
-    """, (month,))
+        UNION ALL
+        SELECT day, user_id, full_name
+        FROM bookings_archive
+        WHERE month = ? AND superseded = 0
+        ORDER BY 1
+    """, (month, month))
     bookings = cursor.fetchall()
     conn.close()
     return bookings
 
+def iter_bookings(start_month, end_month=None, user_id=None, batch_size=500):
+    """مولّد لحجوزات مدى من الأشهر مرتبة بالشهر واليوم، يقرأ على دفعات
+
+    كل صف: month, day, user_id, full_name. الذاكرة المستخدمة بحجم الدفعة فقط.
+    """
+    if end_month is None:
+        end_month = start_month
+    
+    # الحجوزات الحية والمؤرشفة مرتبتان بالفهارس، فيدمجهما SQLite دون فرز (MERGE UNION ALL)
+    user_filter = " AND b.user_id = ?" if user_id is not None else ""
+    archive_filter = " AND user_id = ?" if user_id is not None else ""
+    query = f"""
+        SELECT b.month, b.day, b.user_id, u.full_name
+        FROM bookings b
+        JOIN users u ON b.user_id = u.user_id
+        WHERE b.month BETWEEN ? AND ?{user_filter}
+        UNION ALL
+        SELECT month, day, user_id, full_name
+        FROM bookings_archive
+        WHERE month BETWEEN ? AND ? AND superseded = 0{archive_filter}
+        ORDER BY 1, 2
+    """
+    params = [start_month, end_month]
+    if user_id is not None:
+        params.append(user_id)
+    params = params * 2
+    
+    conn = get_db()
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
 def book_day(user_id, day, month=None):
-    """حجز يوم مع التحقق من جميع الشروط"""
+    """حجز يوم مع التحقق من جميع الشروط داخل معاملة كتابة واحدة"""
     if month is None:
         month = get_current_month()
+    month_days = get_month_days()
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # التحقق من أن اليوم غير محجوز
-    cursor.execute(
-        "SELECT * FROM bookings WHERE day = ? AND month = ?",
-        (day, month)
-    )
-    if cursor.fetchone():
-        conn.close()
-        return False, "❌ اليوم محجوز مسبقاً"
+    conn = get_db(write=True)
+    try:
+        # BEGIN IMMEDIATE يحجز قفل الكتابة قبل الفحص، فلا يتغير شيء بين الفحص والإدراج
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("""
+            SELECT
+                EXISTS(SELECT 1 FROM bookings WHERE day = ? AND month = ?) AS taken,
+                (SELECT max_days FROM users WHERE user_id = ?) AS max_days,
+                (SELECT COUNT(*) FROM bookings WHERE user_id = ? AND month = ?) AS booked
+        """, (day, month, user_id, user_id, month)).fetchone()
+        
+        if row['taken']:
+            return BookingResult(False, "❌ اليوم محجوز مسبقاً", BOOK_TAKEN)
+        if row['max_days'] is None:
+            return BookingResult(False, "❌ المستخدم غير موجود", BOOK_NO_USER)
+        if row['booked'] >= row['max_days']:
+            return BookingResult(
+                False, f"❌ لقد وصلت للحد الأقصى ({row['max_days']} أيام)", BOOK_LIMIT
+            )
+        if not 1 <= day <= month_days:
+            return BookingResult(
+                False,
+                f"❌ اليوم {day} خارج نطاق أيام الشهر ({month_days} يوم)",
+                BOOK_OUT_OF_RANGE
+            )
+        
+        conn.execute(
+            "INSERT INTO bookings (day, user_id, month) VALUES (?, ?, ?)",
+            (day, user_id, month)
+        )
+        conn.commit()
+        bump_data_version()
+        return BookingResult(True, "✅ تم الحجز بنجاح", BOOK_OK)
     
-    # التحقق من عدد أيام المستخدم
-    user = get_user(user_id)
-    if not user:
+    except sqlite3.IntegrityError:
+        # حجز متزامن من عملية أخرى سبقنا إلى نفس اليوم
+        return BookingResult(False, "❌ اليوم محجوز مسبقاً", BOOK_TAKEN)
+    except sqlite3.OperationalError as e:
+        if 'locked' not in str(e) and 'busy' not in str(e):
+            raise
+        return BookingResult(False, "⏳ الضغط عالٍ حالياً، حاول مرة أخرى", BOOK_BUSY)
+    finally:
+        # close() يتراجع عن أي معاملة لم تُثبَّت ويعيد الاتصال للمجمع
         conn.close()
-        return False, "❌ المستخدم غير موجود"
-    
-    user_bookings = cursor.execute(
-        "SELECT COUNT(*) as count FROM bookings WHERE user_id = ? AND month = ?",
-        (user_id, month)
-    ).fetchone()['count']
+
+def cancel_booking(day, month=None, user_id=None):
+    """إلغاء حجز يوم"""
+    if month is None:
+        month = get_current_month()
     
-    if user_bookings >= user['max_days']:
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+
+        if user_id:
+            cursor.execute(
+                "DELETE FROM bookings WHERE day = ? AND month = ? AND user_id = ?",
+                (day, month, user_id)
+            )
+        else:
+            cursor.execute(
+                "DELETE FROM bookings WHERE day = ? AND month = ?",
+                (day, month)
+            )
+
+        conn.commit()
+    finally:
         conn.close()
-        return False, f"❌ لقد وصلت للحد الأقصى ({user['max_days']} أيام)"
+    bump_data_version()
+    return True
+
+def reset_month(month=None):
+    """تصفير الشهر بالكامل (الحجوزات تُنقل إلى الأرشيف ولا تُحذف)"""
+    return archive_month(month, superseded=True)
+
+# ==================== الأرشيف ====================
+
+# طلبات الانتظار الأقدم من هذا العدد من الأيام تُحذف عند الأرشفة
+PENDING_RETENTION_DAYS = 30
+
+def archive_month(month=None, superseded=False):
+    """نقل حجوزات شهر إلى الأرشيف في معاملة واحدة - يعيد عدد الحجوزات المنقولة
+
+    superseded=True عند تصفير شهر: تُحفظ الحجوزات للرجوع لكن لا تظهر في الاستعلامات.
+    """
+    if month is None:
+        month = get_current_month()
     
-    # التحقق من أن اليوم ضمن أيام الشهر
-    month_days = get_month_days()
-    if day > month_days:
+    conn = get_db(write=True)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        cursor = conn.execute("""
+            INSERT INTO bookings_archive (id, day, user_id, month, full_name, booked_date, superseded)
+            SELECT b.id, b.day, b.user_id, b.month, u.full_name, b.booked_date, ?
+            FROM bookings b
+            LEFT JOIN users u ON b.user_id = u.user_id
+            WHERE b.month = ?
+        """, (1 if superseded else 0, month))
+        archived = cursor.rowcount
+        conn.execute("DELETE FROM bookings WHERE month = ?", (month,))
+        conn.execute(
+            "DELETE FROM pending_approvals WHERE request_date < datetime('now', ?)",
+            (f"-{PENDING_RETENTION_DAYS} days",)
+        )
+        conn.commit()
+        
+        # إرجاع الصفحات الفارغة للنظام تدريجياً (خارج المعاملة)
+        conn.execute("PRAGMA incremental_vacuum").fetchall()
+    finally:
         conn.close()
-        return False, f"❌ اليوم {day} خارج نطاق أيام الشهر ({month_days} يوم)"
     
-    # حجز اليوم
+    bump_data_version()
+    return archived
+
+def archive_closed_months():
+    """أرشفة كل الأشهر السابقة للشهر الحالي - يعيد عدد الحجوزات المنقولة"""
+    conn = get_db()
+    cursor = conn.cursor()
     cursor.execute(
-        "INSERT INTO bookings (day, user_id, month) VALUES (?, ?, ?)",
-        (day, user_id, month)
+        "SELECT DISTINCT month FROM bookings WHERE month < ?",
+        (get_current_month(),)
     )
-    
-    conn.commit()
+    months = [row['month'] for row in cursor.fetchall()]
     conn.close()
-    return True, "✅ تم الحجز بنجاح"
+    return sum(archive_month(month) for month in months)
 
-def cancel_booking(day, month=None, user_id=None):
-    """إلغاء حجز يوم"""
+# ==================== رغبات الحجز ====================
+
+# أقصى عدد أيام في قائمة رغبات الطبيب الواحد
+MAX_PREFERENCES = 10
+
+def get_preferences(user_id, month=None):
+    """أيام رغبات المستخدم مرتبة من الأفضل"""
     if month is None:
         month = get_current_month()
-    
+
     conn = get_db()
     cursor = conn.cursor()
-    
-    if user_id:
-        cursor.execute(
-            "DELETE FROM bookings WHERE day = ? AND month = ? AND user_id = ?",
-            (day, month, user_id)
+    cursor.execute(
+        "SELECT day FROM booking_preferences WHERE month = ? AND user_id = ? ORDER BY rank",
+        (month, user_id)
+    )
+    days = [row['day'] for row in cursor.fetchall()]
+    conn.close()
+    return days
+
+def toggle_preference(user_id, day, month=None):
+    """إضافة يوم لآخر قائمة رغبات المستخدم، أو إزالته منها إذا كان فيها"""
+    if month is None:
+        month = get_current_month()
+    month_days = get_month_days()
+
+    conn = get_db(write=True)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        days = [
+            row['day'] for row in conn.execute(
+                "SELECT day FROM booking_preferences WHERE month = ? AND user_id = ? ORDER BY rank",
+                (month, user_id)
+            ).fetchall()
+        ]
+
+        if day in days:
+            days.remove(day)
+            result = BookingResult(True, f"🗑 أُزيل يوم {day} من رغباتك", BOOK_OK)
+        elif not 1 <= day <= month_days:
+            return BookingResult(
+                False,
+                f"❌ اليوم {day} خارج نطاق أيام الشهر ({month_days} يوم)",
+                BOOK_OUT_OF_RANGE
+            )
+        elif len(days) >= MAX_PREFERENCES:
+            return BookingResult(
+                False, f"❌ لقد وصلت للحد الأقصى للرغبات ({MAX_PREFERENCES} أيام)", BOOK_LIMIT
+            )
+        else:
+            days.append(day)
+            result = BookingResult(True, f"✅ أُضيف يوم {day} برغبة رقم {len(days)}", BOOK_OK)
+
+        # إعادة كتابة القائمة كاملة (بضعة صفوف) تبقي الترتيب متصلاً بعد الإزالة
+        conn.execute(
+            "DELETE FROM booking_preferences WHERE month = ? AND user_id = ?",
+            (month, user_id)
         )
-    else:
-        cursor.execute(
-            "DELETE FROM bookings WHERE day = ? AND month = ?",
-            (day, month)
+        conn.executemany(
+            "INSERT INTO booking_preferences (user_id, month, day, rank) VALUES (?, ?, ?, ?)",
+            [(user_id, month, d, rank) for rank, d in enumerate(days, 1)]
         )
-    
-    conn.commit()
-    conn.close()
-    return True
+        conn.commit()
+        return result
+    finally:
+        conn.close()
 
-def reset_month(month=None):
-    """تصفير الشهر بالكامل"""
+def clear_preferences(user_id, month=None):
+    """حذف كل رغبات المستخدم للشهر"""
     if month is None:
         month = get_current_month()
-    
+
+    conn = get_db(write=True)
+    try:
+        conn.execute(
+            "DELETE FROM booking_preferences WHERE month = ? AND user_id = ?",
+            (month, user_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def count_preferences(month=None):
+    """عدد الأطباء الذين أرسلوا رغباتهم وعدد الرغبات للشهر"""
+    if month is None:
+        month = get_current_month()
+
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM bookings WHERE month = ?", (month,))
-    conn.commit()
+    # التجميع بترتيب الفهرس (month, user_id) بدلاً من COUNT(DISTINCT) وجدوله المؤقت
+    row = conn.execute("""
+        SELECT COUNT(*) AS doctors, COALESCE(SUM(wishes), 0) AS preferences
+        FROM (SELECT COUNT(*) AS wishes FROM booking_preferences WHERE month = ? GROUP BY user_id)
+    """, (month,)).fetchone()
     conn.close()
+    return row
+
+def allocate_preferences(month=None):
+    """توزيع أيام الشهر حسب الرغبات في معاملة كتابة واحدة - يعيد allocation.Allocation
+
+    الحجوزات تُدرج دفعة واحدة وتُحذف رغبات الشهر في نفس المعاملة، فإعادة
+    الاستدعاء (مثلاً بعد توقف البوت أثناء مؤقت الغلق) لا توزع شيئاً مرتين.
+    """
+    if month is None:
+        month = get_current_month()
+    month_days = get_month_days()
+
+    conn = get_db(write=True)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        preferences = {}
+        max_days = {}
+        for row in conn.execute("""
+            SELECT p.user_id, p.day, u.max_days
+            FROM booking_preferences p
+            JOIN users u ON p.user_id = u.user_id
+            WHERE p.month = ? AND u.approved = 1
+            ORDER BY p.user_id, p.rank
+        """, (month,)).fetchall():
+            preferences.setdefault(row['user_id'], []).append(row['day'])
+            max_days[row['user_id']] = row['max_days']
+
+        # الحجوزات الموجودة (من المشرف أو قبل تغيير النمط) تُحترم وتُحسب من الحد
+        taken = set()
+        quotas = dict(max_days)
+        for row in conn.execute(
+            "SELECT day, user_id FROM bookings WHERE month = ?", (month,)
+        ).fetchall():
+            taken.add(row['day'])
+            if row['user_id'] in quotas:
+                quotas[row['user_id']] -= 1
+
+        result = allocation.allocate(preferences, quotas, taken, month_days, seed=month)
+        conn.executemany(
+            "INSERT INTO bookings (day, user_id, month) VALUES (?, ?, ?)",
+            [
+                (day, user_id, month)
+                for user_id, days in result.assignments.items()
+                for day in days
+            ]
+        )
+        conn.execute("DELETE FROM booking_preferences WHERE month = ?", (month,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    if result.assignments:
+        bump_data_version()
+    return result
 
 # ==================== دوال الإعدادات ====================
 
+# نسخة من جدول settings في الذاكرة لكل قاعدة: {المسار: {key: value}}
+# تُحمَّل مرة واحدة وتُحدَّث مع كل كتابة (write-through)
+_settings_cache = {}
+_settings_lock = threading.Lock()
+
+# PRAGMA data_version لاتصال الكتابة عند آخر تحميل؛ يتغير فقط إذا كتبت عملية أخرى
+_settings_data_version = {}
+
+def reload_settings(only_if_changed=False):
+    """إعادة تحميل الإعدادات من القاعدة (مثلاً بعد تعديلها من عملية أخرى)"""
+    path = get_db_name()
+    # القراءة عبر اتصال الكتابة تضمن ألا تتداخل مع set_setting
+    conn = get_db(write=True)
+    try:
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if only_if_changed and path in _settings_cache and \
+                _settings_data_version.get(path) == version:
+            return _settings_cache[path]
+        rows = conn.execute("SELECT key, value FROM settings").fetchall()
+        settings = {row['key']: row['value'] for row in rows}
+        with _settings_lock:
+            changed = _settings_data_version.get(path) not in (None, version)
+            _settings_cache[path] = settings
+            _settings_data_version[path] = version
+        if changed:
+            # عملية أخرى كتبت في القاعدة - الرسائل والمستخدمون المحفوظون قد يكونون قدماء
+            invalidate_user()
+            bump_data_version()
+        return settings
+    finally:
+        conn.close()
+
+def get_setting(key, default=None):
+    """قراءة إعداد من الذاكرة (تحميل الجدول كاملاً عند أول استخدام)"""
+    settings = _settings_cache.get(get_db_name())
+    if settings is None:
+        settings = reload_settings()
+    return settings.get(key, default)
+
+def set_setting(key, value):
+    """حفظ إعداد في القاعدة وتحديث الذاكرة مباشرة"""
+    path = get_db_name()
+    conn = get_db(write=True)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+            (key, value)
+        )
+        conn.commit()
+        with _settings_lock:
+            if path in _settings_cache:
+                _settings_cache[path] = {**_settings_cache[path], key: value}
+    finally:
+        conn.close()
+
 def is_booking_open():
     """التحقق إذا كان الحجز مفتوحاً"""
+    return get_setting('booking_open') == '1'
+
+def set_booking_open(status):
+    """فتح أو غلق الحجز"""
+    set_setting('booking_open', '1' if status else '0')
+
+def set_scheduled_booking_time(datetime_str):
+    """حفظ وقت فتح الحجز المجدول"""
+    set_setting('scheduled_booking_time', datetime_str)
+
+def get_scheduled_booking_time():
+    """الحصول على وقت فتح الحجز المجدول"""
+    return get_setting('scheduled_booking_time')
+
+# أنماط الحجز: الأسبق يحجز (أزرار الأيام)، أو رغبات مرتبة توزَّع عند الغلق
+BOOKING_MODE_FIRST_COME = 'first_come'
+BOOKING_MODE_PREFERENCES = 'preferences'
+
+def get_booking_mode():
+    """نمط الحجز الحالي"""
+    return get_setting('booking_mode', BOOKING_MODE_FIRST_COME)
+
+def set_booking_mode(mode):
+    """تغيير نمط الحجز"""
+    if mode not in (BOOKING_MODE_FIRST_COME, BOOKING_MODE_PREFERENCES):
+        raise ValueError(f"نمط حجز غير معروف: {mode}")
+    set_setting('booking_mode', mode)
+
+# ==================== دوال المؤقتات ====================
+
+def get_timers():
+    """جميع المؤقتات المحفوظة"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT value FROM settings WHERE key = 'booking_open'")
-    result = cursor.fetchone()
+    cursor.execute("SELECT * FROM timers ORDER BY run_at")
+    timers = cursor.fetchall()
     conn.close()
-    return result and result['value'] == '1'
+    return timers
 
-def set_booking_open(status):
-    """فتح أو غلق الحجز"""
+def save_timer(name, action, run_at, payload=None):
+    """حفظ مؤقت (يستبدل المؤقت السابق بنفس الاسم)"""
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO timers (name, action, run_at, payload) VALUES (?, ?, ?, ?)",
+            (name, action, run_at, payload)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def delete_timer(name):
+    """حذف مؤقت"""
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM timers WHERE name = ?", (name,))
+        conn.commit()
+    finally:
+        conn.close()
+
+# ==================== دوال المهام الخلفية ====================
+
+# حالات المهمة
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+JOB_INTERRUPTED = 'interrupted'
+
+def create_job(kind, title, params=None, created_by=None):
+    """تسجيل مهمة جديدة في الطابور - يعيد رقمها"""
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO jobs (kind, title, params, created_by) VALUES (?, ?, ?, ?)",
+            (kind, title, params, created_by)
+        )
+        job_id = cursor.lastrowid
+        conn.commit()
+    finally:
+        conn.close()
+    return job_id
+
+def start_job(job_id):
+    conn = get_db(write=True)
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, started_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (JOB_RUNNING, job_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def update_job_progress(job_id, progress, total):
+    conn = get_db(write=True)
+    try:
+        conn.execute(
+            "UPDATE jobs SET progress = ?, total = ? WHERE id = ?",
+            (progress, total, job_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def finish_job(job_id, status, result=None, error=None):
+    """تسجيل نهاية المهمة (done / failed / cancelled)"""
+    conn = get_db(write=True)
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = CURRENT_TIMESTAMP "
+            "WHERE id = ?",
+            (status, result, error, job_id)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_job(job_id):
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
-        ('booking_open', '1' if status else '0')
-    )
-    conn.commit()
+    cursor.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    job = cursor.fetchone()
     conn.close()
+    return job
 
-def set_scheduled_booking_time(datetime_str):
-    """حفظ وقت فتح الحجز المجدول"""
+def get_recent_jobs(limit=10):
+    """آخر المهام (الأحدث أولاً)"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
-        ('scheduled_booking_time', datetime_str)
-    )
-    conn.commit()
+    cursor.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+    jobs = cursor.fetchall()
     conn.close()
+    return jobs
 
-def get_scheduled_booking_time():
-    """الحصول على وقت فتح الحجز المجدول"""
+def mark_interrupted_jobs():
+    """المهام التي كانت في الطابور أو قيد التنفيذ عند توقف البوت - يعيد عددها"""
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE status IN (?, ?)",
+            (JOB_INTERRUPTED, JOB_QUEUED, JOB_RUNNING)
+        )
+        count = cursor.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    return count
+
+# ==================== دوال حالة المحادثة ====================
+
+def get_user_state(user_id):
+    """حالة المحادثة المحفوظة للمستخدم (نص JSON) أو None"""
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT value FROM settings WHERE key = 'scheduled_booking_time'")
-    result = cursor.fetchone()
+    cursor.execute("SELECT data FROM user_state WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
     conn.close()
-    return result['value'] if result else None
+    return row['data'] if row else None
+
+def save_user_states(states):
+    """حفظ حالات عدة مستخدمين في معاملة واحدة: [(user_id, JSON أو None للحذف)]"""
+    upserts = [(user_id, data) for user_id, data in states if data is not None]
+    deletes = [(user_id,) for user_id, data in states if data is None]
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO user_state (user_id, data) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP",
+            upserts
+        )
+        cursor.executemany("DELETE FROM user_state WHERE user_id = ?", deletes)
+        conn.commit()
+    finally:
+        conn.close()
 
 # ==================== دوال الإحصائيات ====================
 
+def get_roster_summary(month=None):
+    """الأطباء المعتمدون مع حجوزاتهم في الشهر - استعلام واحد مهما كان العدد
+
+    كل عنصر: user_id, full_name, max_days, booked_count, booked_days (قائمة مرتبة)
+    """
+    if month is None:
+        month = get_current_month()
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT u.user_id, u.full_name, u.max_days,
+               (SELECT GROUP_CONCAT(day) FROM (
+                    SELECT day FROM bookings
+                    WHERE user_id = u.user_id AND month = ?
+                    UNION ALL
+                    SELECT day FROM bookings_archive
+                    WHERE user_id = u.user_id AND month = ? AND superseded = 0
+                    ORDER BY 1
+               )) AS booked_days
+        FROM users u
+        WHERE u.approved = 1
+        ORDER BY u.full_name
+    """, (month, month))
+    rows = cursor.fetchall()
+    conn.close()
+    
+    roster = []
+    for row in rows:
+        days = [int(d) for d in row['booked_days'].split(',')] if row['booked_days'] else []
+        roster.append({
+            'user_id': row['user_id'],
+            'full_name': row['full_name'],
+            'max_days': row['max_days'],
+            'booked_count': len(days),
+            'booked_days': days,
+        })
+    return roster
+
 def get_month_statistics():
     """إحصائيات سريعة للشهر"""
     month = get_current_month()
     month_days = get_month_days()
-    bookings = get_all_bookings(month)
-    users = get_approved_users()
+    roster = get_roster_summary(month)
+    booked = sum(doctor['booked_count'] for doctor in roster)
     
     return {
         'month': month,
         'month_days': month_days,
-        'booked_days': len(bookings),
-        'free_days': month_days - len(bookings),
-        'total_doctors': len(users)
+        'booked_days': booked,
+        'free_days': month_days - booked,
+        'total_doctors': len(roster)
     }
 
 def get_tomorrow_bookings():
     """الحصول على حجوزات الغد"""
-    month = get_current_month()
-    tomorrow = (datetime.now() + timedelta(days=1)).day
+    # الغد قد يقع في الشهر التالي (مثلاً من 31 إلى 1)
+    tomorrow = datetime.now() + timedelta(days=1)
     
     conn = get_db()
     cursor = conn.cursor()
@@ -391,7 +1305,7 @@ def get_tomorrow_bookings():
         FROM bookings b
         JOIN users u ON b.user_id = u.user_id
         WHERE b.month = ? AND b.day = ? AND b.reminder_sent_24h = 0
-    """, (month, tomorrow))
+    """, (month_of(tomorrow), tomorrow.day))
     bookings = cursor.fetchall()
     conn.close()
     return bookings
@@ -413,22 +1327,73 @@ def get_today_bookings():
     conn.close()
     return bookings
 
-def mark_reminder_sent(booking_id, reminder_type):
-    """تحديث حالة إرسال التذكير"""
+def get_due_reminders(today=None):
+    """جميع التذكيرات غير المرسلة لليوم والغد في استعلام واحد
+
+    كل صف يحتوي id, day, month, user_id, full_name و kind ('same_day' أو '24h')
+    """
+    if today is None:
+        today = datetime.now().date()
+    tomorrow = today + timedelta(days=1)
+    
     conn = get_db()
     cursor = conn.cursor()
-    if reminder_type == '24h':
-        cursor.execute(
-            "UPDATE bookings SET reminder_sent_24h = 1 WHERE id = ?",
-            (booking_id,)
-        )
-    elif reminder_type == 'same_day':
-        cursor.execute(
-            "UPDATE bookings SET reminder_sent_same_day = 1 WHERE id = ?",
-            (booking_id,)
-        )
-    conn.commit()
+    cursor.execute("""
+        SELECT b.id, b.day, b.month, b.user_id, u.full_name,
+               CASE WHEN b.month = ? AND b.day = ? THEN 'same_day' ELSE '24h' END AS kind
+        FROM bookings b
+        JOIN users u ON b.user_id = u.user_id
+        WHERE (b.month = ? AND b.day = ? AND b.reminder_sent_same_day = 0)
+           OR (b.month = ? AND b.day = ? AND b.reminder_sent_24h = 0)
+    """, (
+        month_of(today), today.day,
+        month_of(today), today.day,
+        month_of(tomorrow), tomorrow.day,
+    ))
+    reminders = cursor.fetchall()
     conn.close()
+    return reminders
+
+# حد المتغيرات في استعلام واحد (SQLITE_MAX_VARIABLE_NUMBER في النسخ القديمة 999)
+_MAX_SQL_VARIABLES = 900
+
+def mark_reminders_sent(reminders):
+    """تعليم عدة تذكيرات من النوعين كمرسلة بجملة UPDATE واحدة
+
+    reminders: [(booking_id, '24h' أو 'same_day')]
+    """
+    ids = {'24h': [], 'same_day': []}
+    for booking_id, reminder_type in reminders:
+        if reminder_type in ids:
+            ids[reminder_type].append(booking_id)
+    pairs = [(booking_id, kind) for kind, booking_ids in ids.items() for booking_id in booking_ids]
+    if not pairs:
+        return
+    
+    conn = get_db(write=True)
+    try:
+        cursor = conn.cursor()
+        # كل معرّف يُربط مرتين: في قائمة نوعه وفي WHERE
+        step = _MAX_SQL_VARIABLES // 2
+        for i in range(0, len(pairs), step):
+            chunk = pairs[i:i + step]
+            day_ids = [booking_id for booking_id, kind in chunk if kind == '24h']
+            same_day_ids = [booking_id for booking_id, kind in chunk if kind == 'same_day']
+            cursor.execute(f"""
+                UPDATE bookings SET
+                    reminder_sent_24h = CASE WHEN id IN ({','.join('?' * len(day_ids))})
+                        THEN 1 ELSE reminder_sent_24h END,
+                    reminder_sent_same_day = CASE WHEN id IN ({','.join('?' * len(same_day_ids))})
+                        THEN 1 ELSE reminder_sent_same_day END
+                WHERE id IN ({','.join('?' * len(chunk))})
+            """, day_ids + same_day_ids + [booking_id for booking_id, kind in chunk])
+        conn.commit()
+    finally:
+        conn.close()
+
+def mark_reminder_sent(booking_id, reminder_type):
+    """تحديث حالة إرسال التذكير"""
+    mark_reminders_sent([(booking_id, reminder_type)])
 
 # تهيئة قاعدة البيانات
 init_db()
\ No newline at end of file
@@ -0,0 +1,168 @@
+# export.py - تصدير الحجوزات بصيغ CSV و JSON Lines و iCalendar
+#
+# الصفوف تُقرأ من استعلام واحد على دفعات (db.iter_bookings) وتُكتب مباشرة إلى
+# ملف مؤقت (SpooledTemporaryFile) يبقى في الذاكرة حتى حجم معين ثم ينتقل للقرص،
+# فلا يتجاوز استهلاك الذاكرة حجم الدفعة مهما طال التاريخ المُصدَّر.
+# الدوال هنا متزامنة - تُستدعى من المعالجات عبر adb.run حتى لا تعطل حلقة الأحداث.
+
+import calendar
+import csv
+import io
+import json
+import tempfile
+from datetime import date, datetime, timedelta, timezone
+
+import db
+
+# عدد الصفوف المقروءة من القاعدة في كل دفعة
+BATCH_SIZE = 500
+
+# حجم الملف المؤقت في الذاكرة قبل نقله إلى القرص (بالبايت)
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def shift_month(month, delta):
+    """إزاحة شهر بصيغة YYYY-MM بعدد من الأشهر"""
+    year, month_num = map(int, month.split('-'))
+    index = year * 12 + (month_num - 1) + delta
+    return f"{index // 12}-{index % 12 + 1:02d}"
+
+def iter_months(start_month, end_month):
+    month = start_month
+    while month <= end_month:
+        yield month
+        month = shift_month(month, 1)
+
+def days_in_month(month):
+    """عدد أيام الشهر (الشهر الحالي حسب إعداد المشرف، والبقية حسب التقويم)"""
+    if month == db.get_current_month():
+        return db.get_month_days()
+    year, month_num = map(int, month.split('-'))
+    return calendar.monthrange(year, month_num)[1]
+
+# ==================== CSV ====================
+
+def write_csv(out, rows, start_month, end_month):
+    """جدول كل أيام المدى (المحجوز باسم الطبيب والباقي متاح)"""
+    writer = csv.writer(out)
+    writer.writerow(['الشهر', 'اليوم', 'التاريخ', 'الطبيب'])
+
+    rows = iter(rows)
+    row = next(rows, None)
+    for month in iter_months(start_month, end_month):
+        for day in range(1, days_in_month(month) + 1):
+            doctor = 'متاح'
+            # الصفوف مرتبة بالشهر واليوم، فنتقدم فيها مع الأيام
+            while row is not None and (row['month'], row['day']) < (month, day):
+                row = next(rows, None)
+            if row is not None and (row['month'], row['day']) == (month, day):
+                doctor = row['full_name']
+            writer.writerow([month, day, f"{month}-{day:02d}", doctor])
+
+    # ملخص الأطباء عند تصدير شهر واحد
+    if start_month == end_month:
+        writer.writerow([])
+        writer.writerow(['الطبيب', 'المحجوز', 'الحد الأقصى', 'الأيام'])
+        for doctor in db.get_roster_summary(start_month):
+            writer.writerow([
+                doctor['full_name'],
+                doctor['booked_count'],
+                doctor['max_days'],
+                ' '.join(map(str, doctor['booked_days']))
+            ])
+
+# ==================== JSON Lines ====================
+
+def write_jsonl(out, rows, start_month, end_month):
+    """كائن JSON لكل حجز في سطر مستقل"""
+    for row in rows:
+        out.write(json.dumps({
+            'month': row['month'],
+            'day': row['day'],
+            'date': f"{row['month']}-{row['day']:02d}",
+            'user_id': row['user_id'],
+            'doctor': row['full_name'],
+        }, ensure_ascii=False))
+        out.write('\n')
+
+# ==================== iCalendar ====================
+
+def _ics_escape(text):
+    return (
+        text.replace('\\', '\\\\').replace(';', '\\;')
+        .replace(',', '\\,').replace('\n', '\\n')
+    )
+
+# أقصى طول لسطر في ملف التقويم بالبايت دون فاصل السطر (RFC 5545 §3.1)
+ICS_LINE_OCTETS = 75
+
+def _ics_fold(text):
+    """طي السطر الطويل: أسطر تالية تبدأ بمسافة، دون قطع حرف متعدد البايتات"""
+    parts = []
+    limit = ICS_LINE_OCTETS
+    size = 0
+    start = 0
+    for i, char in enumerate(text):
+        width = len(char.encode('utf-8'))
+        if size + width > limit:
+            parts.append(text[start:i])
+            start = i
+            # المسافة في بداية السطر التالي من ضمن الحد
+            limit = ICS_LINE_OCTETS - 1
+            size = 0
+        size += width
+    parts.append(text[start:])
+    return '\r\n '.join(parts)
+
+def write_ics(out, rows, start_month, end_month):
+    """تقويم فيه حدث يوم كامل لكل مناوبة (RFC 5545)"""
+    def line(text):
+        out.write(_ics_fold(text) + '\r\n')
+
+    # DTSTAMP وقت إنشاء الملف بتوقيت UTC
+    stamp = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}"
+
+    line('BEGIN:VCALENDAR')
+    line('VERSION:2.0')
+    line('PRODID:-//duty-bot//mandoobat//AR')
+    line('CALSCALE:GREGORIAN')
+    for row in rows:
+        year, month_num = map(int, row['month'].split('-'))
+        try:
+            start = date(year, month_num, row['day'])
+        except ValueError:
+            continue
+        line('BEGIN:VEVENT')
+        line(f"UID:{row['month']}-{row['day']:02d}-{row['user_id']}@duty-bot")
+        line(f"DTSTAMP:{stamp}")
+        line(f"DTSTART;VALUE=DATE:{start:%Y%m%d}")
+        line(f"DTEND;VALUE=DATE:{start + timedelta(days=1):%Y%m%d}")
+        line(f"SUMMARY:{_ics_escape('مناوبة - د.' + row['full_name'])}")
+        line('END:VEVENT')
+    line('END:VCALENDAR')
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'ics': write_ics}
+
+# ==================== التصدير ====================
+
+def export_bookings(fmt, start_month, end_month=None, user_id=None, batch_size=BATCH_SIZE):
+    """تصدير الحجوزات إلى ملف مؤقت مفتوح على بدايته - يعيد (الملف، اسم الملف)"""
+    if fmt not in WRITERS:
+        raise ValueError(f"صيغة غير مدعومة: {fmt}")
+    if end_month is None:
+        end_month = start_month
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+b')
+    out = io.TextIOWrapper(spooled, encoding='utf-8', newline='')
+    rows = db.iter_bookings(start_month, end_month, user_id, batch_size)
+    try:
+        WRITERS[fmt](out, rows, start_month, end_month)
+    finally:
+        rows.close()
+    out.flush()
+    out.detach()
+    spooled.seek(0)
+
+    period = start_month if start_month == end_month else f"{start_month}_{end_month}"
+    owner = f"_{user_id}" if user_id is not None else ""
+    return spooled, f"mandoobat{owner}_{period}.{fmt}"
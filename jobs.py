@@ -0,0 +1,122 @@
+# jobs.py - المهام الخلفية الطويلة (الإرسال الجماعي، التصدير) مع حفظ حالتها
+#
+# المعالج يسجّل المهمة ويعود فوراً؛ المهمة تعمل على حلقة الأحداث بحد أقصى من
+# المهام المتزامنة، وتُحفظ حالتها وتقدمها ونتيجتها في جدول jobs. يمكن إلغاء
+# المهمة وهي في الطابور أو أثناء التنفيذ، والمهام التي قطعها توقف البوت تُعلَّم
+# "متوقفة" عند البدء التالي (db.mark_interrupted_jobs).
+
+import asyncio
+import json
+import logging
+import time
+
+import adb
+import db
+
+logger = logging.getLogger(__name__)
+
+# عدد المهام التي تعمل في نفس الوقت (البقية تنتظر في الطابور)
+MAX_CONCURRENT_JOBS = 2
+
+# أقل فاصل بين حفظ التقدم في القاعدة (بالثواني)
+PROGRESS_INTERVAL = 2.0
+
+
+class Job:
+    """مهمة قيد التنفيذ كما يراها الإجراء المسجَّل"""
+
+    def __init__(self, job_id, kind, title, params, created_by):
+        self.id = job_id
+        self.kind = kind
+        self.title = title
+        self.params = params
+        self.created_by = created_by
+        self.cancelled = False
+        self._on_cancel = []
+        self._last_saved = 0.0
+
+    def on_cancel(self, callback):
+        """دالة تُستدعى عند الإلغاء (لإيقاف عمل جارٍ بشكل نظيف)"""
+        self._on_cancel.append(callback)
+
+    def cancel(self):
+        if self.cancelled:
+            return
+        self.cancelled = True
+        for callback in self._on_cancel:
+            callback()
+
+    async def progress(self, done, total, force=False):
+        """حفظ التقدم في القاعدة (مرة كل PROGRESS_INTERVAL على الأكثر)"""
+        now = time.monotonic()
+        if not force and now - self._last_saved < PROGRESS_INTERVAL:
+            return
+        self._last_saved = now
+        await adb.update_job_progress(self.id, done, total)
+
+
+class JobRunner:
+    """تشغيل المهام بحد أقصى من التزامن مع حفظ حالتها في sqlite"""
+
+    def __init__(self, app, max_concurrent=MAX_CONCURRENT_JOBS):
+        self.app = app
+        self._actions = {}
+        self._running = asyncio.Semaphore(max_concurrent)
+        self._jobs = {}
+        self._tasks = {}
+
+    def register(self, kind, callback):
+        """تسجيل نوع مهمة: callback(app, job) دالة async تعيد نص النتيجة"""
+        self._actions[kind] = callback
+
+    async def submit(self, kind, title, params=None, created_by=None):
+        """إضافة مهمة للطابور - يعيد رقمها فوراً"""
+        if kind not in self._actions:
+            raise ValueError(f"نوع مهمة غير معروف: {kind}")
+        job_id = await adb.create_job(
+            kind, title, json.dumps(params, ensure_ascii=False) if params is not None else None,
+            created_by
+        )
+        job = Job(job_id, kind, title, params or {}, created_by)
+        self._jobs[job_id] = job
+        # ليست app.create_task: app.stop() ينتظر تلك المهام حتى تنتهي فيتأخر الإيقاف
+        self._tasks[job_id] = asyncio.create_task(self._run(job))
+        return job_id
+
+    def cancel(self, job_id):
+        """إلغاء مهمة في الطابور أو قيد التنفيذ - يعيد False إذا انتهت أو لم توجد"""
+        job = self._jobs.get(job_id)
+        if job is None or job.cancelled:
+            return False
+        job.cancel()
+        return True
+
+    def active(self):
+        """المهام الحالية (في الطابور أو قيد التنفيذ): {الرقم: Job}"""
+        return dict(self._jobs)
+
+    async def stop(self):
+        """قطع كل المهام عند إيقاف البوت - حالتها تبقى في القاعدة فتُعلَّم متوقفة عند البدء التالي"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job):
+        try:
+            async with self._running:
+                if job.cancelled:
+                    await adb.finish_job(job.id, db.JOB_CANCELLED)
+                    return
+                await adb.start_job(job.id)
+                try:
+                    result = await self._actions[job.kind](self.app, job)
+                except Exception as e:
+                    logger.exception("فشلت المهمة #%s (%s)", job.id, job.kind)
+                    await adb.finish_job(job.id, db.JOB_FAILED, error=str(e))
+                    return
+                status = db.JOB_CANCELLED if job.cancelled else db.JOB_DONE
+                await adb.finish_job(job.id, status, result=result)
+        finally:
+            self._jobs.pop(job.id, None)
+            self._tasks.pop(job.id, None)
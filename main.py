@@ -1,36 +1,68 @@
 # main.py - البوت المتكامل لإدارة المناوبات (نسخة نهائية سريعة)
 
+import asyncio
 import logging
-import logging
-import os
+import signal
 from datetime import datetime, timedelta
-import threading
-import csv
-from io import StringIO
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, filters, ContextTypes
 
-from config import ADMIN_ID
+import config
+import activity
+import adb
+import broadcast
+import export
+import jobs
+import metrics
+import persistence
+import querytrace
+import reminders
+import render_cache
+import routing
+import tenants
+import timers
+import update_processor
 import db
 
-# قراءة توكن البوت من متغير البيئة
-TOKEN = os.getenv("TOKEN")
-
 # إعداد التسجيل
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.WARNING  # تقليل التسريع
+    level=getattr(logging, config.LOG_LEVEL.upper(), logging.WARNING)  # WARNING افتراضياً لتقليل التسريع
 )
 logger = logging.getLogger(__name__)
 
-# متغيرات عامة للتذكيرات
-reminder_timers = []
+# فترة التحقق من تعديل الإعدادات من عملية أخرى (بالثواني)
+SETTINGS_REFRESH_SECONDS = 60
+
+# عدد المهام المعروضة في شاشة المهام
+JOBS_VIEW_LIMIT = 10
+
+# عدد العناصر في كل قائمة من ملخص الأداء
+METRICS_VIEW_TOP = 5
+
+# أقصى طول لرسالة تيليجرام (4096) مع هامش
+MAX_MESSAGE_LENGTH = 4000
+
+BOOKING_MODE_LABELS = {
+    db.BOOKING_MODE_FIRST_COME: "الأسبق يحجز",
+    db.BOOKING_MODE_PREFERENCES: "الرغبات المرتبة",
+}
+
+JOB_STATUS_LABELS = {
+    db.JOB_QUEUED: "🕓",
+    db.JOB_RUNNING: "⏳",
+    db.JOB_DONE: "✅",
+    db.JOB_FAILED: "❌",
+    db.JOB_CANCELLED: "⛔",
+    db.JOB_INTERRUPTED: "⚠️",
+}
 
 # ==================== دوال المساعدة والواجهات ====================
 
 def get_main_keyboard(user_id):
     """لوحة المفاتيح الرئيسية للمستخدمين"""
-    is_admin = (user_id == ADMIN_ID)
+    is_admin = tenants.is_admin(user_id)
     
     keyboard = [
         [KeyboardButton("📅 حجز مناوبة")],
@@ -53,16 +85,18 @@ def get_admin_keyboard():
         [KeyboardButton("⏰ فتح مجدول"), KeyboardButton("📅 ضبط أيام الشهر")],
         [KeyboardButton("📢 إشعار جماعي"), KeyboardButton("📥 تصدير الجدول")],
         [KeyboardButton("➕ زيادة أيام"), KeyboardButton("➖ تقليل أيام")],
-        [KeyboardButton("🔄 بدء شهر جديد")],
+        [KeyboardButton("🔄 بدء شهر جديد"), KeyboardButton("🧾 المهام")],
+        [KeyboardButton("📈 الأداء"), KeyboardButton("🐢 الاستعلامات")],
+        [KeyboardButton("🎯 نمط الحجز")],
         [KeyboardButton("🔙 العودة للقائمة الرئيسية")]
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
-def format_schedule():
+async def format_schedule():
     """تنسيق جدول المناوبات بشكل جميل"""
     month = db.get_current_month()
-    bookings = db.get_all_bookings(month)
-    month_days = db.get_month_days()
+    bookings = await adb.get_all_bookings(month)
+    month_days = await adb.get_month_days()
     
     # تحويل الحجوزات إلى قاموس
     booked = {b['day']: b['full_name'] for b in bookings}
@@ -103,20 +137,20 @@ def format_schedule():
     
     return schedule
 
-def get_days_keyboard(user_id):
+async def get_days_keyboard(user_id):
     """إنشاء لوحة أيام الحجز"""
     month = db.get_current_month()
-    bookings = db.get_all_bookings(month)
+    bookings = await adb.get_all_bookings(month)
     booked_days = [b['day'] for b in bookings]
     
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
         return None, "المستخدم غير موجود"
     
-    user_bookings = [b['day'] for b in db.get_user_bookings(user_id, month)]
+    user_bookings = [b['day'] for b in await adb.get_user_bookings(user_id, month)]
     
     # حساب الأيام المتاحة
-    month_days = db.get_month_days()
+    month_days = await adb.get_month_days()
     available_days = [d for d in range(1, month_days + 1) if d not in booked_days]
     
     if not available_days:
@@ -154,6 +188,75 @@ def get_days_keyboard(user_id):
     
     return InlineKeyboardMarkup(keyboard), header
 
+async def get_preferences_keyboard(user_id, closes_at=None):
+    """لوحة تسجيل الرغبات المرتبة (نمط الرغبات)"""
+    month = db.get_current_month()
+    booked_days = {b['day'] for b in await adb.get_all_bookings(month)}
+    
+    user = await adb.get_user(user_id)
+    if not user:
+        return None, "المستخدم غير موجود"
+    
+    preferences = await adb.get_preferences(user_id, month)
+    ranks = {day: rank for rank, day in enumerate(preferences, 1)}
+    
+    month_days = await adb.get_month_days()
+    available_days = [d for d in range(1, month_days + 1) if d not in booked_days]
+    
+    if not available_days:
+        return None, "⚠️ لا توجد أيام متاحة للحجز"
+    
+    # أزرار الأيام (5 أعمدة) - رقم الرغبة قبل اليوم المختار
+    keyboard = []
+    row = []
+    
+    for i, day in enumerate(available_days, 1):
+        button_text = f"({ranks[day]}) {day}" if day in ranks else str(day)
+        row.append(InlineKeyboardButton(button_text, callback_data=f"pref_{day}"))
+        
+        if i % 5 == 0:
+            keyboard.append(row)
+            row = []
+    
+    if row:
+        keyboard.append(row)
+    
+    keyboard.append([
+        InlineKeyboardButton("🧹 مسح رغباتي", callback_data="pref_clear"),
+        InlineKeyboardButton("✅ تم", callback_data="pref_done")
+    ])
+    
+    header = (
+        f"🗳 *تسجيل الرغبات*\n\n"
+        f"👤 د.{user['full_name']}\n"
+        f"📊 أيامك هذا الشهر: {user['max_days']}\n"
+        f"📍 رغباتك بالترتيب: {', '.join(map(str, preferences)) if preferences else 'لا يوجد'}\n"
+        + (f"⏳ يُغلق التسجيل: {closes_at.strftime('%Y/%m/%d %H:%M')}\n" if closes_at else "")
+        + f"\nاضغط الأيام بترتيب أفضليتك (حتى {db.MAX_PREFERENCES})، والضغط مرة أخرى يزيل اليوم.\n"
+        f"التوزيع عند الغلق بالتناوب بين الأطباء، فلا فائدة من الاستعجال، "
+        f"وترتيب أيام أكثر من حدك يزيد فرصك."
+    )
+    
+    return InlineKeyboardMarkup(keyboard), header
+
+async def format_profile(db_user):
+    """نص الملف الشخصي وقائمة أيام المستخدم المحجوزة"""
+    month = db.get_current_month()
+    bookings = await adb.get_user_bookings(db_user['user_id'], month)
+    booked_days = [b['day'] for b in bookings]
+    
+    info = f"👤 *الملف الشخصي*\n\n"
+    info += f"📌 الاسم: د.{db_user['full_name']}\n"
+    info += f"📊 الحد الأقصى: {db_user['max_days']} أيام\n"
+    info += f"📅 المحجوز: {len(bookings)}\n"
+    
+    if booked_days:
+        info += f"📍 أيامك: {', '.join(map(str, sorted(booked_days)))}"
+    else:
+        info += "⚠️ لا توجد حجوزات هذا الشهر"
+    
+    return info, booked_days
+
 def get_help_text(user):
     """نص المساعدة الشامل"""
     max_days = user['max_days'] if user else 2
@@ -186,94 +289,310 @@ def get_help_text(user):
 بالتوفيق للجميع! 🩺
 """
 
-def export_to_csv():
-    """تصدير الجدول إلى CSV"""
-    month = db.get_current_month()
-    bookings = db.get_all_bookings(month)
-    month_days = db.get_month_days()
-    
-    booked_dict = {b['day']: b for b in bookings}
+async def send_export(bot, chat_id, fmt, months, user_id=None):
+    """تصدير آخر عدد من الأشهر وإرساله كملف - يعيد اسم الملف"""
+    end_month = db.get_current_month()
+    start_month = export.shift_month(end_month, 1 - months)
+    document, filename = await adb.run(
+        export.export_bookings, fmt, start_month, end_month, user_id
+    )
+    try:
+        period = end_month if months == 1 else f"{start_month} → {end_month}"
+        # الملف المؤقت في الذاكرة بلا اسم، ومكتبة تيليجرام تقرأ المحتوى كاملاً على أي حال
+        await bot.send_document(
+            chat_id=chat_id,
+            document=document.read(),
+            filename=filename,
+            caption=f"📊 جدول مناوبات {period}"
+        )
+    finally:
+        document.close()
+    return filename
+
+async def export_job(app, job):
+    """إجراء مهمة التصدير"""
+    params = job.params
+    return await send_export(
+        app.bot, params['chat_id'], params['fmt'], params['months'], params.get('user_id')
+    )
+
+# ==================== الإشعارات الجماعية ====================
+
+def format_broadcast_status(title, job):
+    """نص حالة الإرسال الجماعي للمشرف"""
+    if not job.done:
+        state = "📤 جاري الإرسال..."
+    elif job.cancelled:
+        state = "⛔ تم إيقاف الإرسال"
+    else:
+        state = "✅ اكتمل الإرسال"
+    return (
+        f"{state}\n"
+        f"📢 {title}\n\n"
+        f"📨 تم: {job.delivered}\n"
+        f"❌ فشل: {job.failed}\n"
+        f"⏳ التقدم: {job.processed}/{job.total}"
+    )
+
+async def start_broadcast(context, admin_chat_id, text, title):
+    """إرسال رسالة لجميع الأطباء كمهمة خلفية - يعيد رقم المهمة"""
+    return await context.bot_data['jobs'].submit(
+        'broadcast', title,
+        {'text': text, 'chat_id': admin_chat_id},
+        created_by=admin_chat_id
+    )
+
+async def broadcast_job(app, job):
+    """إجراء مهمة الإرسال الجماعي مع رسالة تقدم قابلة للإيقاف"""
+    users = await adb.get_approved_users()
+    recipients = [u['user_id'] for u in users if not tenants.is_admin(u['user_id'])]
+    sending = broadcast.Broadcast(recipients, job.params['text'], parse_mode='Markdown')
+    job.on_cancel(sending.cancel)
+    stop_keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("⛔ إيقاف الإرسال", callback_data=f"job_cancel_{job.id}")
+    ]])
+    
+    status = await app.bot.send_message(
+        chat_id=job.params['chat_id'],
+        text=format_broadcast_status(job.title, sending),
+        reply_markup=stop_keyboard
+    )
     
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['اليوم', 'التاريخ', 'الطبيب'])
+    async def on_progress(sending):
+        await job.progress(sending.processed, sending.total, force=sending.done)
+        await status.edit_text(
+            format_broadcast_status(job.title, sending),
+            reply_markup=None if sending.done else stop_keyboard
+        )
     
-    for day in range(1, month_days + 1):
-        if day in booked_dict:
-            writer.writerow([day, f"{month}-{day:02d}", booked_dict[day]['full_name']])
-        else:
-            writer.writerow([day, f"{month}-{day:02d}", 'متاح'])
+    await broadcast.run_broadcast(app.bot, sending, on_progress)
+    return f"تم {sending.delivered}، فشل {sending.failed} من {sending.total}"
+
+async def notify_admins(bot, text, **kwargs):
+    """إرسال رسالة لكل مشرفي القسم الحالي"""
+    for admin_id in tenants.admin_ids():
+        try:
+            await bot.send_message(chat_id=admin_id, text=text, **kwargs)
+        except TelegramError as e:
+            logger.warning("تعذر إرسال إشعار للمشرف %s: %s", admin_id, e)
+
+# ==================== نافذة الرغبات ====================
+
+async def open_preference_window(app):
+    """بدء تسجيل الرغبات: غلق تلقائي بعد PREFERENCE_WINDOW_HOURS ما لم يُجدول غلق - يعيد وقت الغلق"""
+    timer_service = app.bot_data['timers']
+    pending = timer_service.pending().get('booking_close')
+    if pending is not None:
+        return pending[1]
+    closes_at = datetime.now() + timedelta(hours=config.PREFERENCE_WINDOW_HOURS)
+    await timer_service.schedule('booking_close', 'close_booking', closes_at)
+    return closes_at
+
+async def is_preference_window_open():
+    """الحجز مفتوح في نمط الرغبات (تسجيل الرغبات بدلاً من الحجز المباشر)"""
+    return await adb.is_booking_open() and \
+        await adb.get_booking_mode() == db.BOOKING_MODE_PREFERENCES
+
+def get_window_close_time(app):
+    """وقت غلق نافذة الرغبات المجدول أو None"""
+    pending = app.bot_data['timers'].pending().get('booking_close')
+    return pending[1] if pending is not None else None
+
+async def close_preference_window(app):
+    """توزيع الأيام حسب الرغبات (معاملة واحدة) وإبلاغ الأطباء في الخلفية - يعيد ملخص المشرف"""
+    result = await adb.allocate_preferences()
+    if result.order:
+        await app.bot_data['jobs'].submit(
+            'allocation', "إبلاغ نتائج توزيع الرغبات",
+            {'doctors': result.order, 'assignments': result.assignments}
+        )
+    stats = await adb.get_month_statistics()
+    return (
+        f"🗳 *تم توزيع الرغبات*\n\n"
+        f"👥 أطباء سجلوا رغباتهم: {len(result.order)}\n"
+        f"📌 أيام موزعة: {sum(len(days) for days in result.assignments.values())}\n"
+        f"⚠️ لم تكتمل أيامهم: {len(result.unmet)}\n"
+        f"⬜ أيام شاغرة: {stats['free_days']}"
+    )
+
+def format_allocation_result(days):
+    """نص نتيجة التوزيع لطبيب"""
+    if not days:
+        return (
+            "🗳 *نتيجة توزيع المناوبات*\n\n"
+            "📭 أُخذت كل الأيام في قائمة رغباتك قبل دورك.\n"
+            "راجع المشرف للأيام الشاغرة."
+        )
+    return (
+        f"🗳 *نتيجة توزيع المناوبات*\n\n"
+        f"📍 أيامك: {', '.join(map(str, sorted(days)))}"
+    )
+
+async def allocation_job(app, job):
+    """إجراء مهمة إبلاغ كل طبيب سجّل رغباته بنتيجته"""
+    # المفاتيح نصوص إذا مرت المعاملات عبر JSON
+    assignments = {int(user_id): days for user_id, days in job.params['assignments'].items()}
+    pending = list(job.params['doctors'])
+    total = len(pending)
+    delivered = 0
+
+    async def worker():
+        nonlocal delivered
+        while pending and not job.cancelled:
+            user_id = pending.pop()
+            if await broadcast.deliver(
+                app.bot, user_id, format_allocation_result(assignments.get(user_id)), 'Markdown',
+                is_cancelled=lambda: job.cancelled, kind='allocation'
+            ):
+                delivered += 1
+            await job.progress(total - len(pending), total, force=not pending)
+
+    await asyncio.gather(*(worker() for _ in range(min(broadcast.MAX_CONCURRENCY, total))))
+    return f"تم {delivered} من {total}"
+
+# ==================== المقاييس ====================
+
+def process_metrics():
+    """القيم اللحظية المشتركة بين الأقسام"""
+    cache = db.get_user_cache_stats()
+    for name in ('hits', 'negative_hits', 'misses', 'evictions', 'size'):
+        yield f"bot_user_cache_{name}", {}, cache[name]
+    yield "bot_render_cache_hits", {}, render_cache.cache.hits
+    yield "bot_render_cache_misses", {}, render_cache.cache.misses
+    yield "bot_activity_pending_users", {}, activity.buffer.get_stats()['pending_users']
+    queries = querytrace.get_stats()
+    yield "bot_sql_statements", {}, queries['statements']
+    yield "bot_sql_slow_statements", {}, queries['slow']
+
+metrics.register_collector(process_metrics)
+
+def app_metrics(app):
+    """القيم اللحظية لتطبيق قسم"""
+    labels = {'tenant': app.bot_data['tenant'].name}
+    updates = app.update_processor.get_stats()
+    for name in ('queued', 'active', 'max_queued', 'processed'):
+        yield f"bot_updates_{name}", labels, updates[name]
+    yield "bot_update_wait_p95_seconds", labels, updates['p95_wait_ms'] / 1000
+    state = app.persistence.get_stats()
+    yield "bot_user_state_cached_users", labels, state['cached_users']
+    yield "bot_user_state_pending_writes", labels, state['pending_writes']
+    job_runner = app.bot_data.get('jobs')
+    yield "bot_jobs_active", labels, len(job_runner.active()) if job_runner else 0
+
+def _slowest(histogram):
+    """أبطأ السلاسل حسب p95"""
+    return sorted(histogram.summary(), key=lambda s: s[3], reverse=True)[:METRICS_VIEW_TOP]
+
+def format_metrics(app):
+    """ملخص المقاييس للمشرف"""
+    updates = app.update_processor.get_stats()
+    msg = "📈 الأداء\n\n"
+    msg += (
+        f"⏱ التحديثات: {updates['processed']} | في الطابور {updates['queued']}"
+        f" | انتظار p95 {updates['p95_wait_ms']:.0f} ms\n"
+    )
+    errors = metrics.HANDLER_ERRORS.total() + metrics.UPDATE_ERRORS.total()
+    msg += f"❗ أخطاء المعالجات: {errors}\n"
     
-    return output.getvalue()
+    sections = (
+        ("🧭 أبطأ المسارات", metrics.HANDLER_SECONDS, 'route'),
+        ("🗄 أبطأ دوال القاعدة", metrics.DB_SECONDS, 'function'),
+        ("📡 أبطأ طلبات تيليجرام", metrics.API_SECONDS, 'method'),
+    )
+    for title, histogram, label in sections:
+        msg += f"\n{title} (p95):\n"
+        for labels, count, avg, p95 in _slowest(histogram):
+            msg += f"  {labels[label]}: {p95 * 1000:.0f} ms (متوسط {avg * 1000:.0f}، ×{count})\n"
+    msg += f"\nأخطاء القاعدة: {metrics.DB_ERRORS.total()} | أخطاء تيليجرام: {metrics.API_ERRORS.total()}\n"
+    
+    msg += "\n📨 الإرسال:\n"
+    for kind, label in (('reminder', "التذكيرات"), ('broadcast', "الإرسال الجماعي")):
+        delivered = metrics.DELIVERIES.total(kind=kind, result='delivered')
+        failed = metrics.DELIVERIES.total(kind=kind, result='failed') + \
+            metrics.DELIVERIES.total(kind=kind, result='rejected')
+        msg += f"  {label}: ✅ {delivered} | ❌ {failed}\n"
+    
+    cache = db.get_user_cache_stats()
+    msg += f"\n💾 ذاكرة المستخدمين: {cache['size']} | إصابة {cache['hit_rate']:.0%}"
+    return msg
+
+def format_query_report():
+    """أثقل جمل SQL وخطط البطيئة منها للمشرف"""
+    report = querytrace.get_report(METRICS_VIEW_TOP)
+    msg = f"🐢 الاستعلامات (حد البطء {querytrace.SLOW_QUERY_MS:.0f} ms)\n"
+    if not report['top']:
+        return msg + "\n📭 لم تُسجَّل جمل بعد"
+    for entry in report['top']:
+        msg += (
+            f"\n• {entry['sql'][:200]}\n"
+            f"  ×{entry['count']} | مجموع {entry['total_ms']:.0f} ms | متوسط {entry['avg_ms']:.1f}"
+            f" | أقصى {entry['max_ms']:.1f} | بطيئة {entry['slow']}\n"
+        )
+        for step in entry['plan'] or []:
+            msg += f"    ↳ {step}\n"
+    if report['recent_slow']:
+        msg += "\nآخر الجمل البطيئة:\n"
+        for entry in report['recent_slow']:
+            at = datetime.fromtimestamp(entry['at']).strftime('%H:%M:%S')
+            msg += f"  {at} {entry['ms']:.0f} ms: {entry['sql'][:80]}\n"
+    return msg[:MAX_MESSAGE_LENGTH]
+
+async def on_error(update, context: ContextTypes.DEFAULT_TYPE):
+    """تسجيل الاستثناءات غير المعالجة في السجل والمقاييس"""
+    metrics.UPDATE_ERRORS.inc(error=type(context.error).__name__)
+    logger.error("استثناء غير معالج", exc_info=context.error)
 
 # ==================== المهام الدورية (مخففة) ====================
 
-def check_and_send_reminders(app):
-    """فحص وإرسال التذكيرات"""
-    try:
-        month = db.get_current_month()
-        tomorrow = (datetime.now() + timedelta(days=1)).day
-        today = datetime.now().day
-        
-        bookings = db.get_all_bookings(month)
-        
-        for booking in bookings:
-            if booking['day'] == tomorrow:
-                try:
-                    app.bot.send_message(
-                        chat_id=booking['user_id'],
-                        text=f"🔔 *تذكير مهم*\n\n"
-                             f"عزيزي د.{booking['full_name']}\n"
-                             f"لديك مناوبة غداً (اليوم {booking['day']})\n\n"
-                             f"بالتوفيق! 🌟",
-                        parse_mode='Markdown'
-                    )
-                except:
-                    pass
-            elif booking['day'] == today:
-                try:
-                    app.bot.send_message(
-                        chat_id=booking['user_id'],
-                        text=f"⏰ *تذكير اليوم*\n\n"
-                             f"عزيزي د.{booking['full_name']}\n"
-                             f"لديك مناوبة اليوم\n\n"
-                             f"نتمنى لك يوماً موفقاً! 🩺",
-                        parse_mode='Markdown'
-                    )
-                except:
-                    pass
-    except:
-        pass
-
-def schedule_reminders(app):
-    """جدولة التذكيرات"""
-    def run_reminders():
-        while True:
-            now = datetime.now()
-            if now.hour == 8 and now.minute == 0:  # الساعة 8 صباحاً
-                check_and_send_reminders(app)
-            threading.Event().wait(60)  # انتظر دقيقة
-    
-    thread = threading.Thread(target=run_reminders, daemon=True)
-    thread.start()
+async def refresh_settings_loop():
+    """إعادة تحميل ذاكرة الإعدادات إذا عدّلت عملية أخرى القاعدة"""
+    while True:
+        await asyncio.sleep(SETTINGS_REFRESH_SECONDS)
+        try:
+            await adb.reload_settings(only_if_changed=True)
+        except Exception:
+            logger.exception("فشل تحديث الإعدادات")
+
+async def evict_user_data_loop(app):
+    """إخلاء حالات المحادثة الخاملة من الذاكرة (تبقى محفوظة في القاعدة)"""
+    while True:
+        await asyncio.sleep(persistence.UPDATE_INTERVAL)
+        try:
+            await app.persistence.evict_idle(app)
+        except Exception:
+            logger.exception("فشل إخلاء حالات المحادثة")
+
+async def open_booking_timer(app, payload):
+    """إجراء المؤقت: فتح الحجز في الموعد المجدول"""
+    await adb.set_booking_open(True)
+    await adb.set_scheduled_booking_time('')
+    text = "✅ *تم فتح الحجز تلقائياً*"
+    if await adb.get_booking_mode() == db.BOOKING_MODE_PREFERENCES:
+        closes_at = await open_preference_window(app)
+        text += f"\n🗳 تسجيل الرغبات حتى {closes_at.strftime('%Y/%m/%d %H:%M')}"
+    await notify_admins(app.bot, text, parse_mode='Markdown')
+
+async def close_booking_timer(app, payload):
+    """إجراء المؤقت: غلق الحجز في الموعد المجدول (وتوزيع الرغبات في نمط الرغبات)"""
+    await adb.set_booking_open(False)
+    text = "🔒 *تم غلق الحجز تلقائياً*"
+    if await adb.get_booking_mode() == db.BOOKING_MODE_PREFERENCES:
+        text += "\n\n" + await close_preference_window(app)
+    await notify_admins(app.bot, text, parse_mode='Markdown')
 
 # ==================== معالجات البوت الرئيسية ====================
 
+@metrics.timed_handler('command:start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالج أمر /start"""
     user = update.effective_user
     user_id = user.id
     
-    try:
-        db.update_last_active(user_id)
-    except:
-        pass
-    
-    db_user = db.get_user(user_id)
+    db_user = await adb.get_user(user_id)
     
     if db_user and db_user['approved'] == 1:
         welcome = f"🎉 *مرحباً بك د.{db_user['full_name']}*"
-        if user_id == ADMIN_ID:
+        if tenants.is_admin(user_id):
             welcome += "\n\n✨ *أنت المشرف* - لديك صلاحيات كاملة"
         
         await update.message.reply_text(
@@ -291,485 +610,808 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         context.user_data['awaiting_name'] = True
 
+router = routing.Router()
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالج الرسائل النصية"""
+    """معالج الرسائل النصية (التوجيه عبر جدول المسارات أدناه)"""
+    await router.dispatch_text(update, context)
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالج الأزرار (التوجيه عبر جدول المسارات أدناه)"""
+    await update.callback_query.answer()
+    await router.dispatch_callback(update, context)
+
+# ==================== قائمة المستخدم ====================
+
+@router.state('awaiting_name', access=routing.ANYONE, before_menu=True)
+async def name_input(update, context, db_user):
+    """إدخال الاسم الثلاثي للتسجيل"""
     user_id = update.effective_user.id
-    text = update.message.text
-    is_admin = (user_id == ADMIN_ID)
-    
-    # معالجة إدخال الاسم
-    if context.user_data.get('awaiting_name'):
-        full_name = text.strip()
-        
-        if len(full_name.split()) < 2:
-            await update.message.reply_text("❌ الرجاء إرسال الاسم الثلاثي كاملاً")
-            return
-        
-        db.add_user(user_id, full_name)
-        
-        await context.bot.send_message(
-            chat_id=ADMIN_ID,
-            text=f"🔔 *طلب موافقة جديد*\n\n👤 الاسم: {full_name}\n🆔 المعرف: {user_id}",
+    full_name = update.message.text.strip()
+
+    if len(full_name.split()) < 2:
+        await update.message.reply_text("❌ الرجاء إرسال الاسم الثلاثي كاملاً")
+        return
+
+    await adb.add_user(user_id, full_name)
+
+    await notify_admins(
+        context.bot,
+        f"🔔 *طلب موافقة جديد*\n\n👤 الاسم: {full_name}\n🆔 المعرف: {user_id}",
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("✅ موافقة", callback_data=f"app_{user_id}"),
+                InlineKeyboardButton("❌ رفض", callback_data=f"rej_{user_id}")
+            ]
+        ])
+    )
+
+    await update.message.reply_text("✅ *تم إرسال طلبك إلى المشرف*\n\nسيتم إعلامك فور الموافقة.", parse_mode='Markdown')
+    context.user_data['awaiting_name'] = False
+
+@router.text("📅 حجز مناوبة")
+async def booking_menu(update, context, db_user):
+    user_id = update.effective_user.id
+    if not await adb.is_booking_open() and not tenants.is_admin(user_id):
+        await update.message.reply_text("🔒 *الحجز مغلق حالياً*", parse_mode='Markdown')
+        return
+
+    # في نمط الرغبات أثناء النافذة: تسجيل الرغبات بدلاً من الحجز المباشر
+    if await is_preference_window_open():
+        keyboard, header = await get_preferences_keyboard(user_id, get_window_close_time(context.application))
+    else:
+        keyboard, header = await get_days_keyboard(user_id)
+    if keyboard:
+        await update.message.reply_text(header, parse_mode='Markdown', reply_markup=keyboard)
+    else:
+        await update.message.reply_text(header, parse_mode='Markdown')
+
+@router.text("📋 عرض الجدول")
+async def show_schedule(update, context, db_user):
+    schedule = await render_cache.cache.get(('schedule', db.get_current_month()), format_schedule)
+    await update.message.reply_text(f"`{schedule}`", parse_mode='Markdown')
+
+@router.text("👤 ملفي الشخصي")
+async def show_profile(update, context, db_user):
+    info, booked_days = await render_cache.cache.get(
+        ('profile', db_user['user_id'], db.get_current_month()),
+        lambda: format_profile(db_user)
+    )
+
+    if booked_days:
+        await update.message.reply_text(
+            info,
+            parse_mode='Markdown',
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🗑 حذف حجز", callback_data="show_delete"),
+                InlineKeyboardButton("📆 ملف التقويم", callback_data="my_ics")
+            ]])
+        )
+    else:
+        await update.message.reply_text(info, parse_mode='Markdown')
+
+@router.text("📚 كيفية الاستخدام")
+async def show_help(update, context, db_user):
+    async def build_help():
+        return get_help_text(db_user)
+    help_text = await render_cache.cache.get(('help', db_user['max_days']), build_help)
+    await update.message.reply_text(help_text, parse_mode='Markdown')
+
+@router.text("🔙 العودة للقائمة الرئيسية")
+async def main_menu(update, context, db_user):
+    await update.message.reply_text("القائمة الرئيسية", reply_markup=get_main_keyboard(update.effective_user.id))
+
+# ==================== قائمة المشرف ====================
+
+@router.text("⚙️ لوحة المشرف", access=routing.ADMIN)
+async def admin_panel(update, context, db_user):
+    stats = await adb.get_month_statistics()
+    await update.message.reply_text(
+        f"🔧 *لوحة تحكم المشرف*\n\n"
+        f"📊 إحصائيات سريعة:\n"
+        f"• الأطباء: {stats['total_doctors']}\n"
+        f"• حجوزات: {stats['booked_days']}/{stats['month_days']}\n"
+        f"• الحجز: {'مفتوح' if await adb.is_booking_open() else 'مغلق'}\n\n"
+        f"اختر ما تريد:",
+        parse_mode='Markdown',
+        reply_markup=get_admin_keyboard()
+    )
+
+@router.text("👥 طلبات موافقة", access=routing.ADMIN)
+async def pending_requests(update, context, db_user):
+    pending = await adb.get_pending_users()
+    if not pending:
+        await update.message.reply_text("✅ لا توجد طلبات جديدة")
+        return
+
+    for p in pending:
+        await update.message.reply_text(
+            f"🔔 *طلب موافقة*\n\n👤 {p['full_name']}\n🆔 `{p['user_id']}`",
             parse_mode='Markdown',
             reply_markup=InlineKeyboardMarkup([
                 [
-                    InlineKeyboardButton("✅ موافقة", callback_data=f"app_{user_id}"),
-                    InlineKeyboardButton("❌ رفض", callback_data=f"rej_{user_id}")
+                    InlineKeyboardButton("✅ موافقة", callback_data=f"app_{p['user_id']}"),
+                    InlineKeyboardButton("❌ رفض", callback_data=f"rej_{p['user_id']}")
                 ]
             ])
         )
-        
-        await update.message.reply_text("✅ *تم إرسال طلبك إلى المشرف*\n\nسيتم إعلامك فور الموافقة.", parse_mode='Markdown')
-        context.user_data['awaiting_name'] = False
-        return
-    
-    # التحقق من حالة المستخدم
-    db_user = db.get_user(user_id)
-    if not db_user or db_user['approved'] != 1:
-        await update.message.reply_text("❌ ليس لديك صلاحية استخدام البوت")
+
+@router.text("📋 قائمة الأطباء", access=routing.ADMIN)
+async def doctors_list(update, context, db_user):
+    roster = await adb.get_roster_summary(db.get_current_month())
+    if not roster:
+        await update.message.reply_text("📭 لا يوجد أطباء مسجلين")
         return
-    
-    # ==================== قائمة المستخدم ====================
-    
-    if text == "📅 حجز مناوبة":
-        if not db.is_booking_open() and not is_admin:
-            await update.message.reply_text("🔒 *الحجز مغلق حالياً*", parse_mode='Markdown')
-            return
-        
-        keyboard, header = get_days_keyboard(user_id)
-        if keyboard:
-            await update.message.reply_text(header, parse_mode='Markdown', reply_markup=keyboard)
-        else:
-            await update.message.reply_text(header, parse_mode='Markdown')
-    
-    elif text == "📋 عرض الجدول":
-        schedule = format_schedule()
-        await update.message.reply_text(f"`{schedule}`", parse_mode='Markdown')
-    
-    elif text == "👤 ملفي الشخصي":
-        month = db.get_current_month()
-        bookings = db.get_user_bookings(user_id, month)
-        booked_days = [b['day'] for b in bookings]
-        
-        info = f"👤 *الملف الشخصي*\n\n"
-        info += f"📌 الاسم: د.{db_user['full_name']}\n"
-        info += f"📊 الحد الأقصى: {db_user['max_days']} أيام\n"
-        info += f"📅 المحجوز: {len(bookings)}\n"
-        
-        if booked_days:
-            info += f"📍 أيامك: {', '.join(map(str, sorted(booked_days)))}"
-            await update.message.reply_text(
-                info,
-                parse_mode='Markdown',
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🗑 حذف حجز", callback_data="show_delete")
-                ]])
-            )
-        else:
-            info += "⚠️ لا توجد حجوزات هذا الشهر"
-            await update.message.reply_text(info, parse_mode='Markdown')
-    
-    elif text == "📚 كيفية الاستخدام":
-        help_text = get_help_text(db_user)
-        await update.message.reply_text(help_text, parse_mode='Markdown')
-    
-    # ==================== قائمة المشرف ====================
-    
-    elif text == "⚙️ لوحة المشرف" and is_admin:
-        stats = db.get_month_statistics()
+
+    msg = "📋 *قائمة الأطباء*\n\n"
+    for doctor in roster:
+        msg += f"• د.{doctor['full_name']}: {doctor['booked_count']}/{doctor['max_days']}\n"
+
+    await update.message.reply_text(msg, parse_mode='Markdown')
+
+@router.text("🗑 حذف مستخدم", access=routing.ADMIN)
+async def delete_user_menu(update, context, db_user):
+    users = await adb.get_approved_users()
+    keyboard = []
+    for u in users:
+        if not tenants.is_admin(u['user_id']):
+            keyboard.append([InlineKeyboardButton(f"❌ د.{u['full_name']}", callback_data=f"deluser_{u['user_id']}")])
+    keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")])
+    await update.message.reply_text("⚠️ *حذف مستخدم*\n\nاختر:", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+@router.text("📊 إحصائيات", access=routing.ADMIN)
+async def show_statistics(update, context, db_user):
+    stats = await adb.get_month_statistics()
+    msg = f"📊 *إحصائيات الشهر*\n\n"
+    msg += f"📅 الشهر: {stats['month']}\n"
+    msg += f"📆 أيام الشهر: {stats['month_days']}\n"
+    msg += f"✅ محجوز: {stats['booked_days']}\n"
+    msg += f"⬜ شاغر: {stats['free_days']}\n"
+    msg += f"👥 الأطباء: {stats['total_doctors']}\n"
+    msg += f"🔓 الحجز: {'مفتوح' if await adb.is_booking_open() else 'مغلق'}\n"
+    msg += f"🎯 النمط: {BOOKING_MODE_LABELS[await adb.get_booking_mode()]}"
+    if await is_preference_window_open():
+        submitted = await adb.count_preferences()
+        msg += f"\n🗳 رغبات مسجلة: {submitted['preferences']} من {submitted['doctors']} طبيب"
+    await update.message.reply_text(msg, parse_mode='Markdown')
+
+@router.text("🔓 فتح الحجز", access=routing.ADMIN)
+async def open_booking(update, context, db_user):
+    await adb.set_booking_open(True)
+    if await adb.get_booking_mode() == db.BOOKING_MODE_PREFERENCES:
+        closes_at = (await open_preference_window(context.application)).strftime('%Y/%m/%d %H:%M')
         await update.message.reply_text(
-            f"🔧 *لوحة تحكم المشرف*\n\n"
-            f"📊 إحصائيات سريعة:\n"
-            f"• الأطباء: {stats['total_doctors']}\n"
-            f"• حجوزات: {stats['booked_days']}/{stats['month_days']}\n"
-            f"• الحجز: {'مفتوح' if db.is_booking_open() else 'مغلق'}\n\n"
-            f"اختر ما تريد:",
-            parse_mode='Markdown',
-            reply_markup=get_admin_keyboard()
+            f"✅ *تم فتح تسجيل الرغبات*\n\n⏳ التوزيع عند الغلق: {closes_at}",
+            parse_mode='Markdown'
         )
+        await start_broadcast(
+            context, update.effective_user.id,
+            f"🗳 *بدأ تسجيل رغبات المناوبات!*\n\n"
+            f"رتّب الأيام التي تفضلها من «📅 حجز مناوبة» قبل {closes_at}.\n"
+            f"التوزيع بعد الغلق بالتناوب بين الأطباء، فلا فائدة من الاستعجال.",
+            "إشعار تسجيل الرغبات"
+        )
+        return
+
+    await update.message.reply_text("✅ *تم فتح الحجز*", parse_mode='Markdown')
+
+    # إشعار الأطباء في الخلفية
+    await start_broadcast(
+        context, update.effective_user.id,
+        "🔔 *تم فتح باب الحجز!*\n\nيمكنك الآن حجز مناوباتك.",
+        "إشعار فتح الحجز"
+    )
+
+@router.text("🔒 غلق الحجز", access=routing.ADMIN)
+async def close_booking(update, context, db_user):
+    await adb.set_booking_open(False)
+    if await adb.get_booking_mode() == db.BOOKING_MODE_PREFERENCES:
+        # الغلق اليدوي ينهي النافذة: لا حاجة لمؤقت الغلق بعد التوزيع
+        await context.bot_data['timers'].cancel('booking_close')
+        summary = await close_preference_window(context.application)
+        await update.message.reply_text(f"🔒 *تم غلق الحجز*\n\n{summary}", parse_mode='Markdown')
+        return
+    await update.message.reply_text("🔒 *تم غلق الحجز*", parse_mode='Markdown')
+
+@router.text("⏰ فتح مجدول", access=routing.ADMIN)
+async def schedule_booking_menu(update, context, db_user):
+    await update.message.reply_text(
+        "⏰ *فتح الحجز بتاريخ محدد*\n\n"
+        "أرسل التاريخ والوقت بهذه الصيغة:\n"
+        "`YYYY/MM/DD HH:MM`\n\n"
+        "مثال: `2026/03/15 09:00`\n"
+        "(15 مارس 2026 الساعة 9 صباحاً)\n\n"
+        "ولغلق الحجز تلقائياً أضف وقت الغلق:\n"
+        "`2026/03/15 09:00 - 2026/03/20 21:00`",
+        parse_mode='Markdown'
+    )
+    context.user_data['awaiting_full_datetime'] = True
+
+@router.text("🎯 نمط الحجز", access=routing.ADMIN)
+async def booking_mode_menu(update, context, db_user):
+    mode = await adb.get_booking_mode()
+    await update.message.reply_text(
+        f"🎯 *نمط الحجز الحالي: {BOOKING_MODE_LABELS[mode]}*\n\n"
+        f"⚡ الأسبق: كل طبيب يحجز أيامه بالضغط عند فتح الحجز.\n"
+        f"🗳 الرغبات: يرتب كل طبيب الأيام التي يفضلها خلال فترة الفتح، "
+        f"وعند الغلق توزَّع الأيام دفعة واحدة بالتناوب بين الأطباء.",
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"⚡ {BOOKING_MODE_LABELS[db.BOOKING_MODE_FIRST_COME]}",
+                                  callback_data=f"mode_{db.BOOKING_MODE_FIRST_COME}")],
+            [InlineKeyboardButton(f"🗳 {BOOKING_MODE_LABELS[db.BOOKING_MODE_PREFERENCES]}",
+                                  callback_data=f"mode_{db.BOOKING_MODE_PREFERENCES}")],
+            [InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")]
+        ])
+    )
+
+@router.text("📅 ضبط أيام الشهر", access=routing.ADMIN)
+async def month_days_menu(update, context, db_user):
+    current = await adb.get_month_days()
+    await update.message.reply_text(
+        f"📅 *عدد أيام الشهر الحالي: {current}*\n\n"
+        "أرسل الرقم الجديد (28-31):",
+        parse_mode='Markdown'
+    )
+    context.user_data['awaiting_month_days'] = True
+
+@router.text("📢 إشعار جماعي", access=routing.ADMIN)
+async def broadcast_menu(update, context, db_user):
+    await update.message.reply_text(
+        "📢 *إرسال إشعار جماعي*\n\n"
+        "أرسل الرسالة التي تريد إرسالها لجميع الأطباء:",
+        parse_mode='Markdown'
+    )
+    context.user_data['awaiting_broadcast'] = True
+
+@router.text("📥 تصدير الجدول", access=routing.ADMIN)
+async def export_menu(update, context, db_user):
+    await update.message.reply_text(
+        "📥 *تصدير الجدول*\n\nاختر الصيغة والمدة:",
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("📄 CSV - الشهر الحالي", callback_data="exp_csv_1")],
+            [InlineKeyboardButton("📄 CSV - آخر 12 شهراً", callback_data="exp_csv_12")],
+            [InlineKeyboardButton("🧾 JSON Lines - آخر 12 شهراً", callback_data="exp_jsonl_12")],
+            [InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")]
+        ])
+    )
+
+@router.text("➕ زيادة أيام", access=routing.ADMIN)
+async def increase_days_menu(update, context, db_user):
+    users = await adb.get_approved_users()
+    keyboard = []
+    for u in users:
+        keyboard.append([InlineKeyboardButton(f"د.{u['full_name']} ({u['max_days']})", callback_data=f"inc_{u['user_id']}")])
+    keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")])
+    await update.message.reply_text("اختر طبيباً:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@router.text("➖ تقليل أيام", access=routing.ADMIN)
+async def decrease_days_menu(update, context, db_user):
+    users = await adb.get_approved_users()
+    keyboard = []
+    for u in users:
+        if u['max_days'] > 1:
+            keyboard.append([InlineKeyboardButton(f"د.{u['full_name']} ({u['max_days']})", callback_data=f"dec_{u['user_id']}")])
+    keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")])
+    await update.message.reply_text("اختر طبيباً:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@router.text("🔄 بدء شهر جديد", access=routing.ADMIN)
+async def new_month_menu(update, context, db_user):
+    month = db.get_current_month()
+    await update.message.reply_text(
+        f"⚠️ *بدء شهر جديد*\n\nسيتم تصفير جميع حجوزات شهر {month} ونقلها إلى الأرشيف\nهل أنت متأكد؟",
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ نعم", callback_data="reset_month"),
+             InlineKeyboardButton("❌ لا", callback_data="cancel")]
+        ])
+    )
+
+@router.text("🧾 المهام", access=routing.ADMIN)
+async def jobs_status(update, context, db_user):
+    recent = await adb.get_recent_jobs(JOBS_VIEW_LIMIT)
+    if not recent:
+        await update.message.reply_text("📭 لا توجد مهام")
+        return
     
-    elif text == "🔙 العودة للقائمة الرئيسية":
-        await update.message.reply_text("القائمة الرئيسية", reply_markup=get_main_keyboard(user_id))
-    
-    elif text == "👥 طلبات موافقة" and is_admin:
-        pending = db.get_pending_users()
-        if not pending:
-            await update.message.reply_text("✅ لا توجد طلبات جديدة")
-            return
-        
-        for p in pending:
+    msg = "🧾 آخر المهام\n\n"
+    keyboard = []
+    for job in recent:
+        msg += f"{JOB_STATUS_LABELS.get(job['status'], job['status'])} #{job['id']} {job['title']}"
+        if job['total']:
+            msg += f" ({job['progress']}/{job['total']})"
+        if job['result']:
+            msg += f"\n   ↳ {job['result']}"
+        elif job['error']:
+            msg += f"\n   ↳ {job['error']}"
+        msg += "\n"
+        if job['status'] in (db.JOB_QUEUED, db.JOB_RUNNING):
+            keyboard.append([InlineKeyboardButton(f"⛔ إلغاء #{job['id']}", callback_data=f"job_cancel_{job['id']}")])
+    
+    await update.message.reply_text(
+        msg,
+        reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+    )
+
+@router.text("📈 الأداء", access=routing.ADMIN)
+async def show_metrics(update, context, db_user):
+    await update.message.reply_text(format_metrics(context.application))
+
+@router.text("🐢 الاستعلامات", access=routing.ADMIN)
+async def show_query_report(update, context, db_user):
+    await update.message.reply_text(format_query_report())
+
+@metrics.timed_handler('command:metrics')
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """أمر /metrics للمشرف (نفس زر 📈 الأداء)"""
+    if tenants.is_admin(update.effective_user.id):
+        await show_metrics(update, context, None)
+
+# ==================== معالجة الإدخالات الخاصة ====================
+
+@router.state('awaiting_full_datetime', access=routing.ADMIN)
+async def scheduled_time_input(update, context, db_user):
+    text = update.message.text
+    try:
+        # دعم الصيغة YYYY/MM/DD HH:MM مع وقت غلق اختياري بعد " - "
+        parts = [p.strip() for p in text.strip().split(' - ')]
+        if len(parts) > 2:
+            raise ValueError(text)
+        scheduled_time = datetime.strptime(parts[0], "%Y/%m/%d %H:%M")
+        close_time = datetime.strptime(parts[1], "%Y/%m/%d %H:%M") if len(parts) == 2 else None
+        now = datetime.now()
+
+        if scheduled_time <= now:
             await update.message.reply_text(
-                f"🔔 *طلب موافقة*\n\n👤 {p['full_name']}\n🆔 `{p['user_id']}`",
-                parse_mode='Markdown',
-                reply_markup=InlineKeyboardMarkup([
-                    [
-                        InlineKeyboardButton("✅ موافقة", callback_data=f"app_{p['user_id']}"),
-                        InlineKeyboardButton("❌ رفض", callback_data=f"rej_{p['user_id']}")
-                    ]
-                ])
+                f"❌ يجب أن يكون الوقت في المستقبل!\nالوقت الحالي: {now.strftime('%Y/%m/%d %H:%M')}"
             )
-    
-    elif text == "📋 قائمة الأطباء" and is_admin:
-        users = db.get_approved_users()
-        if not users:
-            await update.message.reply_text("📭 لا يوجد أطباء مسجلين")
             return
-        
-        msg = "📋 *قائمة الأطباء*\n\n"
-        for u in users:
-            bookings = db.get_user_bookings(u['user_id'], db.get_current_month())
-            msg += f"• د.{u['full_name']}: {len(bookings)}/{u['max_days']}\n"
-        
-        await update.message.reply_text(msg, parse_mode='Markdown')
-    
-    elif text == "🗑 حذف مستخدم" and is_admin:
-        users = db.get_approved_users()
-        keyboard = []
-        for u in users:
-            if u['user_id'] != ADMIN_ID:
-                keyboard.append([InlineKeyboardButton(f"❌ د.{u['full_name']}", callback_data=f"deluser_{u['user_id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")])
-        await update.message.reply_text("⚠️ *حذف مستخدم*\n\nاختر:", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif text == "📊 إحصائيات" and is_admin:
-        stats = db.get_month_statistics()
-        msg = f"📊 *إحصائيات الشهر*\n\n"
-        msg += f"📅 الشهر: {stats['month']}\n"
-        msg += f"📆 أيام الشهر: {stats['month_days']}\n"
-        msg += f"✅ محجوز: {stats['booked_days']}\n"
-        msg += f"⬜ شاغر: {stats['free_days']}\n"
-        msg += f"👥 الأطباء: {stats['total_doctors']}\n"
-        msg += f"🔓 الحجز: {'مفتوح' if db.is_booking_open() else 'مغلق'}"
-        await update.message.reply_text(msg, parse_mode='Markdown')
-    
-    elif text == "🔓 فتح الحجز" and is_admin:
-        db.set_booking_open(True)
-        await update.message.reply_text("✅ *تم فتح الحجز*", parse_mode='Markdown')
-        
-        # إشعار سريع
-        users = db.get_approved_users()
-        for u in users:
-            if u['user_id'] != ADMIN_ID:
-                try:
-                    await context.bot.send_message(
-                        chat_id=u['user_id'],
-                        text="🔔 *تم فتح باب الحجز!*\n\nيمكنك الآن حجز مناوباتك.",
-                        parse_mode='Markdown'
-                    )
-                except:
-                    pass
-    
-    elif text == "🔒 غلق الحجز" and is_admin:
-        db.set_booking_open(False)
-        await update.message.reply_text("🔒 *تم غلق الحجز*", parse_mode='Markdown')
-    
-    elif text == "⏰ فتح مجدول" and is_admin:
+
+        if close_time and close_time <= scheduled_time:
+            await update.message.reply_text("❌ يجب أن يكون وقت الغلق بعد وقت الفتح!")
+            return
+
+        # المؤقتات المحفوظة تستبدل أي جدولة سابقة وتبقى بعد إعادة التشغيل
+        timer_service = context.bot_data['timers']
+        await timer_service.schedule('booking_open', 'open_booking', scheduled_time)
+        if close_time:
+            await timer_service.schedule('booking_close', 'close_booking', close_time)
+        elif not await is_preference_window_open():
+            # غلق نافذة الرغبات المفتوحة حالياً يبقى كما هو
+            await timer_service.cancel('booking_close')
+
+        # حفظ الوقت
+        await adb.set_scheduled_booking_time(scheduled_time.strftime("%Y/%m/%d %H:%M"))
+
+        # حساب الوقت المتبقي
+        diff = scheduled_time - now
+        hours = diff.seconds // 3600
+        minutes = (diff.seconds % 3600) // 60
+
         await update.message.reply_text(
-            "⏰ *فتح الحجز بتاريخ محدد*\n\n"
-            "أرسل التاريخ والوقت بهذه الصيغة:\n"
-            "`YYYY/MM/DD HH:MM`\n\n"
-            "مثال: `2026/03/15 09:00`\n"
-            "(15 مارس 2026 الساعة 9 صباحاً)",
+            f"✅ *تم جدولة فتح الحجز*\n\n"
+            f"📅 التاريخ: {scheduled_time.strftime('%Y/%m/%d')}\n"
+            f"⏰ الوقت: {scheduled_time.strftime('%H:%M')}\n"
+            f"⏳ متبقي: {diff.days} يوم و {hours} ساعة"
+            + (f"\n🔒 الغلق: {close_time.strftime('%Y/%m/%d %H:%M')}" if close_time else ""),
             parse_mode='Markdown'
         )
-        context.user_data['awaiting_full_datetime'] = True
-    
-    elif text == "📅 ضبط أيام الشهر" and is_admin:
-        current = db.get_month_days()
-        await update.message.reply_text(
-            f"📅 *عدد أيام الشهر الحالي: {current}*\n\n"
-            "أرسل الرقم الجديد (28-31):",
-            parse_mode='Markdown'
+
+        # إشعار للأطباء
+        await start_broadcast(
+            context, update.effective_user.id,
+            f"📅 *تم تحديد موعد فتح الحجز*\n\n"
+            f"📆 {scheduled_time.strftime('%Y/%m/%d')}\n"
+            f"⏰ {scheduled_time.strftime('%H:%M')}\n\n"
+            f"🔔 سيتم فتح الحجز تلقائياً.",
+            "إشعار موعد الحجز"
         )
-        context.user_data['awaiting_month_days'] = True
-    
-    elif text == "📢 إشعار جماعي" and is_admin:
+
+        context.user_data['awaiting_full_datetime'] = False
+
+    except ValueError:
         await update.message.reply_text(
-            "📢 *إرسال إشعار جماعي*\n\n"
-            "أرسل الرسالة التي تريد إرسالها لجميع الأطباء:",
+            "❌ صيغة خاطئة!\n"
+            "استخدم: `YYYY/MM/DD HH:MM`\n"
+            "مثال: `2026/03/15 09:00`",
             parse_mode='Markdown'
         )
-        context.user_data['awaiting_broadcast'] = True
-    
-    elif text == "📥 تصدير الجدول" and is_admin:
-        csv_data = export_to_csv()
-        month = db.get_current_month()
-        await update.message.reply_document(
-            document=csv_data.encode('utf-8'),
-            filename=f"mandoobat_{month}.csv",
-            caption=f"📊 جدول مناوبات شهر {month}"
-        )
-    
-    elif text == "➕ زيادة أيام" and is_admin:
-        users = db.get_approved_users()
-        keyboard = []
-        for u in users:
-            keyboard.append([InlineKeyboardButton(f"د.{u['full_name']} ({u['max_days']})", callback_data=f"inc_{u['user_id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")])
-        await update.message.reply_text("اختر طبيباً:", reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif text == "➖ تقليل أيام" and is_admin:
-        users = db.get_approved_users()
-        keyboard = []
-        for u in users:
-            if u['max_days'] > 1:
-                keyboard.append([InlineKeyboardButton(f"د.{u['full_name']} ({u['max_days']})", callback_data=f"dec_{u['user_id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")])
-        await update.message.reply_text("اختر طبيباً:", reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    elif text == "🔄 بدء شهر جديد" and is_admin:
-        month = db.get_current_month()
-        await update.message.reply_text(
-            f"⚠️ *بدء شهر جديد*\n\nسيتم حذف جميع حجوزات شهر {month}\nهل أنت متأكد؟",
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ نعم", callback_data="reset_month"),
-                 InlineKeyboardButton("❌ لا", callback_data="cancel")]
-            ])
-        )
-    
-    # ==================== معالجة الإدخالات الخاصة ====================
-    
-    elif context.user_data.get('awaiting_full_datetime') and is_admin:
+
+@router.state('awaiting_month_days', access=routing.ADMIN)
+async def month_days_input(update, context, db_user):
+    try:
+        days = int(update.message.text.strip())
+        if 28 <= days <= 31:
+            await adb.set_month_days(days)
+            await update.message.reply_text(f"✅ تم ضبط أيام الشهر إلى {days}")
+            context.user_data['awaiting_month_days'] = False
+        else:
+            await update.message.reply_text("❌ الرجاء إدخال رقم بين 28 و 31")
+    except ValueError:
+        await update.message.reply_text("❌ الرجاء إدخال رقم صحيح")
+
+@router.state('awaiting_broadcast', access=routing.ADMIN)
+async def broadcast_input(update, context, db_user):
+    message = update.message.text.strip()
+    context.user_data['awaiting_broadcast'] = False
+    await start_broadcast(
+        context, update.effective_user.id,
+        f"📢 *رسالة من المشرف*\n\n{message}",
+        "إشعار جماعي"
+    )
+
+# ==================== معالجة الموافقات ====================
+
+@router.callback('app_', access=routing.ADMIN)
+async def approve_request(update, context, db_user, arg):
+    query = update.callback_query
+    target = int(arg)
+    if await adb.approve_user(target):
+        await query.edit_message_text("✅ تمت الموافقة")
         try:
-            # دعم الصيغة YYYY/MM/DD HH:MM
-            scheduled_time = datetime.strptime(text.strip(), "%Y/%m/%d %H:%M")
-            now = datetime.now()
-            
-            if scheduled_time <= now:
-                await update.message.reply_text(
-                    f"❌ يجب أن يكون الوقت في المستقبل!\nالوقت الحالي: {now.strftime('%Y/%m/%d %H:%M')}"
-                )
-                return
-            
-            # حفظ الوقت
-            db.set_scheduled_booking_time(scheduled_time.strftime("%Y/%m/%d %H:%M"))
-            
-            # حساب الوقت المتبقي
-            diff = scheduled_time - now
-            hours = diff.seconds // 3600
-            minutes = (diff.seconds % 3600) // 60
-            
-            await update.message.reply_text(
-                f"✅ *تم جدولة فتح الحجز*\n\n"
-                f"📅 التاريخ: {scheduled_time.strftime('%Y/%m/%d')}\n"
-                f"⏰ الوقت: {scheduled_time.strftime('%H:%M')}\n"
-                f"⏳ متبقي: {diff.days} يوم و {hours} ساعة",
-                parse_mode='Markdown'
-            )
-            
-            # إشعار للأطباء
-            users = db.get_approved_users()
-            count = 0
-            for u in users:
-                if u['user_id'] != ADMIN_ID:
-                    try:
-                        await context.bot.send_message(
-                            chat_id=u['user_id'],
-                            text=f"📅 *تم تحديد موعد فتح الحجز*\n\n"
-                                 f"📆 {scheduled_time.strftime('%Y/%m/%d')}\n"
-                                 f"⏰ {scheduled_time.strftime('%H:%M')}\n\n"
-                                 f"🔔 سيتم فتح الحجز تلقائياً.",
-                            parse_mode='Markdown'
-                        )
-                        count += 1
-                    except:
-                        pass
-            
-            await update.message.reply_text(f"📢 تم إشعار {count} طبيب")
-            
-            # إعداد المؤقت
-            def open_booking():
-                try:
-                    db.set_booking_open(True)
-                    # إشعار المشرف
-                    context.bot.send_message(
-                        chat_id=ADMIN_ID,
-                        text="✅ *تم فتح الحجز تلقائياً*",
-                        parse_mode='Markdown'
-                    )
-                except:
-                    pass
-            
-            timer = threading.Timer(diff.total_seconds(), open_booking)
-            timer.daemon = True
-            timer.start()
-            
-            context.user_data['awaiting_full_datetime'] = False
-            
-        except ValueError:
-            await update.message.reply_text(
-                "❌ صيغة خاطئة!\n"
-                "استخدم: `YYYY/MM/DD HH:MM`\n"
-                "مثال: `2026/03/15 09:00`",
-                parse_mode='Markdown'
+            await context.bot.send_message(
+                chat_id=target,
+                text="✅ *تمت الموافقة على طلبك!*\n\nيمكنك استخدام البوت الآن.",
+                parse_mode='Markdown',
+                reply_markup=get_main_keyboard(target)
             )
-    
-    elif context.user_data.get('awaiting_month_days') and is_admin:
-        try:
-            days = int(text.strip())
-            if 28 <= days <= 31:
-                db.set_month_days(days)
-                await update.message.reply_text(f"✅ تم ضبط أيام الشهر إلى {days}")
-                context.user_data['awaiting_month_days'] = False
-            else:
-                await update.message.reply_text("❌ الرجاء إدخال رقم بين 28 و 31")
-        except ValueError:
-            await update.message.reply_text("❌ الرجاء إدخال رقم صحيح")
-    
-    elif context.user_data.get('awaiting_broadcast') and is_admin:
-        message = text.strip()
-        users = db.get_approved_users()
-        success = 0
-        
-        await update.message.reply_text("📤 جاري الإرسال...")
-        
-        for u in users:
-            if u['user_id'] != ADMIN_ID:
-                try:
-                    await context.bot.send_message(
-                        chat_id=u['user_id'],
-                        text=f"📢 *رسالة من المشرف*\n\n{message}",
-                        parse_mode='Markdown'
-                    )
-                    success += 1
-                except:
-                    pass
-        
-        await update.message.reply_text(f"✅ تم الإرسال لـ {success} طبيب")
-        context.user_data['awaiting_broadcast'] = False
+        except TelegramError as e:
+            logger.warning("تعذر إبلاغ المستخدم %s بالموافقة: %s", target, e)
+    else:
+        await query.edit_message_text("❌ فشل الموافقة")
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالج الأزرار"""
+@router.callback('rej_', access=routing.ADMIN)
+async def reject_request(update, context, db_user, arg):
+    await adb.reject_user(int(arg))
+    await update.callback_query.edit_message_text("❌ تم الرفض")
+
+# ==================== معالجة الحجوزات ====================
+
+@router.callback('book_')
+async def book(update, context, db_user, arg):
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    data = query.data
-    is_admin = (user_id == ADMIN_ID)
-    
-    # ==================== معالجة الموافقات ====================
-    
-    if data.startswith('app_') and is_admin:
-        target = int(data.split('_')[1])
-        if db.approve_user(target):
-            await query.edit_message_text("✅ تمت الموافقة")
-            try:
-                await context.bot.send_message(
-                    chat_id=target,
-                    text="✅ *تمت الموافقة على طلبك!*\n\nيمكنك استخدام البوت الآن.",
-                    parse_mode='Markdown',
-                    reply_markup=get_main_keyboard(target)
-                )
-            except:
-                pass
-        else:
-            await query.edit_message_text("❌ فشل الموافقة")
-    
-    elif data.startswith('rej_') and is_admin:
-        target = int(data.split('_')[1])
-        db.reject_user(target)
-        await query.edit_message_text("❌ تم الرفض")
-    
-    # ==================== معالجة الحجوزات ====================
-    
-    elif data.startswith('book_'):
-        day = int(data.split('_')[1])
-        db_user = db.get_user(user_id)
-        
-        if not db_user or db_user['approved'] != 1:
-            await query.edit_message_text("❌ ليس لديك صلاحية")
-            return
-        
-        if not db.is_booking_open() and not is_admin:
-            await query.edit_message_text("🔒 الحجز مغلق حالياً")
-            return
-        
-        success, msg = db.book_day(user_id, day)
-        await query.edit_message_text(msg)
-        
-        if success:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=f"📌 *حجز جديد*\n\nد.{db_user['full_name']} حجز يوم {day}",
-                parse_mode='Markdown'
-            )
-    
-    # ==================== معالجة حذف الحجوزات ====================
-    
-    elif data.startswith('del_'):
-        day = int(data.split('_')[1])
-        if db.cancel_booking(day, db.get_current_month(), user_id):
-            await query.edit_message_text(f"✅ تم حذف حجز يوم {day}")
-        else:
-            await query.edit_message_text("❌ فشل حذف الحجز")
-    
-    elif data == "show_delete":
-        month = db.get_current_month()
-        bookings = db.get_user_bookings(user_id, month)
-        if not bookings:
-            await query.edit_message_text("📭 لا توجد حجوزات")
-            return
-        
-        keyboard = []
-        for b in bookings:
-            keyboard.append([InlineKeyboardButton(f"❌ حذف يوم {b['day']}", callback_data=f"del_{b['day']}")])
-        keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")])
-        await query.edit_message_text("🗑 *حذف حجز*\nاختر:", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
-    
-    # ==================== معالجة إدارة المستخدمين ====================
-    
-    elif data.startswith('deluser_') and is_admin:
-        target = int(data.split('_')[1])
-        db.delete_user(target)
-        await query.edit_message_text("✅ تم حذف المستخدم")
-    
-    elif data.startswith('inc_') and is_admin:
-        target = int(data.split('_')[1])
-        user = db.get_user(target)
-        if user:
-            db.update_user_max_days(target, user['max_days'] + 1)
-            await query.edit_message_text(f"✅ تمت الزيادة إلى {user['max_days'] + 1}")
-    
-    elif data.startswith('dec_') and is_admin:
-        target = int(data.split('_')[1])
-        user = db.get_user(target)
-        if user and user['max_days'] > 1:
-            db.update_user_max_days(target, user['max_days'] - 1)
-            await query.edit_message_text(f"✅ تم التقليل إلى {user['max_days'] - 1}")
-    
-    # ==================== معالجة الإعدادات ====================
-    
-    elif data == "reset_month" and is_admin:
-        db.reset_month()
-        await query.edit_message_text("✅ تم تصفير الشهر")
-    
-    elif data == "cancel":
-        await query.edit_message_text("✅ تم الإلغاء")
-    
-    elif data == "cancel_booking":
-        await query.edit_message_text("✅ تم إلغاء عملية الحجز")
+    day = int(arg)
+
+    if not await adb.is_booking_open() and not tenants.is_admin(user_id):
+        await query.edit_message_text("🔒 الحجز مغلق حالياً")
+        return
+    # أزرار حجز قديمة بعد التحول لنمط الرغبات
+    if await is_preference_window_open() and not tenants.is_admin(user_id):
+        await query.edit_message_text("🗳 الحجز الآن بتسجيل الرغبات - اضغط «📅 حجز مناوبة» من جديد")
+        return
+
+    result = await adb.book_day(user_id, day)
+    await query.edit_message_text(result.message)
+
+    if result.ok:
+        await notify_admins(
+            context.bot,
+            f"📌 *حجز جديد*\n\nد.{db_user['full_name']} حجز يوم {day}",
+            parse_mode='Markdown'
+        )
+
+@router.callback('pref_clear')
+async def clear_preferences(update, context, db_user):
+    await adb.clear_preferences(update.callback_query.from_user.id)
+    await show_preferences(update, context, "🧹 تم مسح رغباتك")
+
+@router.callback('pref_done')
+async def preferences_done(update, context, db_user):
+    days = await adb.get_preferences(update.callback_query.from_user.id)
+    await update.callback_query.edit_message_text(
+        f"✅ تم حفظ رغباتك: {', '.join(map(str, days))}\nستصلك النتيجة بعد غلق التسجيل."
+        if days else "📭 لم تسجل أي رغبة"
+    )
+
+@router.callback('pref_')
+async def toggle_preference(update, context, db_user, arg):
+    query = update.callback_query
+    if not await is_preference_window_open():
+        await query.edit_message_text("🔒 تسجيل الرغبات مغلق حالياً")
+        return
+    result = await adb.toggle_preference(query.from_user.id, int(arg))
+    await show_preferences(update, context, result.message)
+
+async def show_preferences(update, context, notice):
+    """إعادة عرض لوحة الرغبات بعد تعديلها مع سطر النتيجة"""
+    keyboard, header = await get_preferences_keyboard(
+        update.callback_query.from_user.id, get_window_close_time(context.application)
+    )
+    try:
+        await update.callback_query.edit_message_text(
+            f"{notice}\n\n{header}", parse_mode='Markdown', reply_markup=keyboard
+        )
+    except BadRequest as e:
+        # نفس الرفض مرتين (مثلاً الحد الأقصى) لا يغير الرسالة
+        if 'not modified' not in str(e):
+            raise
+
+@router.callback('cancel_booking', access=routing.ANYONE)
+async def cancel_booking_choice(update, context, db_user):
+    await update.callback_query.edit_message_text("✅ تم إلغاء عملية الحجز")
+
+# ==================== معالجة حذف الحجوزات ====================
+
+@router.callback('del_', access=routing.ANYONE)
+async def delete_booking(update, context, db_user, arg):
+    query = update.callback_query
+    day = int(arg)
+    if await adb.cancel_booking(day, db.get_current_month(), query.from_user.id):
+        await query.edit_message_text(f"✅ تم حذف حجز يوم {day}")
+    else:
+        await query.edit_message_text("❌ فشل حذف الحجز")
+
+@router.callback('show_delete', access=routing.ANYONE)
+async def delete_booking_menu(update, context, db_user):
+    query = update.callback_query
+    month = db.get_current_month()
+    bookings = await adb.get_user_bookings(query.from_user.id, month)
+    if not bookings:
+        await query.edit_message_text("📭 لا توجد حجوزات")
+        return
+
+    keyboard = []
+    for b in bookings:
+        keyboard.append([InlineKeyboardButton(f"❌ حذف يوم {b['day']}", callback_data=f"del_{b['day']}")])
+    keyboard.append([InlineKeyboardButton("🔙 إلغاء", callback_data="cancel")])
+    await query.edit_message_text("🗑 *حذف حجز*\nاختر:", parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+# ==================== معالجة التصدير ====================
+
+@router.callback('exp_', access=routing.ADMIN)
+async def export_schedule(update, context, db_user, arg):
+    query = update.callback_query
+    fmt, months = arg.split('_')
+    user_id = query.from_user.id
+    job_id = await context.bot_data['jobs'].submit(
+        'export', f"تصدير {fmt.upper()} - {months} شهر",
+        {'chat_id': user_id, 'fmt': fmt, 'months': int(months)},
+        created_by=user_id
+    )
+    await query.edit_message_text(f"⏳ جاري التصدير... (مهمة #{job_id})\nسيصلك الملف عند انتهائه.")
+
+@router.callback('my_ics')
+async def export_my_calendar(update, context, db_user):
+    user_id = update.callback_query.from_user.id
+    await context.bot_data['jobs'].submit(
+        'export', "ملف التقويم",
+        {'chat_id': user_id, 'fmt': 'ics', 'months': 12, 'user_id': user_id},
+        created_by=user_id
+    )
+
+# ==================== معالجة المهام الخلفية ====================
+
+@router.callback('job_cancel_', access=routing.ADMIN)
+async def cancel_job(update, context, db_user, arg):
+    if not context.bot_data['jobs'].cancel(int(arg)):
+        await update.callback_query.edit_message_text("ℹ️ انتهت المهمة مسبقاً")
+
+# ==================== معالجة إدارة المستخدمين ====================
+
+@router.callback('deluser_', access=routing.ADMIN)
+async def delete_user(update, context, db_user, arg):
+    target = int(arg)
+    await adb.delete_user(target)
+    context.application.drop_user_data(target)
+    await update.callback_query.edit_message_text("✅ تم حذف المستخدم")
+
+@router.callback('inc_', access=routing.ADMIN)
+async def increase_days(update, context, db_user, arg):
+    target = int(arg)
+    user = await adb.get_user(target)
+    if user:
+        await adb.update_user_max_days(target, user['max_days'] + 1)
+        await update.callback_query.edit_message_text(f"✅ تمت الزيادة إلى {user['max_days'] + 1}")
+
+@router.callback('dec_', access=routing.ADMIN)
+async def decrease_days(update, context, db_user, arg):
+    target = int(arg)
+    user = await adb.get_user(target)
+    if user and user['max_days'] > 1:
+        await adb.update_user_max_days(target, user['max_days'] - 1)
+        await update.callback_query.edit_message_text(f"✅ تم التقليل إلى {user['max_days'] - 1}")
+
+# ==================== معالجة الإعدادات ====================
+
+@router.callback('mode_', access=routing.ADMIN)
+async def set_booking_mode(update, context, db_user, arg):
+    query = update.callback_query
+    # تغيير النمط أثناء الفتح يترك رغبات بلا توزيع أو حجوزات خارج النافذة
+    if await adb.is_booking_open():
+        await query.edit_message_text("⚠️ أغلق الحجز أولاً ثم غيّر النمط")
+        return
+    await adb.set_booking_mode(arg)
+    await query.edit_message_text(f"✅ نمط الحجز: {BOOKING_MODE_LABELS[arg]}")
+
+@router.callback('reset_month', access=routing.ADMIN)
+async def reset_month(update, context, db_user):
+    archived = await adb.reset_month()
+    archived += await adb.archive_closed_months()
+    await update.callback_query.edit_message_text(f"✅ تم تصفير الشهر\n🗄 نُقل {archived} حجز إلى الأرشيف")
+
+@router.callback('cancel', access=routing.ANYONE)
+async def cancel(update, context, db_user):
+    await update.callback_query.edit_message_text("✅ تم الإلغاء")
 
 # ==================== تشغيل البوت ====================
 
+async def before_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """قبل بقية المعالجات (المجموعة -1): تفعيل قسم التطبيق وتسجيل النشاط"""
+    tenants.activate(context.bot_data['tenant'])
+    if update.effective_user is not None:
+        activity.buffer.touch(update.effective_user.id)
+
+async def on_startup(app):
+    """تشغيل المهام الخلفية على حلقة أحداث البوت"""
+    # المهام المنشأة هنا ترث القسم فتعمل على قاعدته
+    tenants.activate(app.bot_data['tenant'])
+    await adb.init_db()
+    
+    # إبقاء جدول الحجوزات الحي صغيراً: الأشهر المنتهية تُنقل للأرشيف
+    await adb.archive_closed_months()
+    
+    # مهام قطعها توقف البوت السابق لن تكتمل - تُعلَّم ويُبلَّغ المشرف
+    interrupted = await adb.mark_interrupted_jobs()
+    if interrupted:
+        await notify_admins(app.bot, f"⚠️ {interrupted} مهمة توقفت بسبب إعادة تشغيل البوت (انظر 🧾 المهام)")
+    
+    job_runner = jobs.JobRunner(app)
+    job_runner.register('broadcast', broadcast_job)
+    job_runner.register('export', export_job)
+    job_runner.register('allocation', allocation_job)
+    app.bot_data['jobs'] = job_runner
+    
+    # التطبيق لم يبدأ بعد (post_init) فتُنشأ المهام على الحلقة مباشرة وتُلغى في on_shutdown
+    background_tasks = app.bot_data['background_tasks'] = []
+    background_tasks.append(asyncio.create_task(refresh_settings_loop()))
+    background_tasks.append(asyncio.create_task(reminders.reminder_loop(app.bot)))
+    background_tasks.append(asyncio.create_task(evict_user_data_loop(app)))
+    background_tasks.append(asyncio.create_task(activity.buffer.run()))
+    
+    timer_service = timers.TimerService(app)
+    timer_service.register('open_booking', open_booking_timer)
+    timer_service.register('close_booking', close_booking_timer)
+    app.bot_data['timers'] = timer_service
+    background_tasks.append(await timer_service.start())
+    
+    # خادم المقاييس واحد للعملية: يشغله أول قسم ويوقفه عند إيقافه
+    if config.METRICS_PORT:
+        app.bot_data['metrics_server'] = await metrics.start_http_server(
+            config.METRICS_LISTEN, config.METRICS_PORT
+        )
+
+async def on_stop(app):
+    """قطع المهام الطويلة بعد توقف استقبال التحديثات وقبل إغلاق اتصال البوت"""
+    job_runner = app.bot_data.get('jobs')
+    if job_runner is not None:
+        await job_runner.stop()
+
+async def on_shutdown(app):
+    """إيقاف المهام الخلفية وإغلاق مجمع اتصالات القسم - بعد app.shutdown() الذي يحفظ بيانات المستخدمين"""
+    for task in app.bot_data.pop('background_tasks', []):
+        task.cancel()
+    await activity.buffer.flush(app.bot_data['tenant'].db_path)
+    if app.bot_data.pop('metrics_server', False):
+        await metrics.stop_http_server()
+    db.close_pool(app.bot_data['tenant'].db_path)
+
+# أنواع التحديثات التي نعالجها فقط (تيليجرام لا يرسل غيرها)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+def build_application(tenant=None, request_factory=None):
+    """إنشاء تطبيق البوت لقسم (الافتراضي إذا لم يُحدد) مع جميع المعالجات
+
+    request_factory: دالة تنشئ BaseRequest بديلاً (لتشغيل البوت دون اتصال في الأدوات)
+    """
+    tenant = tenant or tenants.default_tenant()
+    builder = (
+        Application.builder()
+        .token(tenant.token)
+        .concurrent_updates(update_processor.UserOrderedUpdateProcessor(config.CONCURRENT_UPDATES))
+        .persistence(persistence.SqlitePersistence(tenant.db_path))
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if config.BOT_API_URL:
+        api_url = config.BOT_API_URL.rstrip('/')
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    if request_factory is None:
+        # نفس أحجام مجمع الاتصالات الافتراضية للمكتبة، مع قياس كل طلب
+        builder = builder.request(metrics.InstrumentedRequest(connection_pool_size=256)) \
+            .get_updates_request(metrics.InstrumentedRequest(connection_pool_size=1))
+    else:
+        builder = builder.request(request_factory()).get_updates_request(request_factory())
+    app = builder.build()
+    app.bot_data['tenant'] = tenant
+    # مفتاح لكل قسم: بناء تطبيق القسم مرة أخرى يستبدل مجمّعه بدلاً من تكرار سلاسله
+    metrics.register_collector(lambda: app_metrics(app), key=('app', tenant.name))
+
+    app.add_handler(TypeHandler(Update, before_update), group=-1)
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("metrics", metrics_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(CallbackQueryHandler(button_handler))
+    app.add_error_handler(on_error)
+    return app
+
+def webhook_options(index, tenant, shared):
+    """إعدادات webhook للقسم: مع عدة أقسام لكل قسم منفذ ومسار خاص"""
+    if not config.WEBHOOK_URL or not config.WEBHOOK_SECRET:
+        raise ValueError("وضع webhook يحتاج WEBHOOK_URL و WEBHOOK_SECRET")
+    url_path = f"{config.WEBHOOK_PATH}/{tenant.name}" if shared else config.WEBHOOK_PATH
+    return dict(
+        listen=config.WEBHOOK_LISTEN,
+        port=config.WEBHOOK_PORT + index,
+        url_path=url_path,
+        webhook_url=f"{config.WEBHOOK_URL.rstrip('/')}/{url_path}",
+        secret_token=config.WEBHOOK_SECRET,
+        allowed_updates=ALLOWED_UPDATES
+    )
+
+async def serve_tenants(apps):
+    """تشغيل تطبيقات عدة أقسام على حلقة أحداث واحدة حتى إشارة الإيقاف"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    started = []
+    try:
+        for index, app in enumerate(apps):
+            # مهام التطبيق (جلب التحديثات والمهام الخلفية) ترث قسمه
+            with tenants.use(app.bot_data['tenant']):
+                await app.initialize()
+                await on_startup(app)
+                started.append(app)
+                if config.BOT_MODE == 'webhook':
+                    await app.updater.start_webhook(**webhook_options(index, app.bot_data['tenant'], True))
+                else:
+                    await app.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+                await app.start()
+        await stop.wait()
+    finally:
+        for app in reversed(started):
+            with tenants.use(app.bot_data['tenant']):
+                if app.updater.running:
+                    await app.updater.stop()
+                if app.running:
+                    await app.stop()
+                # بنفس ترتيب run_polling: المجمع يُغلق بعد حفظ الحالة في app.shutdown()
+                await on_stop(app)
+                await app.shutdown()
+                await on_shutdown(app)
+
+def run_application(apps):
+    """تشغيل البوت بالطريقة المحددة في الإعدادات (polling أو webhook)"""
+    try:
+        if len(apps) > 1:
+            asyncio.run(serve_tenants(apps))
+        elif config.BOT_MODE == 'webhook':
+            apps[0].run_webhook(**webhook_options(0, apps[0].bot_data['tenant'], False))
+        else:
+            apps[0].run_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        adb.shutdown()
+
 def main():
     """الدالة الرئيسية لتشغيل البوت"""
     print("=" * 50)
     print("🤖 بوت إدارة المناوبات - النسخة النهائية")
     print("=" * 50)
-    print(f"📱 معرف المشرف: {ADMIN_ID}")
+    departments = tenants.load_tenants()
+    for tenant in departments:
+        admins = ', '.join(map(str, sorted(tenant.admin_ids)))
+        print(f"🏥 القسم: {tenant.name} | 📱 المشرفون: {admins}")
+    print(f"📡 طريقة الاستقبال: {config.BOT_MODE}")
     print("=" * 50)
     print("🚀 جاري تشغيل البوت...")
     
     try:
-        app = Application.builder().token(TOKEN).build()
-        
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        app.add_handler(CallbackQueryHandler(button_handler))
-        
-        # تشغيل التذكيرات في خيط منفصل
-        schedule_reminders(app)
+        apps = [build_application(tenant) for tenant in departments]
         
         print("✅ البوت يعمل بنجاح!")
         print("=" * 50)
@@ -782,7 +1424,7 @@ def main():
         print("  ✓ واجهة عربية جميلة")
         print("=" * 50)
         
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        run_application(apps)
         
     except Exception as e:
         print(f"❌ خطأ: {e}")
@@ -0,0 +1,315 @@
+# metrics.py - مقاييس الأداء: مدرجات زمنية وعدادات أخطاء ومقاييس لحظية
+#
+# المعالجات (routing.py)، ودوال القاعدة (adb.run)، وطلبات Bot API
+# (InstrumentedRequest)، والإرسال (broadcast.deliver) تسجّل هنا. القيم اللحظية
+# من المكونات الأخرى (طابور التحديثات، ذاكرة المستخدمين، ...) تُقرأ عند الطلب عبر
+# دوال مسجلة بـ register_collector. تُعرض:
+#   - بصيغة Prometheus النصية على GET /metrics (start_http_server، محلياً فقط)
+#   - ملخصاً للمشرف في البوت (main.show_metrics)
+
+import asyncio
+import bisect
+import functools
+import logging
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# حدود فئات المدرجات الزمنية (بالثواني)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_registry = {}
+# {المفتاح: الدالة} - التسجيل بنفس المفتاح يستبدل السابقة
+_collectors = {}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        # {التسميات مرتبة: القيمة}
+        self._series = {}
+        with _lock:
+            if name in _registry:
+                raise ValueError(f"مقياس مكرر: {name}")
+            _registry[name] = self
+
+    def samples(self):
+        """[(اسم السطر، التسميات، القيمة)] بصيغة Prometheus"""
+        with _lock:
+            return [(self.name, dict(key), value) for key, value in self._series.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with _lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def total(self, **labels):
+        """مجموع السلاسل المطابقة للتسميات المعطاة"""
+        with _lock:
+            return sum(
+                value for key, value in self._series.items()
+                if all(item in key for item in labels.items())
+            )
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self._series[_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _key(labels)
+        with _lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _key(labels)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                # [عدد كل فئة ... فئة +Inf، المجموع، العدد]
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        result = []
+        with _lock:
+            series = [(dict(key), list(values)) for key, values in self._series.items()]
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                result.append((f"{self.name}_bucket", {**labels, 'le': le}, cumulative))
+            result.append((f"{self.name}_sum", labels, values[-2]))
+            result.append((f"{self.name}_count", labels, values[-1]))
+        return result
+
+    def summary(self, quantile=0.95):
+        """[(التسميات، العدد، المتوسط بالثواني، الشريحة التقريبية)] لكل سلسلة"""
+        with _lock:
+            series = [(dict(key), list(values)) for key, values in self._series.items()]
+        result = []
+        for labels, values in series:
+            count = values[-1]
+            if count:
+                result.append((labels, count, values[-2] / count, self._quantile(values, quantile)))
+        return result
+
+    def _quantile(self, values, quantile):
+        # تقريب خطي داخل الفئة التي تقع فيها الشريحة
+        target = quantile * values[-1]
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, values):
+            if count and cumulative + count >= target:
+                return lower + (bound - lower) * (target - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+
+def register_collector(callback, key=None):
+    """دالة تعيد [(اسم مقياس لحظي، التسميات، القيمة)] تُستدعى عند كل قراءة
+
+    key: مفتاح التسجيل (الدالة نفسها افتراضياً)؛ إعادة التسجيل بنفس المفتاح
+    تستبدل الدالة السابقة بدلاً من تكرار نفس السلاسل
+    """
+    with _lock:
+        _collectors[callback if key is None else key] = callback
+
+
+# ==================== المقاييس ====================
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "زمن تنفيذ معالجات البوت حسب المسار")
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "استثناءات المعالجات حسب المسار ونوع الخطأ")
+HANDLERS_IN_FLIGHT = Gauge('bot_handlers_in_flight', "المعالجات قيد التنفيذ")
+
+DB_SECONDS = Histogram('bot_db_call_seconds', "زمن دوال القاعدة (شاملاً انتظار الخيط العامل)")
+DB_ERRORS = Counter('bot_db_call_errors_total', "استثناءات دوال القاعدة")
+DB_IN_FLIGHT = Gauge('bot_db_calls_in_flight', "استدعاءات القاعدة قيد التنفيذ")
+
+API_SECONDS = Histogram('bot_api_request_seconds', "زمن طلبات Bot API حسب الدالة")
+API_ERRORS = Counter('bot_api_errors_total', "طلبات Bot API الفاشلة حسب الدالة ورمز الحالة أو الخطأ")
+API_IN_FLIGHT = Gauge('bot_api_requests_in_flight', "طلبات Bot API قيد التنفيذ")
+
+DELIVERIES = Counter('bot_deliveries_total', "رسائل التذكير والإرسال الجماعي حسب النتيجة")
+UPDATE_ERRORS = Counter('bot_update_errors_total', "تحديثات انتهت باستثناء غير معالج")
+
+# ==================== القياس ====================
+
+class timed:
+    """قياس زمن وأخطاء كتلة async في مدرج ومع مقياس قيد التنفيذ
+
+        async with metrics.timed(metrics.DB_SECONDS, metrics.DB_ERRORS, metrics.DB_IN_FLIGHT, function=name):
+            ...
+    """
+
+    __slots__ = ('histogram', 'errors', 'in_flight', 'labels', '_start')
+
+    def __init__(self, histogram, errors, in_flight, **labels):
+        self.histogram = histogram
+        self.errors = errors
+        self.in_flight = in_flight
+        self.labels = labels
+
+    async def __aenter__(self):
+        self.in_flight.inc()
+        self._start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self._start, **self.labels)
+        self.in_flight.dec()
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.errors.inc(**self.labels, error=exc_type.__name__)
+        return False
+
+
+def timed_handler(route):
+    """مزخرف لمعالج خارج جدول المسارات (مثل أوامر /start) ليُقاس كالمسارات"""
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            async with timed(HANDLER_SECONDS, HANDLER_ERRORS, HANDLERS_IN_FLIGHT, route=route):
+                return await handler(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest يقيس زمن كل طلب Bot API وأخطاءه"""
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        endpoint = url.rsplit('/', 1)[-1]
+        API_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **timeouts)
+        except Exception as e:
+            API_ERRORS.inc(method=endpoint, error=type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, method=endpoint)
+            API_IN_FLIGHT.dec()
+        if not 200 <= code <= 299:
+            API_ERRORS.inc(method=endpoint, error=str(code))
+        return code, payload
+
+# ==================== العرض ====================
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def collect():
+    """القيم اللحظية من الدوال المسجلة: {الاسم: [(التسميات، القيمة)]}"""
+    gathered = {}
+    with _lock:
+        callbacks = list(_collectors.values())
+    for callback in callbacks:
+        try:
+            for name, labels, value in callback():
+                gathered.setdefault(name, []).append((labels, value))
+        except Exception:
+            logger.exception("فشل جمع المقاييس من %r", callback)
+    return gathered
+
+
+def render_prometheus():
+    """كل المقاييس بصيغة Prometheus النصية"""
+    lines = []
+    with _lock:
+        metrics = list(_registry.values())
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name, samples in collect().items():
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+# ==================== خادم HTTP ====================
+
+_server = None
+
+
+async def _handle_http(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # تجاهل الترويسات
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?', 1)[0] == '/metrics':
+            status, body = '200 OK', render_prometheus().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(host, port):
+    """تشغيل GET /metrics على حلقة الأحداث الحالية - يعيد False إذا كان يعمل مسبقاً"""
+    global _server
+    if _server is not None:
+        return False
+    _server = await asyncio.start_server(_handle_http, host, port)
+    logger.info("المقاييس على http://%s:%s/metrics", host, port)
+    return True
+
+
+async def stop_http_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,183 @@
+# persistence.py - حفظ حالة المحادثة (context.user_data) في sqlite
+#
+# حالات مثل awaiting_name و awaiting_broadcast كانت تضيع عند إعادة التشغيل. هذه
+# الطبقة تنفذ واجهة BasePersistence لمكتبة تيليجرام لحفظ user_data فقط:
+#   - الكتابة مؤجلة: المكتبة تسلّم البيانات المعدلة كل UPDATE_INTERVAL ثانية،
+#     وكل ما يصل في نفس الدورة يُكتب في معاملة واحدة (executemany)
+#   - التحميل عند الحاجة: لا شيء يُحمَّل عند البدء؛ بيانات المستخدم تُقرأ من
+#     القاعدة قبل أول معالج يخصه (refresh_user_data)
+#   - الإخلاء: بيانات من لم يتفاعل منذ USER_DATA_TTL، أو الأقدم استخداماً عند
+#     تجاوز MAX_CACHED_USERS، تُحذف من الذاكرة وتبقى في القاعدة
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import adb
+import db
+
+logger = logging.getLogger(__name__)
+
+# فترة تسليم البيانات المعدلة من المكتبة (بالثواني)
+UPDATE_INTERVAL = 30
+
+# بيانات المستخدم الخامل أطول من هذا تُخلى من الذاكرة (بالثواني)
+USER_DATA_TTL = 30 * 60
+
+# أقصى عدد مستخدمين في الذاكرة
+MAX_CACHED_USERS = 5000
+
+
+class SqlitePersistence(BasePersistence):
+    """حفظ context.user_data في جدول user_state بقاعدة القسم"""
+
+    def __init__(self, db_path, update_interval=UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db_path = db_path
+        # المستخدمون المحمَّلون في الذاكرة بترتيب آخر استخدام: {user_id: وقت آخر استخدام}
+        self._loaded = OrderedDict()
+        # بيانات بانتظار الكتابة: {user_id: JSON أو None للحذف}
+        self._dirty = {}
+        self._flush_task = None
+        # مستخدمون أُخلوا من الذاكرة (drop_user_data القادم لا يحذفهم من القاعدة)
+        self._evicted = set()
+        self._app = None
+        self.loads = 0
+        self.evictions = 0
+
+    async def _call(self, func, *args):
+        # المكتبة تستدعي هذه الدوال من مهامها، فنحدد قاعدة القسم صراحة
+        with db.use_database(self.db_path):
+            return await adb.run(func, *args)
+
+    # ==================== user_data ====================
+
+    async def get_user_data(self):
+        # التحميل عند الحاجة في refresh_user_data بدلاً من تحميل الجميع عند البدء
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded:
+            self._loaded[user_id] = time.monotonic()
+            self._loaded.move_to_end(user_id)
+            return
+        data = self._dirty.get(user_id, False)
+        if data is False:
+            data = await self._call(db.get_user_state, user_id)
+        if data:
+            user_data.update(json.loads(data))
+        self._loaded[user_id] = time.monotonic()
+        self.loads += 1
+
+    async def update_user_data(self, user_id, data):
+        try:
+            self._dirty[user_id] = json.dumps(data, ensure_ascii=False) if data else None
+        except (TypeError, ValueError):
+            logger.warning("بيانات المستخدم %s غير قابلة للحفظ: %r", user_id, data)
+            return
+        # كل التحديثات في نفس دورة المكتبة تُجمع في كتابة واحدة بعدها
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_soon())
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._evicted:
+            self._evicted.discard(user_id)
+            # المكتبة تتجاهل تعديلات نفس الدورة لمن طُلب حذفه؛ إذا عاد المستخدم بعد
+            # الإخلاء نحفظ بياناته الحالية بأنفسنا
+            if user_id in self._loaded and self._app is not None:
+                await self.update_user_data(user_id, dict(self._app.user_data.get(user_id, {})))
+            return
+        self._loaded.pop(user_id, None)
+        self._dirty[user_id] = None
+        await self.flush()
+
+    async def _flush_soon(self):
+        await asyncio.sleep(0)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """كتابة كل البيانات المعدلة في معاملة واحدة"""
+        if not self._dirty:
+            return
+        states, self._dirty = list(self._dirty.items()), {}
+        try:
+            await self._call(db.save_user_states, states)
+        except Exception:
+            # إعادتها للكتابة في الدورة التالية دون استبدال ما هو أحدث
+            for user_id, data in states:
+                self._dirty.setdefault(user_id, data)
+            raise
+
+    # ==================== الإخلاء ====================
+
+    async def evict_idle(self, app, now=None):
+        """إخلاء بيانات الخاملين من ذاكرة التطبيق - يعيد عدد من أُخلوا"""
+        self._app = app
+        await self.flush()
+        now = time.monotonic() if now is None else now
+        # لا نُخلي من استُخدم خلال دورتي تسليم (قد تكون تعديلاته لم تُسلَّم بعد)
+        safe_before = now - 2 * self.update_interval
+        evict = []
+        excess = len(self._loaded) - MAX_CACHED_USERS
+        for user_id, seen in self._loaded.items():
+            if seen > safe_before:
+                break
+            if seen < now - USER_DATA_TTL or len(evict) < excess:
+                evict.append(user_id)
+        for user_id in evict:
+            del self._loaded[user_id]
+            self._evicted.add(user_id)
+            app.drop_user_data(user_id)
+        self.evictions += len(evict)
+        return len(evict)
+
+    def get_stats(self):
+        return {
+            'cached_users': len(self._loaded),
+            'pending_writes': len(self._dirty),
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
+
+    # ==================== بيانات غير محفوظة ====================
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,218 @@
+# querytrace.py - تتبع زمن جمل SQL والتقاط خطة الاستعلامات البطيئة
+#
+# اتصالات المجمع في db.py تعيد مؤشرات TracedCursor: كل جملة تُقاس، وتُجمع
+# إحصائياتها تحت نصها الموحَّد (مسافات مضغوطة، قيم حرفية وقوائم IN (?, ?, ...)
+# مستبدلة)، فتظهر الجملة الواحدة سطراً واحداً مهما تغيرت معاملاتها. الجملة
+# الأبطأ من SLOW_QUERY_MS تُحفظ في سجل دائري مع EXPLAIN QUERY PLAN الخاص بها
+# (يُلتقط مرة لكل جملة موحدة كل PLAN_REFRESH_SECONDS).
+#
+# الزمن المقاس هو زمن execute (أول خطوة، وفيها يتم الفرز والتجميع) مضافاً إليه
+# زمن القراءة اللاحقة بـ fetch*. حد البطء يُقارن بزمن execute وحده.
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# تعطيل التتبع بالكامل: QUERY_TRACE=0
+ENABLED = os.getenv("QUERY_TRACE", "1") != "0"
+
+# الجملة الأبطأ من هذا تُسجَّل وتُلتقط خطتها (بالمللي ثانية)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "50"))
+
+# عدد آخر التنفيذات البطيئة المحفوظة
+SLOW_LOG_SIZE = 100
+
+# أقصى عدد جمل موحدة في الإحصائيات (الأقل زمناً كلياً يُحذف عند التجاوز)
+MAX_STATEMENTS = 500
+
+# إعادة التقاط خطة الجملة البطيئة بعد هذه المدة (البيانات والفهارس تتغير)
+PLAN_REFRESH_SECONDS = 600
+
+_lock = threading.Lock()
+# {الجملة الموحدة: [العدد، مجموع الزمن، أقصى زمن، عدد مرات البطء]}
+_stats = {}
+# {الجملة الموحدة: (وقت الالتقاط، أسطر الخطة)}
+_plans = {}
+# (الوقت، الجملة الموحدة، الزمن بالثواني)
+_slow_log = deque(maxlen=SLOW_LOG_SIZE)
+
+# ==================== توحيد النص ====================
+
+_WHITESPACE = re.compile(r'\s+')
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'(?<![\w?])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LISTS = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+
+# الجمل التي تُلتقط خطتها (لا معنى لخطة PRAGMA أو CREATE أو VACUUM)
+_EXPLAINABLE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', re.IGNORECASE)
+
+# توحيد نفس النص مرة واحدة (نصوص db.py ثابتة في الغالب)
+_normalized = {}
+_NORMALIZED_CACHE_SIZE = 2048
+
+
+def normalize(sql):
+    """نص الجملة بعد استبدال القيم والمسافات (للتجميع)"""
+    result = _normalized.get(sql)
+    if result is not None:
+        return result
+    result = _WHITESPACE.sub(' ', sql).strip()
+    result = _STRINGS.sub('?', result)
+    result = _NUMBERS.sub('?', result)
+    result = _PLACEHOLDER_LISTS.sub('IN (?, ...)', result)
+    if len(_normalized) >= _NORMALIZED_CACHE_SIZE:
+        _normalized.clear()
+    _normalized[sql] = result
+    return result
+
+# ==================== التسجيل ====================
+
+def _needs_plan(key, now):
+    captured = _plans.get(key)
+    return captured is None or now - captured[0] >= PLAN_REFRESH_SECONDS
+
+
+def _capture_plan(conn, key, sql, params, now):
+    try:
+        rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    except Exception as e:
+        # معاملات غير قابلة لإعادة الاستخدام أو جدول حُذف منذ التنفيذ
+        plan = [f"(تعذر الالتقاط: {e})"]
+    else:
+        plan = [row[-1] for row in rows]
+    with _lock:
+        _plans[key] = (now, plan)
+
+
+def record(key, elapsed, slow_elapsed=None, conn=None, sql=None, params=None):
+    """تسجيل تنفيذ لجملة موحدة؛ slow_elapsed = زمن execute للمقارنة بحد البطء"""
+    slow = slow_elapsed is not None and slow_elapsed * 1000 >= SLOW_QUERY_MS
+    with _lock:
+        stats = _stats.get(key)
+        if stats is None:
+            if len(_stats) >= MAX_STATEMENTS:
+                del _stats[min(_stats, key=lambda k: _stats[k][1])]
+            stats = _stats[key] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        if slow:
+            stats[3] += 1
+            _slow_log.append((time.time(), key, slow_elapsed))
+        capture = slow and conn is not None and _needs_plan(key, time.monotonic()) \
+            and _EXPLAINABLE.match(sql) is not None
+    if slow:
+        logger.warning("جملة بطيئة (%.1f ms): %s", slow_elapsed * 1000, key)
+    if capture:
+        _capture_plan(conn, key, sql, params, time.monotonic())
+
+
+def _add_fetch_time(key, elapsed):
+    with _lock:
+        stats = _stats.get(key)
+        if stats is not None:
+            stats[1] += elapsed
+
+
+class TracedCursor:
+    """مؤشر sqlite3 يقيس execute/executemany وما يليها من قراءة"""
+
+    __slots__ = ('_cursor', '_key')
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._key = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        self._cursor.execute(sql, params)
+        elapsed = time.perf_counter() - start
+        self._key = normalize(sql)
+        record(self._key, elapsed, elapsed, self._cursor.connection, sql, params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        self._cursor.executemany(sql, seq_of_params)
+        elapsed = time.perf_counter() - start
+        # زمن الدفعة كاملة لا يُقارن بحد الجملة الواحدة
+        self._key = normalize(sql)
+        record(self._key, elapsed)
+        return self
+
+    def _timed_fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._key is not None:
+                _add_fetch_time(self._key, time.perf_counter() - start)
+
+    def fetchone(self):
+        return self._timed_fetch(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed_fetch(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed_fetch(self._cursor.fetchall)
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+
+def wrap(cursor):
+    """مؤشر متتبَّع إذا كان التتبع مفعلاً"""
+    return TracedCursor(cursor) if ENABLED else cursor
+
+# ==================== التقرير ====================
+
+def get_report(limit=10):
+    """أثقل الجمل (حسب الزمن الكلي) مع خطتها إن كانت بطيئة، وآخر التنفيذات البطيئة"""
+    with _lock:
+        statements = sorted(_stats.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        top = [
+            {
+                'sql': key,
+                'count': count,
+                'total_ms': total * 1000,
+                'avg_ms': total * 1000 / count,
+                'max_ms': worst * 1000,
+                'slow': slow,
+                'plan': _plans.get(key, (None, None))[1],
+            }
+            for key, (count, total, worst, slow) in statements
+        ]
+        recent = [
+            {'at': at, 'sql': key, 'ms': elapsed * 1000}
+            for at, key, elapsed in reversed(_slow_log)
+        ][:limit]
+    return {'top': top, 'recent_slow': recent}
+
+
+def get_stats():
+    with _lock:
+        return {
+            'statements': sum(stats[0] for stats in _stats.values()),
+            'distinct': len(_stats),
+            'slow': sum(stats[3] for stats in _stats.values()),
+        }
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _plans.clear()
+        _slow_log.clear()
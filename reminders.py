@@ -0,0 +1,94 @@
+# reminders.py - تذكيرات المناوبات على حلقة أحداث البوت
+#
+# بدلاً من الفحص كل دقيقة، تحسب الحلقة موعد الإرسال التالي وتنام حتى يحين.
+# في كل جولة: استعلام واحد للتذكيرات غير المرسلة (اليوم والغد)، إرسال متزامن
+# على دفعات، ثم تحديث واحد للنوعين لتعليم ما أُرسل.
+
+import asyncio
+import logging
+from datetime import datetime, time, timedelta
+
+import adb
+import broadcast
+
+logger = logging.getLogger(__name__)
+
+# موعد إرسال التذكيرات اليومي
+REMINDER_TIME = time(8, 0)
+
+# عدد الرسائل المرسلة معاً في كل دفعة
+REMINDER_BATCH_SIZE = 20
+
+
+def next_run_time(now):
+    """أول موعد إرسال بعد اللحظة المعطاة"""
+    run_at = datetime.combine(now.date(), REMINDER_TIME)
+    if run_at <= now:
+        run_at += timedelta(days=1)
+    return run_at
+
+def format_reminder(reminder):
+    """نص التذكير حسب نوعه"""
+    if reminder['kind'] == 'same_day':
+        return (
+            f"⏰ *تذكير اليوم*\n\n"
+            f"عزيزي د.{reminder['full_name']}\n"
+            f"لديك مناوبة اليوم\n\n"
+            f"نتمنى لك يوماً موفقاً! 🩺"
+        )
+    return (
+        f"🔔 *تذكير مهم*\n\n"
+        f"عزيزي د.{reminder['full_name']}\n"
+        f"لديك مناوبة غداً (اليوم {reminder['day']})\n\n"
+        f"بالتوفيق! 🌟"
+    )
+
+async def send_due_reminders(bot, today=None):
+    """إرسال التذكيرات المستحقة - يعيد (عدد المرسل، عدد الفاشل)"""
+    due = await adb.get_due_reminders(today)
+    sent = []
+    failed = 0
+
+    def send(reminder):
+        return broadcast.deliver(
+            bot, reminder['user_id'], format_reminder(reminder), parse_mode='Markdown',
+            kind='reminder'
+        )
+
+    for i in range(0, len(due), REMINDER_BATCH_SIZE):
+        batch = due[i:i + REMINDER_BATCH_SIZE]
+        # خطأ غير متوقع في رسالة لا يُسقط الدفعة: ما أُرسل قبله يُعلَّم حتى لا يتكرر
+        results = await asyncio.gather(*(send(r) for r in batch), return_exceptions=True)
+        for reminder, result in zip(batch, results):
+            if isinstance(result, Exception):
+                logger.error("فشل إرسال التذكير %s: %s", reminder['id'], result)
+                failed += 1
+            elif result:
+                sent.append((reminder['id'], reminder['kind']))
+            else:
+                failed += 1
+
+    # النوعان معاً في جملة واحدة
+    await adb.mark_reminders_sent(sent)
+
+    total_sent = len(sent)
+    if due:
+        logger.info("التذكيرات: أُرسل %d وفشل %d", total_sent, failed)
+    return total_sent, failed
+
+async def reminder_loop(bot):
+    """حلقة التذكيرات - تُشغَّل كمهمة خلفية عند بدء البوت"""
+    # إذا بدأ البوت بعد موعد اليوم نرسل ما فات (الأعلام تمنع التكرار)
+    if datetime.now().time() >= REMINDER_TIME:
+        try:
+            await send_due_reminders(bot)
+        except Exception:
+            logger.exception("فشل إرسال التذكيرات")
+
+    while True:
+        now = datetime.now()
+        await asyncio.sleep((next_run_time(now) - now).total_seconds())
+        try:
+            await send_due_reminders(bot)
+        except Exception:
+            logger.exception("فشل إرسال التذكيرات")
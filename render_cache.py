@@ -0,0 +1,63 @@
+# render_cache.py - ذاكرة للرسائل المنسقة (الجدول، الدليل، الملف الشخصي)
+#
+# كل رسالة تُحفظ مع رقم إصدار البيانات (db.get_data_version) وقت بنائها، وتُعاد
+# كما هي طالما لم يتغير الرقم. الحجز والإلغاء وتصفير الشهر وتغيير أيام الشهر
+# ترفع الرقم فتُبنى الرسالة من جديد عند أول طلب بعدها. المفاتيح تشمل مسار القاعدة،
+# فذاكرة واحدة تخدم كل الأقسام في وضع تعدد الأقسام.
+
+import asyncio
+from collections import OrderedDict
+
+import db
+
+# أقصى عدد رسائل محفوظة (الأقدم استخداماً يُحذف أولاً)
+MAX_ENTRIES = 2048
+
+
+class RenderCache:
+    """ذاكرة LRU لرسائل مرتبطة بإصدار البيانات"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._building = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key, build):
+        """الرسالة المحفوظة للمفتاح، أو بناؤها بـ build() (دالة async) وحفظها"""
+        key = (db.get_db_name(), key)
+        version = db.get_data_version()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        # طلبات متزامنة لنفس الرسالة تنتظر بناءً واحداً
+        pending = self._building.get((key, version))
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.ensure_future(build())
+        self._building[(key, version)] = future
+        try:
+            value = await future
+        finally:
+            self._building.pop((key, version), None)
+
+        # لا نحفظ نتيجة بُنيت على بيانات تغيرت أثناء البناء
+        if db.get_data_version() == version:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+cache = RenderCache()
@@ -0,0 +1,170 @@
+# routing.py - توجيه الرسائل والأزرار عبر جداول (قواميس) بدلاً من سلاسل if/elif
+#
+# كل مسار يُسجَّل مرة واحدة مع صلاحيته:
+#
+#     router = Router()
+#
+#     @router.text("📋 عرض الجدول", access=APPROVED)
+#     async def show_schedule(update, context, db_user): ...
+#
+#     @router.callback("book_", access=APPROVED)        # بادئة: book_12
+#     async def book(update, context, db_user, arg): ...  # arg = "12"
+#
+#     @router.state('awaiting_broadcast', access=ADMIN)  # حالة محادثة في user_data
+#     async def broadcast_input(update, context, db_user): ...
+#
+# البحث عن نص الزر أو بادئة الزر المضمّن عملية قاموس واحدة، والمستخدم لا يُقرأ
+# من القاعدة إلا للمسارات التي تحتاجه. زمن كل مسار وأخطاؤه في metrics.
+
+import logging
+
+import adb
+import metrics
+import tenants
+
+logger = logging.getLogger(__name__)
+
+# مستويات الصلاحية
+ANYONE = 'anyone'      # بدون تحقق (المستخدم لا يُقرأ من القاعدة)
+APPROVED = 'approved'  # طبيب معتمد (المستخدم يُقرأ من القاعدة ويُمرَّر للمعالج)
+ADMIN = 'admin'        # مشرف القسم الحالي
+
+# ردود رفض الصلاحية (مسارات المشرف تُتجاهل بصمت كما في السابق)
+DENIED_MESSAGE = "❌ ليس لديك صلاحية استخدام البوت"
+DENIED_CALLBACK = "❌ ليس لديك صلاحية"
+
+
+class Route:
+    __slots__ = ('name', 'handler', 'access')
+
+    def __init__(self, name, handler, access):
+        self.name = name
+        self.handler = handler
+        self.access = access
+
+
+class Router:
+    """جداول توجيه للرسائل النصية والأزرار وحالات المحادثة"""
+
+    def __init__(self):
+        self._text = {}
+        # الأزرار: مطابقة كاملة، ثم بادئة مفهرسة بالمقطع الأول قبل '_'
+        self._callbacks = {}
+        self._prefixes = {}
+        # حالات المحادثة بترتيب التسجيل: قبل أزرار القائمة أو بعدها
+        self._states_first = []
+        self._states = []
+
+    # ==================== التسجيل ====================
+
+    def text(self, label, access=APPROVED):
+        """مسار لنص زر من لوحة المفاتيح"""
+        def register(handler):
+            if label in self._text:
+                raise ValueError(f"مسار مكرر: {label}")
+            self._text[label] = Route(f"text:{handler.__name__}", handler, access)
+            return handler
+        return register
+
+    def callback(self, data, access=APPROVED):
+        """مسار لزر مضمّن: مطابقة كاملة، أو بادئة إذا انتهت بـ '_' (المعالج يستلم الباقي)"""
+        def register(handler):
+            route = Route(f"callback:{data}", handler, access)
+            if data.endswith('_'):
+                segment = data.split('_', 1)[0]
+                if segment in self._prefixes:
+                    raise ValueError(f"بادئة مكررة: {data}")
+                self._prefixes[segment] = (data, route)
+            else:
+                if data in self._callbacks:
+                    raise ValueError(f"مسار مكرر: {data}")
+                self._callbacks[data] = route
+            return handler
+        return register
+
+    def state(self, key, access=APPROVED, before_menu=False):
+        """مسار لحالة محادثة (context.user_data[key]) يستقبل النص الحر
+
+        before_menu=True: الحالة تسبق أزرار القائمة (مثل إدخال الاسم قبل التسجيل)؛
+        وإلا فضغط زر من القائمة ينفذ الزر وتبقى الحالة منتظرة.
+        """
+        def register(handler):
+            route = Route(f"state:{key}", handler, access)
+            (self._states_first if before_menu else self._states).append((key, route))
+            return handler
+        return register
+
+    # ==================== التوجيه ====================
+
+    def _find_text(self, text, user_data):
+        for key, route in self._states_first:
+            if user_data.get(key):
+                return route
+        route = self._text.get(text)
+        if route is not None:
+            return route
+        for key, route in self._states:
+            if user_data.get(key):
+                return route
+        return None
+
+    def _find_callback(self, data):
+        route = self._callbacks.get(data)
+        if route is not None:
+            return route, None
+        entry = self._prefixes.get(data.split('_', 1)[0])
+        if entry is not None and data.startswith(entry[0]):
+            return entry[1], data[len(entry[0]):]
+        return None, None
+
+    async def _authorize(self, route, user_id):
+        """(مسموح، المستخدم من القاعدة أو None)"""
+        if route.access == ANYONE:
+            return True, None
+        if route.access == ADMIN:
+            return tenants.is_admin(user_id), None
+        db_user = await adb.get_user(user_id)
+        return bool(db_user and db_user['approved'] == 1), db_user
+
+    async def dispatch_text(self, update, context):
+        """توجيه رسالة نصية - يعيد اسم المسار أو None"""
+        user_id = update.effective_user.id
+        route = self._find_text(update.message.text, context.user_data)
+        if route is None:
+            # نص غير معروف: نخبر غير المعتمدين فقط كما في السابق
+            db_user = await adb.get_user(user_id)
+            if not db_user or db_user['approved'] != 1:
+                await update.message.reply_text(DENIED_MESSAGE)
+            return None
+
+        allowed, db_user = await self._authorize(route, user_id)
+        if not allowed:
+            if route.access == APPROVED:
+                await update.message.reply_text(DENIED_MESSAGE)
+            return route.name
+        await self._run(route, update, context, db_user)
+        return route.name
+
+    async def dispatch_callback(self, update, context):
+        """توجيه زر مضمّن - يعيد اسم المسار أو None"""
+        query = update.callback_query
+        route, arg = self._find_callback(query.data)
+        if route is None:
+            logger.debug("زر بدون مسار: %s", query.data)
+            return None
+
+        allowed, db_user = await self._authorize(route, query.from_user.id)
+        if not allowed:
+            if route.access == APPROVED:
+                await query.edit_message_text(DENIED_CALLBACK)
+            return route.name
+        if arg is None:
+            await self._run(route, update, context, db_user)
+        else:
+            await self._run(route, update, context, db_user, arg)
+        return route.name
+
+    async def _run(self, route, update, context, *args):
+        async with metrics.timed(metrics.HANDLER_SECONDS, metrics.HANDLER_ERRORS,
+                                 metrics.HANDLERS_IN_FLIGHT, route=route.name):
+            await route.handler(update, context, *args)
@@ -0,0 +1,92 @@
+# tenants.py - تعدد الأقسام: عملية واحدة تخدم عدة أقسام، لكل قسم بوت وقاعدة ومشرفون
+#
+# سجل الأقسام ملف JSON (config.TENANTS_FILE):
+#
+#     {"tenants": [
+#         {"name": "icu", "token_env": "ICU_TOKEN", "db": "icu.db", "admins": [111, 222]},
+#         {"name": "er", "token": "123:ABC", "db": "er.db", "admins": [333]}
+#     ]}
+#
+# بدون الملف يعمل البوت كالسابق بقسم واحد (TOKEN و DB_NAME و ADMIN_ID).
+# القسم الحالي متغير سياق: يُفعَّل عند بدء تطبيق القسم وعند وصول كل تحديث، وكل
+# مهمة asyncio ترثه ممن أنشأها، فتعمل دوال db.py والمعالجات على قاعدة القسم الصحيح
+# بينما تبقى حلقة الأحداث والخيوط العاملة وذاكرة الرسائل مشتركة.
+
+import contextvars
+import json
+import os
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+
+import config
+import db
+
+Tenant = namedtuple('Tenant', ['name', 'token', 'db_path', 'admin_ids'])
+
+_current = contextvars.ContextVar('tenant', default=None)
+
+
+def default_tenant():
+    """القسم الوحيد في الوضع العادي (من متغيرات البيئة و config.py)"""
+    return Tenant('default', os.getenv("TOKEN"), db.DB_NAME, frozenset([config.ADMIN_ID]))
+
+def load_tenants(path=None):
+    """قراءة سجل الأقسام - قائمة Tenant (قسم افتراضي واحد إذا لم يوجد السجل)"""
+    path = path if path is not None else config.TENANTS_FILE
+    if not path:
+        return [default_tenant()]
+
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)['tenants']
+
+    tenants = []
+    seen = set()
+    for entry in entries:
+        name = entry['name']
+        if not re.fullmatch(r'[A-Za-z0-9_-]+', name):
+            raise ValueError(f"اسم قسم غير صالح: {name!r}")
+        if name in seen:
+            raise ValueError(f"قسم مكرر: {name}")
+        seen.add(name)
+
+        token = entry.get('token') or os.getenv(entry.get('token_env', ''), '')
+        if not token:
+            raise ValueError(f"لا يوجد توكن للقسم {name}")
+        admins = frozenset(int(admin_id) for admin_id in entry.get('admins', []))
+        if not admins:
+            raise ValueError(f"لا يوجد مشرف للقسم {name}")
+        tenants.append(Tenant(name, token, entry.get('db', f"{name}.db"), admins))
+    return tenants
+
+# ==================== القسم الحالي ====================
+
+def current():
+    """القسم الحالي (الافتراضي خارج أي قسم)"""
+    tenant = _current.get()
+    if tenant is None:
+        tenant = default_tenant()
+    return tenant
+
+def activate(tenant):
+    """تفعيل قسم لبقية المهمة الحالية وما تنشئه من مهام"""
+    _current.set(tenant)
+    db.activate_database(tenant.db_path)
+
+@contextmanager
+def use(tenant):
+    """تنفيذ كتلة ضمن قسم محدد"""
+    token = _current.set(tenant)
+    try:
+        with db.use_database(tenant.db_path):
+            yield tenant
+    finally:
+        _current.reset(token)
+
+def is_admin(user_id):
+    """هل المستخدم مشرف في القسم الحالي"""
+    return user_id in current().admin_ids
+
+def admin_ids():
+    """مشرفو القسم الحالي مرتبين (للإشعارات)"""
+    return sorted(current().admin_ids)
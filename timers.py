@@ -0,0 +1,121 @@
+# timers.py - خدمة المؤقتات الدائمة (فتح/غلق الحجز المجدول وأي إجراء مؤقت آخر)
+#
+# جميع المؤقتات في كومة واحدة (heap) تديرها مهمة واحدة على حلقة أحداث البوت،
+# وتُحفظ في جدول timers حتى تُستعاد بعد إعادة التشغيل. لكل مؤقت اسم فريد:
+# جدولة اسم موجود تستبدل المؤقت القديم، والمؤقتات التي فات موعدها أثناء
+# التوقف تُنفَّذ فوراً عند البدء.
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+from datetime import datetime
+
+import adb
+
+logger = logging.getLogger(__name__)
+
+# صيغة حفظ الوقت في القاعدة
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class TimerService:
+    """مجدول إجراءات مؤقتة على حلقة الأحداث مع حفظها في sqlite"""
+
+    def __init__(self, app):
+        self.app = app
+        self._actions = {}
+        self._heap = []
+        # الإصدار الحالي لكل اسم؛ العناصر القديمة في الكومة تُتجاهل عند خروجها
+        self._current = {}
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def register(self, action, callback):
+        """تسجيل إجراء: callback(app, payload) دالة async"""
+        self._actions[action] = callback
+
+    async def start(self):
+        """تحميل المؤقتات المحفوظة وتشغيل حلقة التنفيذ"""
+        for row in await adb.get_timers():
+            self._push(
+                row['name'], row['action'],
+                datetime.strptime(row['run_at'], TIME_FORMAT),
+                json.loads(row['payload']) if row['payload'] else None
+            )
+        self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def schedule(self, name, action, run_at, payload=None):
+        """جدولة إجراء (يستبدل أي مؤقت سابق بنفس الاسم)"""
+        if action not in self._actions:
+            raise ValueError(f"إجراء غير معروف: {action}")
+        await adb.save_timer(
+            name, action, run_at.strftime(TIME_FORMAT),
+            json.dumps(payload) if payload is not None else None
+        )
+        self._push(name, action, run_at, payload)
+
+    async def cancel(self, name):
+        """إلغاء مؤقت - يعيد False إذا لم يكن موجوداً"""
+        if self._current.pop(name, None) is None:
+            return False
+        await adb.delete_timer(name)
+        self._wakeup.set()
+        return True
+
+    def pending(self):
+        """المؤقتات المنتظرة: {الاسم: (الإجراء، الموعد)}"""
+        return {
+            name: (action, run_at)
+            for run_at, seq, name, action, payload in self._heap
+            if self._current.get(name) == seq
+        }
+
+    def _push(self, name, action, run_at, payload):
+        seq = next(self._counter)
+        self._current[name] = seq
+        heapq.heappush(self._heap, (run_at, seq, name, action, payload))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            # تنظيف العناصر الملغاة أو المستبدلة من رأس الكومة
+            while self._heap and self._current.get(self._heap[0][2]) != self._heap[0][1]:
+                heapq.heappop(self._heap)
+
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = (self._heap[0][0] - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            run_at, seq, name, action, payload = heapq.heappop(self._heap)
+            await self._fire(name, seq, action, run_at, payload)
+
+    async def _fire(self, name, seq, action, run_at, payload):
+        late = (datetime.now() - run_at).total_seconds()
+        if late > 60:
+            logger.warning("تنفيذ المؤقت %s متأخراً %.0f ثانية", name, late)
+        try:
+            await self._actions[action](self.app, payload)
+        except Exception:
+            logger.exception("فشل تنفيذ المؤقت %s (%s)", name, action)
+        # الحذف بعد التنفيذ: إذا توقف البوت أثناءه يُعاد التنفيذ عند البدء
+        if self._current.get(name) == seq:
+            del self._current[name]
+            await adb.delete_timer(name)
@@ -0,0 +1,461 @@
+# tools/bench_db.py - قياس دوال db.py على قواعد بأحجام واقعية
+#
+#     python tools/bench_db.py
+#     python tools/bench_db.py --doctors 10,1000 --months 1,120 --save before.json
+#     python tools/bench_db.py --compare before.json --threshold 25
+#
+# لكل تركيبة (عدد الأطباء × أشهر السجل) تُنشأ قاعدة مؤقتة: أطباء معتمدون، وطلبات
+# انتظار، وسجل أشهر سابقة في الأرشيف، والشهر الحالي محجوز نصفه (ومعه اليوم والغد
+# للتذكيرات). ثم تُقاس كل عملية عدة مرات (حتى --runs أو --budget ثانية)، وتُشغَّل
+# مرة إضافية تحت tracemalloc لقياس ذاكرة بايثون (ذاكرة SQLite الداخلية لا تظهر فيه).
+#
+# --save يحفظ النتائج JSON، و --compare يقارن بملف سابق ويخرج بالرمز 1 إذا تباطأت
+# عملية (p50) أكثر من --threshold بالمئة.
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# يجب ضبط القاعدة المؤقتة قبل استيراد db (تهيئة القاعدة تتم عند الاستيراد)
+_tmpdir = tempfile.TemporaryDirectory(prefix='duty_bench_db_')
+os.environ['DB_NAME'] = os.path.join(_tmpdir.name, 'bench.db')
+
+import db  # noqa: E402
+import querytrace  # noqa: E402
+
+# أقل عدد تشغيلات لكل عملية حتى لو انتهت الميزانية
+MIN_RUNS = 5
+
+# أقصى عدد أطباء يرسلون رغباتهم في قياس التوزيع (31 يوماً لا تكفي أكثر من ذلك بكثير)
+PREFERENCE_DOCTORS = 500
+
+# دوال البنية التحتية (المجمع، الترحيل، الذاكرة) لا تُقاس كعمليات
+INFRASTRUCTURE = {
+    'get_db_name', 'activate_database', 'use_database', 'get_pool', 'close_pool', 'get_db',
+    'get_data_version', 'bump_data_version', 'get_schema_version', 'migrate', 'init_db',
+    'peek_cached_user', 'invalidate_user', 'get_user_cache_stats', 'month_of',
+    'get_current_month', 'reload_settings',
+}
+
+# ==================== تجهيز القاعدة ====================
+
+def shift_month(month, delta):
+    year, number = map(int, month.split('-'))
+    index = year * 12 + number - 1 + delta
+    return f"{index // 12}-{index % 12 + 1:02d}"
+
+
+class Dataset:
+    """قاعدة مولَّدة وما يلزم لتشغيل العمليات عليها"""
+
+    def __init__(self, doctors, months):
+        self.doctors = doctors
+        self.months = months
+        self.month = db.get_current_month()
+        self.month_days = 31
+        today = datetime.now().date()
+        # نصف أيام الشهر محجوزة، ومعها اليوم والغد (للتذكيرات)
+        self.booked_days = sorted(
+            set(range(1, self.month_days + 1, 2)) | {today.day, (today + timedelta(days=1)).day}
+        )
+        self.free_days = [d for d in range(1, self.month_days + 1) if d not in self.booked_days]
+        # في آخر يوم من الشهر يقع الغد في الشهر التالي
+        tomorrow = today + timedelta(days=1)
+        self.tomorrow_month = db.month_of(tomorrow)
+        self.tomorrow_day = tomorrow.day
+        # مستخدم دون حجوزات لمسار الحجز الناجح
+        self.free_user = doctors
+
+    def doctor_for(self, day, month_index=0):
+        # الطبيب الأخير محجوز للقياس فلا يُعطى حجوزات
+        return (day * 7 + month_index * 3) % max(self.doctors - 1, 1) + 1
+
+    def current_rows(self):
+        rows = [(day, self.doctor_for(day), self.month) for day in self.booked_days]
+        if self.tomorrow_month != self.month:
+            rows.append((self.tomorrow_day, self.doctor_for(self.tomorrow_day), self.tomorrow_month))
+        return rows
+
+    def build(self, path):
+        db.close_pool()
+        db.DB_NAME = path
+        db.init_db()
+        conn = db.get_db(write=True)
+        conn.executemany(
+            "INSERT INTO users (user_id, full_name, approved, max_days) VALUES (?, ?, 1, ?)",
+            [(user_id, f"طبيب رقم {user_id}", 5) for user_id in range(1, self.doctors + 1)]
+        )
+        # طلبات انتظار بنسبة 5%
+        conn.executemany(
+            "INSERT INTO pending_approvals (user_id, full_name) VALUES (?, ?)",
+            [(self.doctors + i, f"طلب {i}") for i in range(1, self.doctors // 20 + 2)]
+        )
+        # سجل الأشهر السابقة في الأرشيف (كل أيام الشهر محجوزة)
+        conn.executemany(
+            "INSERT INTO bookings_archive (day, user_id, month, full_name, superseded) "
+            "VALUES (?, ?, ?, ?, 0)",
+            [
+                (day, self.doctor_for(day, m), shift_month(self.month, -m), f"طبيب رقم {self.doctor_for(day, m)}")
+                for m in range(1, self.months)
+                for day in range(1, 29)
+            ]
+        )
+        # الأرشيف يحتفظ بمعرف الحجز الأصلي: عداد bookings يبدأ بعد آخر معرف فيه
+        # كما لو كانت هذه الصفوف قد مرت بجدول bookings فعلاً
+        conn.execute(
+            "INSERT OR REPLACE INTO sqlite_sequence (name, seq) "
+            "SELECT 'bookings', COALESCE(MAX(id), 0) FROM bookings_archive"
+        )
+        conn.executemany(
+            "INSERT INTO bookings (day, user_id, month) VALUES (?, ?, ?)", self.current_rows()
+        )
+        conn.executemany(
+            "INSERT INTO user_state (user_id, data) VALUES (?, ?)",
+            [(user_id, '{"awaiting_name": true}') for user_id in range(1, min(self.doctors, 1000) + 1)]
+        )
+        conn.commit()
+        conn.execute("ANALYZE")
+        conn.close()
+        db.set_month_days(self.month_days)
+        db.set_booking_open(True)
+
+    def restore_current_month(self):
+        """إعادة حجوزات الشهر بعد تصفيره"""
+        conn = db.get_db(write=True)
+        conn.executemany(
+            "INSERT OR IGNORE INTO bookings (day, user_id, month) VALUES (?, ?, ?)", self.current_rows()
+        )
+        conn.commit()
+        conn.close()
+
+    def reset_reminders(self):
+        """إعادة تذكيرات اليوم والغد إلى "غير مرسلة" """
+        conn = db.get_db(write=True)
+        conn.execute(
+            "UPDATE bookings SET reminder_sent_24h = 0, reminder_sent_same_day = 0 WHERE month IN (?, ?)",
+            (self.month, self.tomorrow_month)
+        )
+        conn.commit()
+        conn.close()
+
+    def check(self):
+        """التأكد من أن حجوزات الشهر المولدة موجودة قبل القياس (عملية سابقة قد تكون أفرغتها)"""
+        booked = len(db.get_all_bookings(self.month))
+        if booked < len(self.booked_days):
+            raise RuntimeError(
+                f"حجوزات الشهر {booked} بدلاً من {len(self.booked_days)} - عملية سابقة لم تُعِد البيانات"
+            )
+
+# ==================== العمليات ====================
+
+class Operation:
+    """عملية مقاسة: call() يُقاس، و setup() قبله و teardown() بعده دون قياس"""
+
+    def __init__(self, name, call, setup=None, covers=None, teardown=None):
+        self.name = name
+        self.call = call
+        self.setup = setup
+        # بعد كل تشغيل دون قياس (لإعادة البيانات التي غيّرها call)
+        self.teardown = teardown
+        # دوال db.py التي تغطيها (الافتراضي: نفس الاسم)
+        self.covers = covers or (name,)
+
+
+def operations(data):
+    month, free_user, free_day = data.month, data.free_user, data.free_days[0]
+    booked_day, booked_user = data.booked_days[0], data.doctor_for(data.booked_days[0])
+    first_month = shift_month(month, -(data.months - 1))
+    state = {'job_id': db.create_job('bench', "قياس"), 'due': []}
+    active_rows = [
+        (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 1, user_id)
+        for user_id in range(1, min(data.doctors, 1000) + 1)
+    ]
+    state_rows = [(user_id, '{"awaiting_broadcast": true}') for user_id in range(1, min(data.doctors, 200) + 1)]
+
+    def cancel_free():
+        db.cancel_booking(free_day, month, free_user)
+
+    def book_free():
+        db.book_day(free_user, free_day, month)
+
+    def load_due():
+        data.reset_reminders()
+        state['due'] = [(row['id'], row['kind']) for row in db.get_due_reminders()]
+        if not state['due']:
+            raise RuntimeError("لا توجد تذكيرات مستحقة في البيانات المولدة")
+
+    # طبيب مؤقت لعمليات التسجيل والموافقة والحذف
+    new_doctor = 10 ** 8
+
+    def pending_doctor():
+        db.delete_user(new_doctor)
+        db.add_user(new_doctor, "طبيب جديد")
+
+    def approved_doctor():
+        pending_doctor()
+        db.approve_user(new_doctor)
+
+    # التوزيع على شهر لاحق بلا حجوزات (بعد الشهر التالي الذي قد يحوي حجز الغد) حتى لا يمس بيانات التذكيرات.
+    # الرغبات منحازة لأيام بعينها (نهايات الأسابيع مثلاً) ليكون التنافس واقعياً
+    later_month = shift_month(month, 2)
+    rng = random.Random(0)
+    popular = list(range(1, data.month_days + 1))
+    weights = [3 if day % 7 in (5, 6) else 1 for day in popular]
+    preference_rows = []
+    for user_id in range(1, min(data.doctors, PREFERENCE_DOCTORS) + 1):
+        days = []
+        while len(days) < db.MAX_PREFERENCES:
+            day = rng.choices(popular, weights)[0]
+            if day not in days:
+                days.append(day)
+        preference_rows += [(user_id, later_month, day, rank) for rank, day in enumerate(days, 1)]
+
+    def seed_preferences():
+        conn = db.get_db(write=True)
+        conn.execute("DELETE FROM bookings WHERE month = ?", (later_month,))
+        conn.execute("DELETE FROM booking_preferences WHERE month = ?", (later_month,))
+        conn.executemany(
+            "INSERT INTO booking_preferences (user_id, month, day, rank) VALUES (?, ?, ?, ?)",
+            preference_rows
+        )
+        conn.commit()
+        conn.close()
+
+    return [
+        # المستخدمون
+        Operation('get_user', lambda: db.get_user(booked_user), setup=lambda: db.invalidate_user(booked_user)),
+        Operation('get_user[cached]', lambda: db.get_user(booked_user), covers=('get_user',)),
+        Operation('get_user[unknown]', lambda: db.get_user(10 ** 9), setup=lambda: db.invalidate_user(10 ** 9),
+                  covers=('get_user',)),
+        Operation('get_approved_users', db.get_approved_users),
+        Operation('get_pending_users', db.get_pending_users),
+        Operation('add_user', lambda: db.add_user(new_doctor, "طبيب جديد")),
+        Operation('approve_user', lambda: db.approve_user(new_doctor), setup=pending_doctor),
+        Operation('reject_user', lambda: db.reject_user(new_doctor), setup=pending_doctor),
+        Operation('update_user_max_days', lambda: db.update_user_max_days(booked_user, 5)),
+        Operation('delete_user', lambda: db.delete_user(new_doctor), setup=approved_doctor),
+        Operation('update_last_active', lambda: db.update_last_active(booked_user)),
+        Operation('record_activity', lambda: db.record_activity(active_rows)),
+        # الحجوزات
+        Operation('get_month_days', db.get_month_days),
+        Operation('set_month_days', lambda: db.set_month_days(data.month_days)),
+        Operation('get_user_bookings', lambda: db.get_user_bookings(booked_user, month)),
+        Operation('get_all_bookings', lambda: db.get_all_bookings(month)),
+        Operation('iter_bookings[history]', lambda: list(db.iter_bookings(first_month, month)),
+                  covers=('iter_bookings',)),
+        Operation('book_day', book_free, setup=cancel_free),
+        Operation('book_day[taken]', lambda: db.book_day(free_user, booked_day, month), covers=('book_day',)),
+        Operation('cancel_booking', cancel_free, setup=book_free),
+        Operation('reset_month', lambda: db.reset_month(month), teardown=data.restore_current_month),
+        Operation('archive_month', lambda: db.archive_month(shift_month(month, -1000))),
+        Operation('archive_closed_months', db.archive_closed_months),
+        # رغبات الحجز
+        Operation('get_preferences', lambda: db.get_preferences(1, later_month), setup=seed_preferences),
+        Operation('toggle_preference', lambda: db.toggle_preference(free_user, free_day, later_month)),
+        Operation('clear_preferences', lambda: db.clear_preferences(free_user, later_month),
+                  setup=lambda: db.toggle_preference(free_user, free_day, later_month)),
+        Operation('count_preferences', lambda: db.count_preferences(later_month), setup=seed_preferences),
+        Operation('allocate_preferences', lambda: db.allocate_preferences(later_month), setup=seed_preferences),
+        # الإعدادات والمؤقتات
+        Operation('get_setting', lambda: db.get_setting('booking_open')),
+        Operation('set_setting', lambda: db.set_setting('bench', '1')),
+        Operation('is_booking_open', db.is_booking_open),
+        Operation('set_booking_open', lambda: db.set_booking_open(True)),
+        Operation('get_scheduled_booking_time', db.get_scheduled_booking_time),
+        Operation('set_scheduled_booking_time', lambda: db.set_scheduled_booking_time('')),
+        Operation('get_booking_mode', db.get_booking_mode),
+        Operation('set_booking_mode', lambda: db.set_booking_mode(db.BOOKING_MODE_FIRST_COME)),
+        Operation('get_timers', db.get_timers),
+        Operation('save_timer', lambda: db.save_timer('bench', 'open_booking', '2099-01-01 00:00:00')),
+        Operation('delete_timer', lambda: db.delete_timer('bench'),
+                  setup=lambda: db.save_timer('bench', 'open_booking', '2099-01-01 00:00:00')),
+        # المهام وحالة المحادثة
+        Operation('create_job', lambda: db.create_job('bench', "قياس")),
+        Operation('start_job', lambda: db.start_job(state['job_id'])),
+        Operation('update_job_progress', lambda: db.update_job_progress(state['job_id'], 1, 2)),
+        Operation('finish_job', lambda: db.finish_job(state['job_id'], db.JOB_DONE, result="تم")),
+        Operation('get_job', lambda: db.get_job(state['job_id'])),
+        Operation('get_recent_jobs', db.get_recent_jobs),
+        Operation('mark_interrupted_jobs', db.mark_interrupted_jobs),
+        Operation('get_user_state', lambda: db.get_user_state(1)),
+        Operation('save_user_states', lambda: db.save_user_states(state_rows)),
+        # الإحصائيات والتذكيرات
+        Operation('get_roster_summary', lambda: db.get_roster_summary(month)),
+        Operation('get_month_statistics', db.get_month_statistics),
+        Operation('get_tomorrow_bookings', db.get_tomorrow_bookings),
+        Operation('get_today_bookings', db.get_today_bookings),
+        Operation('get_due_reminders', db.get_due_reminders, setup=data.reset_reminders),
+        Operation('mark_reminders_sent', lambda: db.mark_reminders_sent(state['due']), setup=load_due),
+        Operation('mark_reminder_sent', lambda: db.mark_reminder_sent(booked_day, 'same_day')),
+    ]
+
+# ==================== القياس ====================
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(op, runs, budget):
+    times = []
+    started = time.perf_counter()
+    while len(times) < runs:
+        if op.setup:
+            op.setup()
+        start = time.perf_counter()
+        op.call()
+        times.append(time.perf_counter() - start)
+        if op.teardown:
+            op.teardown()
+        if len(times) >= MIN_RUNS and time.perf_counter() - started > budget:
+            break
+
+    # تشغيل إضافي لقياس ذاكرة بايثون (بعد التسخين حتى لا تُحسب الذاكرات المؤقتة الأولى)
+    if op.setup:
+        op.setup()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    op.call()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if op.teardown:
+        op.teardown()
+
+    times.sort()
+    return {
+        'op': op.name,
+        'runs': len(times),
+        'p50_us': round(percentile(times, 50) * 1e6, 1),
+        'p95_us': round(percentile(times, 95) * 1e6, 1),
+        'mean_us': round(sum(times) / len(times) * 1e6, 1),
+        'peak_kib': round((peak - before) / 1024, 1),
+        'retained_kib': round((current - before) / 1024, 1),
+    }
+
+
+def uncovered(ops):
+    """دوال db.py العامة التي لا تغطيها أي عملية"""
+    covered = {name for op in ops for name in op.covers}
+    public = {
+        name for name, value in vars(db).items()
+        if callable(value) and not name.startswith('_') and getattr(value, '__module__', None) == 'db'
+        and not isinstance(value, type) and name not in INFRASTRUCTURE
+    }
+    return sorted(public - covered)
+
+
+def run_matrix(doctor_counts, month_counts, runs, budget):
+    results = []
+    for doctors in doctor_counts:
+        for months in month_counts:
+            data = Dataset(doctors, months)
+            started = time.perf_counter()
+            data.build(os.path.join(_tmpdir.name, f'bench_{doctors}_{months}.db'))
+            built = time.perf_counter() - started
+            ops = operations(data)
+            print(f"⏳ {doctors} طبيب × {months} شهر (التجهيز {built:.1f}s)", file=sys.stderr)
+            for op in ops:
+                data.check()
+                result = measure(op, runs, budget)
+                result.update(doctors=doctors, months=months)
+                results.append(result)
+            db.close_pool()
+    missing = uncovered(ops)
+    if missing:
+        print(f"⚠️ دوال بدون قياس: {', '.join(missing)}", file=sys.stderr)
+    return results
+
+# ==================== التقرير والمقارنة ====================
+
+def metadata():
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'query_trace': querytrace.ENABLED,
+    }
+
+
+def print_table(results):
+    print(f"{'doctors':>8} {'months':>6}  {'operation':32} {'p50 µs':>10} {'p95 µs':>10} {'peak KiB':>9} {'runs':>5}")
+    for r in results:
+        print(
+            f"{r['doctors']:>8} {r['months']:>6}  {r['op']:32} {r['p50_us']:>10} {r['p95_us']:>10}"
+            f" {r['peak_kib']:>9} {r['runs']:>5}"
+        )
+
+
+def compare(results, baseline_path, threshold):
+    """طباعة الفروق عن ملف سابق - يعيد عدد العمليات المتباطئة"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    old = {(r['doctors'], r['months'], r['op']): r for r in baseline['results']}
+    print(f"\nمقارنة مع {baseline_path} ({baseline['meta']['date']}):")
+    regressions = 0
+    for r in results:
+        before = old.get((r['doctors'], r['months'], r['op']))
+        if before is None or not before['p50_us']:
+            continue
+        change = (r['p50_us'] - before['p50_us']) / before['p50_us'] * 100
+        if abs(change) < threshold:
+            continue
+        slower = change > 0
+        regressions += slower
+        mark = '🔺' if slower else '🟢'
+        print(
+            f"  {mark} {r['doctors']:>6} × {r['months']:<4} {r['op']:32}"
+            f" {before['p50_us']:>9} → {r['p50_us']:>9} µs ({change:+.0f}%)"
+        )
+    if not regressions:
+        print("  ✅ لا تباطؤ فوق الحد")
+    return regressions
+
+
+def parse_counts(text):
+    return [int(part) for part in text.split(',') if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس دوال db.py على أحجام بيانات مختلفة")
+    parser.add_argument('--doctors', default='10,100,1000,10000', help="أعداد الأطباء مفصولة بفواصل")
+    parser.add_argument('--months', default='1,12,120', help="أشهر السجل مفصولة بفواصل")
+    parser.add_argument('--runs', type=int, default=200, help="أقصى عدد تشغيلات لكل عملية")
+    parser.add_argument('--budget', type=float, default=0.5, help="ثوانٍ لكل عملية")
+    parser.add_argument('--no-trace', action='store_true', help="تعطيل querytrace أثناء القياس")
+    parser.add_argument('--save', help="حفظ النتائج في ملف JSON")
+    parser.add_argument('--compare', help="مقارنة بملف JSON سابق")
+    parser.add_argument('--threshold', type=float, default=20.0, help="نسبة التباطؤ المقبولة (%%)")
+    parser.add_argument('--json', action='store_true', help="طباعة النتائج بصيغة JSON")
+    args = parser.parse_args()
+
+    if args.no_trace:
+        querytrace.ENABLED = False
+    results = run_matrix(parse_counts(args.doctors), parse_counts(args.months), args.runs, args.budget)
+    report = {'meta': metadata(), 'results': results}
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+# tools/bench_stampede.py - محاكاة لحظة "🔓 فتح الحجز": جميع الأطباء يحجزون في نفس اللحظة
+#
+# يعمل دون اتصال بالإنترنت على قاعدة بيانات مؤقتة:
+#     python tools/bench_stampede.py --doctors 200 --taps 5
+#     python tools/bench_stampede.py --mode db --doctors 500 --json
+#
+# السيناريوهات:
+#   handler - طلبات book_ متزامنة عبر button_handler بكائنات Update/Bot وهمية
+#   db      - استدعاءات db.book_day متزامنة من خيوط متعددة
+#
+# يخرج بالرمز 1 إذا انكسر أحد الثوابت (يوم محجوز مرتين أو طبيب فوق max_days).
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# يجب ضبط القاعدة المؤقتة قبل استيراد db (تهيئة القاعدة تتم عند الاستيراد)
+_tmpdir = tempfile.TemporaryDirectory(prefix='duty_bench_')
+os.environ['DB_NAME'] = os.path.join(_tmpdir.name, 'bench.db')
+
+import db  # noqa: E402
+
+# ==================== كائنات تيليجرام الوهمية ====================
+
+class FakeCallbackQuery:
+    """بديل CallbackQuery يسجل الردود بدلاً من إرسالها"""
+
+    def __init__(self, user_id, data):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.edits = []
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+        return True
+
+
+class StubBot:
+    """بديل context.bot يسجل الرسائل المرسلة"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(chat_id=chat_id, text=text)
+
+
+def make_callback(user_id, data, bot):
+    query = FakeCallbackQuery(user_id, data)
+    update = SimpleNamespace(
+        callback_query=query,
+        effective_user=query.from_user,
+        effective_chat=SimpleNamespace(id=user_id),
+    )
+    context = SimpleNamespace(bot=bot, user_data={}, bot_data={})
+    return update, context, query
+
+# ==================== تجهيز القاعدة ====================
+
+def fresh_database(name, doctors, max_days):
+    """قاعدة جديدة فيها أطباء معتمدون والحجز مفتوح"""
+    db.close_pool()
+    db.DB_NAME = os.path.join(_tmpdir.name, f'{name}.db')
+    db.init_db()
+    for user_id in range(1, doctors + 1):
+        db.add_user(user_id, f"طبيب رقم {user_id}")
+        db.approve_user(user_id, max_days)
+    db.set_booking_open(True)
+
+def plan_taps(doctors, taps, month_days, seed):
+    """قائمة (الطبيب، اليوم) ثابتة لنفس البذرة"""
+    rng = random.Random(seed)
+    plan = [
+        (user_id, rng.randint(1, month_days))
+        for user_id in range(1, doctors + 1)
+        for _ in range(taps)
+    ]
+    rng.shuffle(plan)
+    return plan
+
+def check_invariants():
+    """التحقق من عدم تكرار الأيام وعدم تجاوز max_days"""
+    conn = db.get_db()
+    double_booked = conn.execute("""
+        SELECT day, month, COUNT(*) AS n FROM bookings
+        GROUP BY day, month HAVING n > 1
+    """).fetchall()
+    over_quota = conn.execute("""
+        SELECT b.user_id, COUNT(*) AS n, u.max_days FROM bookings b
+        JOIN users u ON b.user_id = u.user_id
+        GROUP BY b.user_id, b.month HAVING n > u.max_days
+    """).fetchall()
+    conn.close()
+    return {
+        'double_booked_days': len(double_booked),
+        'doctors_over_max_days': len(over_quota),
+    }
+
+# ==================== التقرير ====================
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(name, latencies, outcomes, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'scenario': name,
+        'requests': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'booked': outcomes.get('ok', 0),
+        'conflicts': outcomes.get('taken', 0),
+        'rejected': sum(
+            n for code, n in outcomes.items() if code not in ('ok', 'taken', 'error')
+        ),
+        'errors': outcomes.get('error', 0),
+        **check_invariants(),
+    }
+
+# ==================== السيناريوهات ====================
+
+def classify_reply(text):
+    """تحويل رد button_handler إلى رمز نتيجة"""
+    if text.startswith('✅'):
+        return db.BOOK_OK
+    if 'محجوز مسبقاً' in text:
+        return db.BOOK_TAKEN
+    return 'rejected'
+
+async def run_handler_scenario(args):
+    import adb
+    import main
+
+    fresh_database('handler', args.doctors, args.max_days)
+    plan = plan_taps(args.doctors, args.taps, db.get_month_days(), args.seed)
+    bot = StubBot()
+    latencies, outcomes = [], {}
+
+    async def tap(user_id, day):
+        update, context, query = make_callback(user_id, f"book_{day}", bot)
+        start = time.perf_counter()
+        try:
+            await main.button_handler(update, context)
+            code = classify_reply(query.edits[-1]) if query.edits else 'error'
+        except Exception:
+            code = 'error'
+        latencies.append(time.perf_counter() - start)
+        outcomes[code] = outcomes.get(code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(tap(user_id, day) for user_id, day in plan))
+    elapsed = time.perf_counter() - start
+    adb.shutdown()
+    return summarize('handler', latencies, outcomes, elapsed)
+
+def run_db_scenario(args):
+    fresh_database('db', args.doctors, args.max_days)
+    plan = plan_taps(args.doctors, args.taps, db.get_month_days(), args.seed)
+    latencies, outcomes = [], {}
+    lock = threading.Lock()
+    chunks = [plan[i::args.threads] for i in range(args.threads)]
+    barrier = threading.Barrier(args.threads + 1)
+
+    def worker(chunk):
+        barrier.wait()
+        for user_id, day in chunk:
+            start = time.perf_counter()
+            try:
+                code = db.book_day(user_id, day).code
+            except Exception:
+                code = 'error'
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                outcomes[code] = outcomes.get(code, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return summarize('db', latencies, outcomes, time.perf_counter() - start)
+
+# ==================== التشغيل ====================
+
+def print_report(report):
+    print(f"\n=== {report['scenario']} ===")
+    for key, value in report.items():
+        if key != 'scenario':
+            print(f"  {key:24} {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس ضغط لحظة فتح الحجز")
+    parser.add_argument('--mode', choices=['handler', 'db', 'both'], default='both')
+    parser.add_argument('--doctors', type=int, default=100)
+    parser.add_argument('--taps', type=int, default=3, help="عدد الضغطات لكل طبيب")
+    parser.add_argument('--max-days', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=16, help="خيوط سيناريو db")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="طباعة النتائج بصيغة JSON")
+    args = parser.parse_args()
+
+    reports = []
+    if args.mode in ('db', 'both'):
+        reports.append(run_db_scenario(args))
+    if args.mode in ('handler', 'both'):
+        reports.append(asyncio.run(run_handler_scenario(args)))
+    db.close_pool()
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+    else:
+        for report in reports:
+            print_report(report)
+
+    broken = any(r['double_booked_days'] or r['doctors_over_max_days'] for r in reports)
+    return 1 if broken else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
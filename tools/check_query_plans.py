@@ -0,0 +1,172 @@
+# tools/check_query_plans.py - التحقق من أن استعلامات db.py تستخدم الفهارس
+#
+#     python tools/check_query_plans.py [-v]
+#
+# ينشئ قاعدة مؤقتة فيها بيانات عدة أشهر، ويشغّل كل دوال db.py العامة مع تسجيل
+# كل جملة SQL تُنفَّذ فعلاً (set_trace_callback)، ثم يمرر كل جملة على
+# EXPLAIN QUERY PLAN. يفشل (رمز خروج 1) إذا مسحت جملة جدولاً كبيراً كاملاً
+# أو احتاجت فرزاً مؤقتاً، إلا إذا كانت في قائمة الاستثناءات أدناه.
+
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmpdir = tempfile.TemporaryDirectory(prefix='duty_plans_')
+os.environ['DB_NAME'] = os.path.join(_tmpdir.name, 'plans.db')
+
+import db  # noqa: E402
+
+# جداول صغيرة بطبيعتها لا يضر مسحها
+SMALL_TABLES = {'settings', 'timers'}
+
+# جمل يُقبل فيها المسح الكامل عن قصد (نمط -> السبب)
+ALLOWED_SCANS = {
+    'FROM jobs ORDER BY id DESC LIMIT': 'مسح بترتيب rowid من النهاية يتوقف بعد LIMIT صف',
+}
+
+_statements = []
+
+def _trace(conn):
+    conn.set_trace_callback(_statements.append)
+
+def seed(doctors=60, months=12):
+    """بيانات تجريبية: أطباء معتمدون وحجوزات عدة أشهر"""
+    for user_id in range(1, doctors + 1):
+        db.add_user(user_id, f"طبيب رقم {user_id}")
+        db.approve_user(user_id, 5)
+    db.add_user(doctors + 1, "طبيب منتظر")
+    conn = db.get_db(write=True)
+    conn.executemany(
+        "INSERT INTO bookings (day, user_id, month) VALUES (?, ?, ?)",
+        [
+            (day, (day * 7 + m) % doctors + 1, f"2025-{m:02d}")
+            for m in range(1, months + 1)
+            for day in range(1, 29)
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+def exercise():
+    """استدعاء كل دالة عامة في db.py مرة واحدة على الأقل"""
+    month = db.get_current_month()
+    db.get_user(1)
+    db.add_user(500, "طبيب جديد")
+    db.approve_user(500)
+    db.get_approved_users()
+    db.get_pending_users()
+    db.update_user_max_days(2, 4)
+    db.update_last_active(1)
+    db.record_activity([("2026-01-01 00:00:00", 3, 1), ("2026-01-01 00:00:00", 1, 2)])
+    db.get_user_bookings(1)
+    db.get_all_bookings(month)
+    list(db.iter_bookings("2025-01", month))
+    list(db.iter_bookings("2025-01", month, user_id=1))
+    db.book_day(1, 3)
+    db.cancel_booking(3, month, 1)
+    db.cancel_booking(4, month)
+    db.get_roster_summary()
+    db.get_month_statistics()
+    db.get_tomorrow_bookings()
+    db.get_today_bookings()
+    due = db.get_due_reminders()
+    db.mark_reminders_sent([(r['id'], r['kind']) for r in due] or [(1, '24h'), (2, 'same_day')])
+    db.mark_reminder_sent(1, 'same_day')
+    db.reload_settings()
+    db.set_month_days(30)
+    db.set_booking_open(True)
+    db.get_timers()
+    db.save_timer('check', 'noop', '2030-01-01 00:00:00')
+    db.delete_timer('check')
+    db.reject_user(999)
+    db.reset_month('2025-01')
+    db.archive_month('2025-02')
+    db.archive_closed_months()
+    db.get_all_bookings('2025-02')
+    db.get_user_bookings(1, '2025-02')
+    job_id = db.create_job('export', 'check', '{}', 1)
+    db.start_job(job_id)
+    db.update_job_progress(job_id, 1, 2)
+    db.get_job(job_id)
+    db.get_recent_jobs()
+    db.finish_job(job_id, db.JOB_DONE, 'ok')
+    db.mark_interrupted_jobs()
+    db.save_user_states([(1, '{"awaiting_name": true}'), (2, None)])
+    db.get_user_state(1)
+    db.set_booking_mode(db.BOOKING_MODE_PREFERENCES)
+    db.get_booking_mode()
+    for user_id, day in ((1, 5), (2, 5), (1, 6), (2, 7), (1, 6)):
+        db.toggle_preference(user_id, day)
+    db.get_preferences(1)
+    db.count_preferences()
+    db.allocate_preferences()
+    db.toggle_preference(3, 8)
+    db.clear_preferences(3)
+    db.delete_user(60)
+
+def normalize(sql):
+    return re.sub(r'\s+', ' ', sql).strip()
+
+def plan_problems(conn, sql):
+    """مشاكل خطة التنفيذ: مسح كامل لجدول كبير أو فرز مؤقت"""
+    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+    problems = []
+    for detail in plan:
+        scan = re.match(r'SCAN (\w+)', detail)
+        if scan and 'INDEX' not in detail and detail != 'SCAN CONSTANT ROW':
+            table = scan.group(1)
+            real_table = _alias_table(sql, table)
+            if real_table not in SMALL_TABLES:
+                problems.append(detail)
+        if 'USE TEMP B-TREE' in detail:
+            problems.append(detail)
+    return plan, problems
+
+def _alias_table(sql, name):
+    """تحويل الاسم المستعار (b, u) إلى اسم الجدول"""
+    match = re.search(rf'(\w+)\s+(?:AS\s+)?{name}\b', sql, re.IGNORECASE)
+    if match and match.group(1).upper() not in ('FROM', 'JOIN', 'UPDATE', 'INTO'):
+        return match.group(1)
+    return name
+
+def main():
+    verbose = '-v' in sys.argv
+    seed()
+    db.close_pool()
+    db.CONNECTION_HOOKS.append(_trace)
+    exercise()
+    db.CONNECTION_HOOKS.remove(_trace)
+    db.close_pool()
+
+    seen = {}
+    for sql in _statements:
+        text = normalize(sql)
+        if re.match(r'(SELECT|UPDATE|DELETE)\b', text, re.IGNORECASE):
+            seen.setdefault(text, sql)
+
+    conn = sqlite3.connect(db.DB_NAME)
+    failures = 0
+    for text, sql in seen.items():
+        plan, problems = plan_problems(conn, sql)
+        allowed = next((why for pattern, why in ALLOWED_SCANS.items() if pattern in text), None)
+        if problems and not allowed:
+            failures += 1
+            print(f"❌ {text}")
+            for detail in plan:
+                print(f"      {detail}")
+        elif verbose:
+            print(f"✅ {text}")
+            for detail in plan:
+                print(f"      {detail}")
+    conn.close()
+
+    print(f"\n{len(seen)} جملة، {failures} بدون فهرس مناسب")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+# tools/check_webhook.py - فحص وضع webhook دون اتصال بالإنترنت
+#
+#     python tools/check_webhook.py
+#
+# يشغّل تطبيق البوت الحقيقي (main.build_application) بخادم webhook محلي، مع طلبات
+# Bot API بديلة تُسجَّل في الذاكرة بدلاً من إرسالها لتيليجرام. ثم يرسل تحديثات
+# مسجلة بصيغة JSON إلى الخادم ويتحقق من:
+#   - رفض الطلبات بدون الرمز السري أو برمز خاطئ (403)
+#   - قبول الطلبات الصحيحة ووصول رد البوت (sendMessage) لكل تحديث
+#   - تسجيل webhook بأنواع التحديثات المسموحة فقط
+# ويطبع زمن كل تحديث من الإرسال إلى الرد. رمز الخروج 1 عند أي فشل.
+
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmpdir = tempfile.TemporaryDirectory(prefix='duty_webhook_')
+os.environ['DB_NAME'] = os.path.join(_tmpdir.name, 'webhook.db')
+
+from telegram.request import BaseRequest  # noqa: E402
+
+import main  # noqa: E402
+import tenants  # noqa: E402
+
+SECRET = 'offline-check-secret'
+URL_PATH = 'telegram'
+ADMIN_CHAT = main.config.ADMIN_ID
+NEW_USER = 1001
+
+# تحديثات مسجلة: /start من مستخدم جديد، ثم الاسم، ثم أمر /start من المشرف
+RECORDED_UPDATES = [
+    {
+        "update_id": 1,
+        "message": {
+            "message_id": 10, "date": 1767225600,
+            "chat": {"id": NEW_USER, "type": "private", "first_name": "Test"},
+            "from": {"id": NEW_USER, "is_bot": False, "first_name": "Test"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    },
+    {
+        "update_id": 2,
+        "message": {
+            "message_id": 11, "date": 1767225601,
+            "chat": {"id": NEW_USER, "type": "private", "first_name": "Test"},
+            "from": {"id": NEW_USER, "is_bot": False, "first_name": "Test"},
+            "text": "أحمد محمد علي",
+        },
+    },
+    {
+        "update_id": 3,
+        "message": {
+            "message_id": 12, "date": 1767225602,
+            "chat": {"id": ADMIN_CHAT, "type": "private", "first_name": "Admin"},
+            "from": {"id": ADMIN_CHAT, "is_bot": False, "first_name": "Admin"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    },
+]
+
+
+class OfflineRequest(BaseRequest):
+    """طلبات Bot API تُجاب محلياً وتُسجَّل بدلاً من إرسالها"""
+
+    calls = []
+
+    def __init__(self):
+        self._message_id = 100
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        OfflineRequest.calls.append((time.perf_counter(), endpoint, params))
+
+        if endpoint == 'getMe':
+            result = {"id": 1, "is_bot": True, "first_name": "Duty", "username": "duty_test_bot"}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": int(params.get('chat_id', 0)), "type": "private"},
+                "text": params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def post(url, payload, secret):
+    headers = {'Content-Type': 'application/json'}
+    if secret is not None:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    request = urllib.request.Request(url, json.dumps(payload).encode(), headers)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+async def wait_for_reply(chat_id, since, timeout=5.0):
+    """انتظار أول sendMessage للمحادثة بعد اللحظة المعطاة - يعيد زمن وصوله"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        for at, endpoint, params in OfflineRequest.calls:
+            if at >= since and endpoint == 'sendMessage' and int(params.get('chat_id', 0)) == chat_id:
+                return at
+        await asyncio.sleep(0.005)
+    return None
+
+async def run_check():
+    failures = []
+    port = free_port()
+    url = f"http://127.0.0.1:{port}/{URL_PATH}"
+    tenant = tenants.default_tenant()._replace(token='123456:OFFLINE')
+    app = main.build_application(tenant, request_factory=OfflineRequest)
+
+    # app.shutdown() (نهاية async with) يحفظ الحالة قبل إغلاق المجمع في on_shutdown
+    try:
+        async with app:
+            # post_init/post_shutdown تُستدعى تلقائياً فقط مع run_polling/run_webhook،
+            # وقبل app.start() كما في run_webhook حتى لا ينتظر app.stop() المهام الدائمة
+            await main.on_startup(app)
+            await app.updater.start_webhook(
+                listen='127.0.0.1',
+                port=port,
+                url_path=URL_PATH,
+                webhook_url=f"https://bot.example.invalid/{URL_PATH}",
+                secret_token=SECRET,
+                allowed_updates=main.ALLOWED_UPDATES,
+            )
+            await app.start()
+            try:
+                set_webhook = [p for _, e, p in OfflineRequest.calls if e == 'setWebhook']
+                allowed = set_webhook[-1].get('allowed_updates') if set_webhook else None
+                if allowed != ['message', 'callback_query']:
+                    failures.append(f"allowed_updates غير متوقعة: {allowed}")
+
+                for secret in (None, 'wrong-secret'):
+                    status = await asyncio.to_thread(post, url, RECORDED_UPDATES[0], secret)
+                    if status != 403:
+                        failures.append(f"رمز سري {secret!r}: الحالة {status} بدلاً من 403")
+
+                for update in RECORDED_UPDATES:
+                    chat_id = update['message']['chat']['id']
+                    start = time.perf_counter()
+                    status = await asyncio.to_thread(post, url, update, SECRET)
+                    replied_at = await wait_for_reply(chat_id, start)
+                    if status != 200 or replied_at is None:
+                        failures.append(f"التحديث {update['update_id']}: الحالة {status}، رد: {replied_at is not None}")
+                    else:
+                        print(f"  ✅ update {update['update_id']}: {(replied_at - start) * 1000:.1f} ms")
+            finally:
+                await app.updater.stop()
+                await app.stop()
+                await main.on_stop(app)
+    finally:
+        await main.on_shutdown(app)
+
+    return failures
+
+def main_check():
+    failures = asyncio.run(run_check())
+    for failure in failures:
+        print(f"  ❌ {failure}")
+    print("✅ وضع webhook يعمل" if not failures else f"❌ {len(failures)} فشل")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main_check())
@@ -0,0 +1,83 @@
+# tools/check_write_lock.py - التحقق من أن فشل الكتابة لا يحبس اتصال الكتابة
+#
+#     python tools/check_write_lock.py
+#
+# اتصال الكتابة في db.py حصري بقفل لا يُحرَّر إلا في close(). يفرض هذا الفحص
+# أخطاء داخل دوال الكتابة (معامل غير صالح، خرق قيد) وعند فتح الاتصال نفسه، ثم
+# يتأكد أن الكتابة التالية تنجح خلال مهلة قصيرة. يفشل (رمز خروج 1) عند أي حبس.
+
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmpdir = tempfile.TemporaryDirectory(prefix='duty_lock_')
+os.environ['DB_NAME'] = os.path.join(_tmpdir.name, 'lock.db')
+
+import db  # noqa: E402
+
+# المهلة التي تُعتبر بعدها الكتابة محبوسة (بالثواني)
+WRITE_TIMEOUT = 2
+
+# أخطاء مفروضة: (الوصف، دالة يجب أن ترفع استثناء)
+FAILING_WRITES = [
+    ("save_user_states بقيمة لا تُربط", lambda: db.save_user_states([(1, object())])),
+    ("record_activity بقيمة لا تُربط", lambda: db.record_activity([(object(), 1, 1)])),
+    ("create_job يخرق NOT NULL", lambda: db.create_job('export', None)),
+    ("save_timer بقيمة لا تُربط", lambda: db.save_timer('t', 'open_booking', object())),
+    ("mark_reminders_sent بمعرّف لا يُربط", lambda: db.mark_reminders_sent([(object(), '24h')])),
+]
+
+def write_finishes(func):
+    """تشغيل كتابة على خيط منفصل - True إذا انتهت خلال المهلة"""
+    worker = threading.Thread(target=func, daemon=True)
+    worker.start()
+    worker.join(WRITE_TIMEOUT)
+    return not worker.is_alive()
+
+def check_failing_writes():
+    failures = 0
+    for name, func in FAILING_WRITES:
+        try:
+            func()
+        except (sqlite3.Error, ValueError, TypeError):
+            pass
+        else:
+            print(f"⚠️ {name}: لم يرفع استثناء (الفحص لا يختبر شيئاً)")
+        if write_finishes(lambda: db.set_booking_open(True)):
+            print(f"✅ {name}")
+        else:
+            print(f"❌ {name}: الكتابة التالية محبوسة")
+            failures += 1
+            # القفل محبوس ولن يُحرَّر - الفحوص التالية ستفشل كلها
+            break
+    return failures
+
+def check_failing_connect():
+    """فشل فتح اتصال الكتابة نفسه يجب أن يحرر القفل"""
+    pool = db.ConnectionPool(os.path.join(_tmpdir.name, 'missing', 'lock.db'))
+    try:
+        pool.acquire(write=True)
+    except sqlite3.Error:
+        pass
+    if pool._writer_lock.acquire(timeout=WRITE_TIMEOUT):
+        pool._writer_lock.release()
+        print("✅ فشل فتح اتصال الكتابة")
+        return 0
+    print("❌ فشل فتح اتصال الكتابة: القفل محبوس")
+    return 1
+
+def main():
+    failures = check_failing_writes() + check_failing_connect()
+    if not failures:
+        # مع قفل محبوس ينتظر إغلاق المجمع للأبد
+        db.close_pool()
+    print(f"\n{len(FAILING_WRITES) + 1} حالة، {failures} فشل")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
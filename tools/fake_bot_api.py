@@ -0,0 +1,459 @@
+# tools/fake_bot_api.py - خادم Bot API محلي لقياس البوت الحقيقي من طرف إلى طرف
+#
+#     python tools/fake_bot_api.py --users 1000 --taps 2
+#     python tools/fake_bot_api.py --scenario browse --users 3000 --json
+#
+# يشغّل خادماً محلياً يتحدث بلغة Bot API (getUpdates، sendMessage،
+# editMessageText، answerCallbackQuery، sendDocument، ...)، ثم يشغّل تطبيق
+# البوت الحقيقي (main.build_application مع config.BOT_API_URL) في وضع polling
+# عليه. كل مستخدم وهمي يرسل تحديثاً وينتظر الرد قبل التالي، فيُقاس الطريق كاملاً:
+# getUpdates -> فك التحديث -> طابور المكتبة -> المعالجات -> القاعدة -> sendMessage.
+#
+# السيناريوهات:
+#   booking - "📅 حجز مناوبة" ثم --taps ضغطات book_<يوم> ثم "📋 عرض الجدول"
+#   browse  - تصفح: الجدول، الملف الشخصي، الدليل، ثم تصدير ملف التقويم (sendDocument)
+#   preferences - نمط الرغبات: "📅 حجز مناوبة" ثم --taps ضغطات pref_<يوم> و "✅ تم"،
+#             وبعد انتهاء الجميع يُغلق التسجيل ويُقاس التوزيع (معاملة واحدة)
+#
+# يخرج بالرمز 1 إذا انكسر أحد ثوابت الحجز أو لم يصل أي رد.
+
+import argparse
+import asyncio
+import email.parser
+import email.policy
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# يجب ضبط القاعدة المؤقتة قبل استيراد db
+_tmpdir = tempfile.TemporaryDirectory(prefix='duty_fake_api_')
+os.environ['DB_NAME'] = os.path.join(_tmpdir.name, 'fake_api.db')
+
+import adb  # noqa: E402
+import config  # noqa: E402
+import db  # noqa: E402
+
+TOKEN = '123456:FAKE-API'
+
+# معرفات المستخدمين الوهميين تبدأ من هنا (بعيداً عن معرف المشرف)
+FIRST_USER_ID = 10_000_000
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Duty", "username": "duty_fake_bot"}
+
+# ==================== خادم Bot API ====================
+
+class FakeBotApi:
+    """خادم HTTP يجيب طلبات Bot API من الذاكرة ويطابق الردود مع التحديثات المرسلة"""
+
+    def __init__(self):
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Condition()
+        # أول رد منتظر لكل محادثة: {chat_id: Future}
+        self._waiters = {}
+        self.calls = {}
+        self._server = None
+        self._closed = False
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        # إنهاء طلبات getUpdates المنتظرة قبل إغلاق الخادم
+        async with self._new_updates:
+            self._closed = True
+            self._new_updates.notify_all()
+        self._server.close()
+        await self._server.wait_closed()
+
+    # ---------- المستخدمون الوهميون ----------
+
+    async def inject(self, update):
+        """إضافة تحديث لطابور getUpdates - يعيد Future يكتمل بأول رد للمحادثة"""
+        chat_id = _chat_of_update(update)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = future
+        update['update_id'] = next(self._update_ids)
+        async with self._new_updates:
+            self._updates.append(update)
+            self._new_updates.notify_all()
+        return future
+
+    def _reply(self, chat_id, method, params, message):
+        future = self._waiters.pop(chat_id, None)
+        if future is not None and not future.done():
+            future.set_result((time.perf_counter(), method, params, message))
+
+    # ---------- HTTP ----------
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await _read_body(reader, headers)
+                path = request_line.decode('latin-1').split()[1]
+                method = path.rsplit('/', 1)[-1]
+                params = _parse_params(headers.get('content-type', ''), body)
+                result = await self._call(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _call(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            chat_id = int(params.get('chat_id') or 0)
+            message = {
+                "message_id": int(params.get('message_id') or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+            }
+            if method == 'sendDocument':
+                message["document"] = {"file_id": f"doc{message['message_id']}", "file_unique_id": "u"}
+            else:
+                message["text"] = params.get('text', '')
+            self._reply(chat_id, method, params, message)
+            return message
+        # answerCallbackQuery، deleteWebhook، ... لا تحتاج نتيجة
+        return True
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        async with self._new_updates:
+            # ما قبل offset تأكد استلامه
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            if not self._updates and timeout and not self._closed:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+
+async def _read_body(reader, headers):
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = b''
+        while True:
+            size = int((await reader.readline()).strip() or b'0', 16)
+            if size == 0:
+                await reader.readline()
+                return body
+            body += await reader.readexactly(size)
+            await reader.readline()
+    length = int(headers.get('content-length') or 0)
+    return await reader.readexactly(length) if length else b''
+
+
+def _parse_params(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename() is None:
+                params[name] = part.get_content()
+        return params
+    return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+
+def _chat_of_update(update):
+    if 'message' in update:
+        return update['message']['chat']['id']
+    return update['callback_query']['from']['id']
+
+# ==================== التحديثات الوهمية ====================
+
+def text_update(user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"}
+    message = {
+        "message_id": 1, "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"}, "from": user, "text": text,
+    }
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"message": message}
+
+
+def callback_update(user_id, data, message_id):
+    user = {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"}
+    return {
+        "callback_query": {
+            "id": f"{user_id}-{message_id}-{data}",
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "…",
+            },
+        }
+    }
+
+# ==================== تجهيز القاعدة ====================
+
+def seed_database(users, max_days, mode=db.BOOKING_MODE_FIRST_COME):
+    """أطباء معتمدون والحجز مفتوح بالنمط المطلوب"""
+    db.init_db()
+    for user_id in range(FIRST_USER_ID, FIRST_USER_ID + users):
+        db.add_user(user_id, f"طبيب رقم {user_id - FIRST_USER_ID + 1}")
+        db.approve_user(user_id, max_days)
+    db.set_booking_mode(mode)
+    db.set_booking_open(True)
+
+
+def check_invariants():
+    conn = db.get_db()
+    double_booked = conn.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM bookings GROUP BY day, month HAVING COUNT(*) > 1)"
+    ).fetchone()[0]
+    over_quota = conn.execute("""
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM bookings b JOIN users u ON b.user_id = u.user_id
+            GROUP BY b.user_id, b.month HAVING COUNT(*) > MAX(u.max_days)
+        )
+    """).fetchone()[0]
+    conn.close()
+    return {'double_booked_days': double_booked, 'doctors_over_max_days': over_quota}
+
+# ==================== المستخدمون ====================
+
+class Results:
+    def __init__(self):
+        self.latencies = {}
+        self.outcomes = {}
+        self.timeouts = 0
+
+    def add(self, kind, latency):
+        self.latencies.setdefault(kind, []).append(latency)
+
+    def outcome(self, code):
+        self.outcomes[code] = self.outcomes.get(code, 0) + 1
+
+
+async def act(api, results, kind, update, timeout):
+    """إرسال تحديث وانتظار الرد - يعيد الرد (method, params, message) أو None"""
+    sent = time.perf_counter()
+    future = await api.inject(update)
+    try:
+        replied, method, params, message = await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        results.timeouts += 1
+        return None
+    results.add(kind, replied - sent)
+    return method, params, message
+
+
+def classify_booking(text):
+    if text.startswith('✅'):
+        return db.BOOK_OK
+    if 'محجوز مسبقاً' in text:
+        return db.BOOK_TAKEN
+    return 'rejected'
+
+
+async def booking_user(api, results, user_id, args, rng, month_days):
+    reply = await act(api, results, 'text', text_update(user_id, "📅 حجز مناوبة"), args.timeout)
+    message_id = reply[2]['message_id'] if reply else 1
+    for _ in range(args.taps):
+        update = callback_update(user_id, f"book_{rng.randint(1, month_days)}", message_id)
+        reply = await act(api, results, 'callback', update, args.timeout)
+        if reply:
+            results.outcome(classify_booking(reply[1].get('text', '')))
+    await act(api, results, 'text', text_update(user_id, "📋 عرض الجدول"), args.timeout)
+
+
+def classify_preference(text):
+    if text.startswith('✅'):
+        return 'added'
+    if text.startswith('🗑'):
+        return 'removed'
+    return 'rejected'
+
+
+async def preferences_user(api, results, user_id, args, rng, month_days):
+    reply = await act(api, results, 'text', text_update(user_id, "📅 حجز مناوبة"), args.timeout)
+    message_id = reply[2]['message_id'] if reply else 1
+    for _ in range(args.taps):
+        update = callback_update(user_id, f"pref_{rng.randint(1, month_days)}", message_id)
+        reply = await act(api, results, 'callback', update, args.timeout)
+        if reply:
+            results.outcome(classify_preference(reply[1].get('text', '')))
+    await act(api, results, 'callback', callback_update(user_id, "pref_done", message_id), args.timeout)
+
+
+async def browse_user(api, results, user_id, args, rng, month_days):
+    for label in ("📋 عرض الجدول", "👤 ملفي الشخصي", "📚 كيفية الاستخدام"):
+        reply = await act(api, results, 'text', text_update(user_id, label), args.timeout)
+    # مهمة خلفية: الرد ملف يصل بعد الطابور (jobs.MAX_CONCURRENT_JOBS)
+    message_id = reply[2]['message_id'] if reply else 1
+    await act(api, results, 'export', callback_update(user_id, "my_ics", message_id), args.timeout)
+
+SCENARIOS = {
+    'booking': booking_user,
+    'browse': browse_user,
+    'preferences': preferences_user,
+}
+
+# ==================== التشغيل ====================
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run(args):
+    import main
+    import metrics
+    import tenants
+
+    api = FakeBotApi()
+    port = await api.start()
+    config.BOT_API_URL = f"http://127.0.0.1:{port}"
+    config.CONCURRENT_UPDATES = args.concurrency
+    mode = db.BOOKING_MODE_PREFERENCES if args.scenario == 'preferences' else db.BOOKING_MODE_FIRST_COME
+    seed_database(args.users, args.max_days, mode)
+    db.close_pool()
+
+    tenant = tenants.default_tenant()._replace(token=TOKEN)
+    app = main.build_application(tenant)
+    results = Results()
+    rng = random.Random(args.seed)
+    month_days = db.get_month_days()
+
+    with tenants.use(tenant):
+        await app.initialize()
+        await main.on_startup(app)
+        await app.updater.start_polling(allowed_updates=main.ALLOWED_UPDATES)
+        await app.start()
+        try:
+            user = SCENARIOS[args.scenario]
+
+            async def start_user(index, user_id):
+                if args.ramp:
+                    await asyncio.sleep(args.ramp * index / args.users)
+                await user(api, results, user_id, args, random.Random(rng.random()), month_days)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(
+                start_user(index, FIRST_USER_ID + index) for index in range(args.users)
+            ))
+            elapsed = time.perf_counter() - start
+
+            allocation_ms = None
+            if args.scenario == 'preferences':
+                # غلق التسجيل كما يفعل المشرف أو مؤقت الغلق: كل الحجوزات في معاملة واحدة
+                await adb.set_booking_open(False)
+                allocation_start = time.perf_counter()
+                await main.close_preference_window(app)
+                allocation_ms = (time.perf_counter() - allocation_start) * 1000
+                # إبلاغ الأطباء محدود بمعدل تيليجرام الحقيقي - لا ننتظره، يقطعه on_stop كإيقاف البوت
+        finally:
+            await app.updater.stop()
+            await app.stop()
+            await main.on_stop(app)
+            await app.shutdown()
+            await main.on_shutdown(app)
+            await api.stop()
+
+        report = {
+            'scenario': args.scenario,
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'elapsed_s': round(elapsed, 3),
+            'replies': sum(len(v) for v in results.latencies.values()),
+            'timeouts': results.timeouts,
+        }
+        report['throughput_rps'] = round(report['replies'] / elapsed, 1) if elapsed else 0.0
+        if allocation_ms is not None:
+            report['allocation_ms'] = round(allocation_ms, 2)
+            report['allocated_days'] = len(db.get_all_bookings())
+        for kind, latencies in sorted(results.latencies.items()):
+            latencies.sort()
+            for pct in (50, 95, 99):
+                report[f'{kind}_p{pct}_ms'] = round(percentile(latencies, pct) * 1000, 2)
+            report[f'{kind}_max_ms'] = round(latencies[-1] * 1000, 2)
+        processor = app.update_processor.get_stats()
+        report['bot_queue_wait_p95_ms'] = round(processor['p95_wait_ms'], 2)
+        report['bot_max_queued'] = processor['max_queued']
+        report['bot_handler_errors'] = metrics.HANDLER_ERRORS.total() + metrics.UPDATE_ERRORS.total()
+        report['outcomes'] = results.outcomes
+        report['api_calls'] = dict(sorted(api.calls.items()))
+        report.update(check_invariants())
+    return report
+
+
+def print_report(report):
+    print(f"\n=== {report['scenario']} ===")
+    for key, value in report.items():
+        if key != 'scenario':
+            print(f"  {key:24} {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس البوت من طرف إلى طرف عبر Bot API وهمي")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='booking')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--taps', type=int, default=2, help="ضغطات الحجز (أو الرغبات) لكل مستخدم")
+    parser.add_argument('--max-days', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=config.CONCURRENT_UPDATES,
+                        help="CONCURRENT_UPDATES للبوت")
+    parser.add_argument('--ramp', type=float, default=0.0, help="توزيع بدء المستخدمين على ثوانٍ")
+    parser.add_argument('--timeout', type=float, default=30.0, help="مهلة الرد لكل تحديث")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="طباعة النتائج بصيغة JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    adb.shutdown()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    broken = report['double_booked_days'] or report['doctors_over_max_days'] or not report['replies']
+    return 1 if broken else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
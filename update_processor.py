@@ -0,0 +1,119 @@
+# update_processor.py - معالجة التحديثات بالتوازي مع الحفاظ على ترتيب تحديثات كل مستخدم
+#
+# تحديثات المستخدم الواحد تُنفَّذ بترتيب وصولها (حالات awaiting_* في user_data
+# تعتمد على ذلك)، وتحديثات المستخدمين المختلفين تعمل بالتوازي حتى حد معين.
+# فلا ينتظر ضغط زر حجز من طبيب انتهاءَ تصدير أو إرسال جماعي بدأه المشرف.
+#
+# ملاحظة: BaseUpdateProcessor.process_update يحجز إشارته (semaphore) قبل
+# do_process_update، فلو كانت هي حد التوازي لشغلت تحديثات مستخدم واحد منتظرة
+# دورها كل الأماكن. لذلك إشارة الأساس هنا حد أعلى للتحديثات المعلقة فقط، وحد
+# التوازي الفعلي يُطبَّق بعد دور المستخدم.
+
+import asyncio
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# الحد الأعلى للتحديثات المعلقة (منتظرة + قيد التنفيذ) قبل إيقاف استلام المزيد
+MAX_PENDING_UPDATES = 1024
+
+# عدد أزمنة الانتظار المحفوظة لحساب p95
+WAIT_SAMPLES = 1024
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """تنفيذ متوازٍ للتحديثات مع تسلسل تحديثات كل مستخدم"""
+
+    __slots__ = (
+        'concurrency', '_running', '_user_locks', '_queued', '_active',
+        '_max_queued', '_max_user_queue', '_processed', '_wait_total',
+        '_wait_max', '_wait_samples'
+    )
+
+    def __init__(self, concurrency, max_pending=MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending, concurrency))
+        self.concurrency = concurrency
+        self._running = asyncio.Semaphore(concurrency)
+        # {user_id: [القفل، عدد تحديثاته المعلقة]}
+        self._user_locks = {}
+        self._queued = 0
+        self._active = 0
+        self._max_queued = 0
+        self._max_user_queue = 0
+        self._processed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_samples = deque(maxlen=WAIT_SAMPLES)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update, coroutine):
+        arrived = time.perf_counter()
+        user = update.effective_user if isinstance(update, Update) else None
+
+        self._queued += 1
+        self._max_queued = max(self._max_queued, self._queued)
+        entry = None
+        if user is not None:
+            entry = self._user_locks.get(user.id)
+            if entry is None:
+                entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            self._max_user_queue = max(self._max_user_queue, entry[1])
+
+        started = False
+        try:
+            # قفل المستخدم أولاً (أقفال asyncio تخدم المنتظرين بترتيب وصولهم) ثم مكان تنفيذ
+            if entry is not None:
+                await entry[0].acquire()
+            try:
+                async with self._running:
+                    started = True
+                    self._queued -= 1
+                    self._record_wait(time.perf_counter() - arrived)
+                    self._active += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self._active -= 1
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if not started:
+                # أُلغي قبل التنفيذ (مثلاً عند الإيقاف)
+                self._queued -= 1
+                coroutine.close()
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._user_locks[user.id]
+
+    def _record_wait(self, wait):
+        self._processed += 1
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        self._wait_samples.append(wait)
+
+    def get_stats(self):
+        """إحصائيات الطابور: العمق الحالي والأقصى وأزمنة الانتظار قبل التنفيذ"""
+        samples = sorted(self._wait_samples)
+        p95 = samples[int(len(samples) * 0.95)] if samples else 0.0
+        return {
+            'concurrency': self.concurrency,
+            'queued': self._queued,
+            'active': self._active,
+            'max_queued': self._max_queued,
+            'max_user_queue': self._max_user_queue,
+            'users_waiting': sum(1 for lock, count in self._user_locks.values() if count > 1),
+            'processed': self._processed,
+            'avg_wait_ms': self._wait_total * 1000 / self._processed if self._processed else 0.0,
+            'p95_wait_ms': p95 * 1000,
+            'max_wait_ms': self._wait_max * 1000,
+        }